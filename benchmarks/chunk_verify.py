@@ -0,0 +1,136 @@
+"""Measure what chunk verification costs, and what a repair costs against a full re-send.
+
+Sends a file with FileTransferManager.send_stream to a receiver on
+127.0.0.1:32769 (so SnapSend must not be running here), first with
+verification off, then on, then on with --corrupt chunks damaged on
+their way out. The damage is done in the sender's first pass only, the way
+a flaky link or bad RAM would, and is caught by the receiver's ChunkTree
+and repaired. Reports throughput, the CPU time both ends spent per GB and
+how many bytes were sent twice.
+
+    python benchmarks/chunk_verify.py --size-mb 1000
+    python benchmarks/chunk_verify.py --size-mb 2000 --corrupt 20
+"""
+import argparse
+import hashlib
+import os
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from snapsend import ChunkTree, DeviceDiscoveryScreen, FileTransferManager  # noqa: E402
+
+
+class Receiver:
+    """Just enough of DeviceDiscoveryScreen to run its receive path without a window"""
+    handle_file_reception = DeviceDiscoveryScreen.handle_file_reception
+    receive_file_data = DeviceDiscoveryScreen.receive_file_data
+
+    class app:
+        show_receiving_popup = update_receiving_progress = close_receiving_popup = staticmethod(lambda *args: None)
+
+    def __init__(self, downloads_path):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(('127.0.0.1', 32769))
+        self.server.listen(8)
+        self.downloads_path = downloads_path
+        self.done = threading.Semaphore(0)
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            client, addr = self.server.accept()
+            threading.Thread(target=self._serve, args=(client, addr), daemon=True).start()
+
+    def _serve(self, client, addr):
+        self.handle_file_reception(client, addr, self.downloads_path)
+        self.done.release()
+
+
+class CorruptingLimiter:
+    """Flips a byte in the chosen 1 MiB blocks of the first pass"""
+
+    def __init__(self, limiter, blocks):
+        self.limiter = limiter
+        self.blocks = blocks
+        self.sent = 0
+
+    def send(self, sock, peer, data):
+        index = self.sent // ChunkTree.CHUNK
+        self.sent += len(data)
+        if index in self.blocks:
+            self.blocks.discard(index)
+            data = bytearray(data)
+            data[len(data) // 2] ^= 0xff
+        self.limiter.send(sock, peer, data)
+
+    def __getattr__(self, name):
+        return getattr(self.limiter, name)
+
+
+def digest(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1048576), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size-mb', type=int, default=500)
+    parser.add_argument('--corrupt', type=int, default=5, help="chunks to damage in the last run")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='snapsend-bench-')
+    try:
+        source = os.path.join(workdir, 'source.bin')
+        size = args.size_mb * 1048576
+        with open(source, 'wb') as f:
+            for _ in range(args.size_mb):
+                f.write(os.urandom(1048576))
+        expected = digest(source)
+        downloads = os.path.join(workdir, 'downloads')
+        os.makedirs(downloads)
+        receiver = Receiver(downloads)
+        FileTransferManager.dedup = False
+        limiter = FileTransferManager.limiter
+        chunks = (size + ChunkTree.CHUNK - 1) // ChunkTree.CHUNK
+        runs = (
+            (None, False, set()),  # The first pass pays for the page cache
+            ('unverified', False, set()),
+            ('verified', True, set()),
+            (f'{args.corrupt} corrupted', True, set(random.sample(range(chunks), min(args.corrupt, chunks)))),
+        )
+        for name, verify, blocks in runs:
+            FileTransferManager.verify_chunks = verify
+            FileTransferManager.limiter = CorruptingLimiter(limiter, blocks)
+            wall, cpu = time.perf_counter(), time.process_time()
+            try:
+                FileTransferManager.send_stream('127.0.0.1', 'source.bin', size,
+                                                FileTransferManager.file_chunks(source, size), file_path=source)
+                error = None
+            except Exception as e:
+                error = e
+            receiver.done.acquire()
+            wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+            sent = FileTransferManager.limiter.sent
+            if name is None:
+                continue
+            ok = digest(os.path.join(downloads, 'source.bin')) == expected
+            print(f"{name:14} {size / wall / 1048576:8.1f} MB/s  {cpu / size * 1073741824:6.2f} CPU s/GB  "
+                  f"resent {(sent - size) / 1048576:7.1f} MB  "
+                  f"{'verified' if ok else 'CORRUPT'}{f'  ({error})' if error else ''}")
+        FileTransferManager.limiter = limiter
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
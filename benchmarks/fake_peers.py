@@ -0,0 +1,251 @@
+"""Simulate many SnapSend peers against one running receiver.
+
+Every virtual peer has its own address and device ID. By default the
+addresses are 127.1.0.1, 127.1.0.2 and so on, which Linux routes over
+loopback without any setup. Each peer beacons to the target every
+--beacon-interval seconds. With --churn, peers leave and are replaced
+by new devices, so the target keeps adding and expiring cards. With
+--uploads, that many uploaders keep sending files from random live peers
+to the target's receiver on port 32769. Each file is written over the
+same loadgen-<n>.bin in the target's downloads folder.
+
+Start the target with **Serve metrics on localhost** enabled. The tool
+reads its /metrics endpoint during the run and reports:
+- beacon processing latency, device card lag and sweep time;
+- the listed peer count over time;
+- receive throughput as seen by the target.
+
+Upload throughput and latency are measured here as well.
+
+    python benchmarks/fake_peers.py --peers 500 --duration 60
+    python benchmarks/fake_peers.py --peers 200 --churn 0.5 --uploads 16 --upload-mb 1,8,64
+
+To drive a receiver on another machine over a bridge, first add the
+peer range to the bridge. For example, give br0 10.9.0.1/16 and up.
+Then pass --address-base 10.9.0.1 and the target's address. The metrics
+endpoint only listens on localhost. On that machine, forward the port
+or leave out --metrics-url.
+"""
+import argparse
+import ipaddress
+import os
+import random
+import re
+import socket
+import sys
+import threading
+import time
+import urllib.request
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from snapsend import StreamHeader  # noqa: E402
+
+SAMPLE = re.compile(r'^(\w+)(?:\{(.*)\})? (\S+)$')
+HISTOGRAMS = (
+    ('beacon processing', 'snapsend_beacon_processing_seconds'),
+    ('device card lag', 'snapsend_device_card_lag_seconds'),
+    ('device sweep', 'snapsend_device_sweep_seconds'),
+)
+
+
+class VirtualPeer:
+    def __init__(self, index, address):
+        self.index = index
+        self.address = address
+        self.generation = 0
+        self.renew()
+
+    def renew(self):
+        """Become a different device on the same address"""
+        self.generation += 1
+        self.device_id = uuid.uuid4().hex[:16]
+        self.name = f"loadgen-{self.index}-{self.generation}"
+
+    def beacon(self):
+        return f"{self.name}|{self.address}|{self.device_id}|".encode()
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.beacons = 0
+        self.replaced = 0
+        self.uploads = 0
+        self.upload_errors = 0
+        self.upload_bytes = 0
+        self.upload_seconds = []
+
+    def add(self, **values):
+        with self.lock:
+            for name, value in values.items():
+                setattr(self, name, getattr(self, name) + value)
+
+
+def scrape(url):
+    """{(name, labels): value} from a Prometheus text endpoint, or None if it is unreachable"""
+    try:
+        with urllib.request.urlopen(url, timeout=2) as response:
+            text = response.read().decode()
+    except OSError:
+        return None
+    samples = {}
+    for line in text.splitlines():
+        match = SAMPLE.match(line)
+        if match:
+            samples[match.group(1), match.group(2) or ''] = float(match.group(3))
+    return samples
+
+
+def quantile(before, after, name, q):
+    """Estimate quantile q of what histogram name observed between two scrapes"""
+    buckets = []
+    for (sample, labels), value in after.items():
+        if sample == name + '_bucket':
+            bound = labels.split('le="')[1].rstrip('"')
+            buckets.append((float(bound), value - before.get((sample, labels), 0)))
+    buckets.sort()
+    total = buckets[-1][1] if buckets else 0
+    if not total:
+        return None
+    for bound, count in buckets:
+        if count >= q * total:
+            return bound
+    return buckets[-1][0]
+
+
+def run_beacons(peers, args, stats, stop):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+    replace_chance = args.churn * args.beacon_interval / 60
+    while not stop.is_set():
+        started = time.perf_counter()
+        for i, peer in enumerate(peers):
+            if replace_chance and random.random() < replace_chance:
+                peer.renew()
+                stats.add(replaced=1)
+            try:
+                sock.sendto(peer.beacon(), (args.beacon_to or args.target, 32768))
+                stats.add(beacons=1)
+            except OSError as e:
+                print(f"Beacon from {peer.address} failed: {e}")
+            # Spread the round over the interval the way independent devices would be
+            delay = started + args.beacon_interval * (i + 1) / len(peers) - time.perf_counter()
+            if delay > 0:
+                stop.wait(delay)
+    sock.close()
+
+
+def run_uploads(peers, sizes, payload, args, stats, stop):
+    while not stop.is_set():
+        peer = random.choice(peers)
+        size = random.choice(sizes)
+        started = time.perf_counter()
+        try:
+            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+                sock.bind((peer.address, 0))
+                sock.settimeout(60)
+                sock.connect((args.target, 32769))
+                sock.sendall(StreamHeader.pack(f"loadgen-{peer.index}.bin", size))
+                view = memoryview(payload)
+                sent = 0
+                while sent < size:
+                    block = view[:min(len(view), size - sent)]
+                    sock.sendall(block)
+                    sent += len(block)
+                status, info = StreamHeader.read_reply(sock)
+                if status != StreamHeader.ACCEPT:
+                    raise Exception(info.get('error', "rejected"))
+            stats.add(uploads=1, upload_bytes=size, upload_seconds=[time.perf_counter() - started])
+        except Exception as e:
+            print(f"Upload from {peer.address} failed: {e}")
+            stats.add(upload_errors=1)
+            stop.wait(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--target', default='127.0.0.1', help="address of the SnapSend instance under test")
+    parser.add_argument('--peers', type=int, default=100)
+    parser.add_argument('--address-base', default='127.1.0.1', help="first virtual peer address")
+    parser.add_argument('--beacon-to', help="send beacons here instead of the target, e.g. a broadcast address")
+    parser.add_argument('--beacon-interval', type=float, default=2.0)
+    parser.add_argument('--churn', type=float, default=0.0, help="share of peers replaced per minute")
+    parser.add_argument('--uploads', type=int, default=0, help="concurrent uploads")
+    parser.add_argument('--upload-mb', default='4', help="comma-separated sizes to pick from")
+    parser.add_argument('--duration', type=float, default=30.0)
+    parser.add_argument('--metrics-url', default='http://127.0.0.1:32780/metrics',
+                        help="the target's metrics endpoint; pass '' to skip it")
+    args = parser.parse_args()
+
+    base = ipaddress.IPv4Address(args.address_base)
+    peers = [VirtualPeer(i, str(base + i)) for i in range(args.peers)]
+    sizes = [int(float(mb) * 1048576) for mb in args.upload_mb.split(',')]
+    payload = os.urandom(1048576)
+    stats = Stats()
+    stop = threading.Event()
+
+    before = scrape(args.metrics_url) if args.metrics_url else None
+    if args.metrics_url and before is None:
+        print(f"No metrics at {args.metrics_url}; reporting what this side sees only")
+    threads = [threading.Thread(target=run_beacons, args=(peers, args, stats, stop))]
+    threads += [threading.Thread(target=run_uploads, args=(peers, sizes, payload, args, stats, stop))
+                for _ in range(args.uploads)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+
+    listed = []  # (seconds since start, peers the target lists)
+    all_listed_at = None
+    try:
+        while time.perf_counter() - started < args.duration:
+            time.sleep(1)
+            elapsed = time.perf_counter() - started
+            samples = scrape(args.metrics_url) if before is not None else None
+            count = samples.get(('snapsend_peers', '')) if samples else None
+            if count is not None:
+                listed.append((elapsed, count))
+                if all_listed_at is None and count >= args.peers:
+                    all_listed_at = elapsed
+            print(f"{elapsed:5.0f}s  beacons {stats.beacons}  uploads {stats.uploads} ({stats.upload_errors} failed)"
+                  + (f"  target lists {count:.0f}" if count is not None else ""))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+    elapsed = time.perf_counter() - started
+
+    print(f"\n{args.peers} peers for {elapsed:.1f}s: {stats.beacons} beacons sent, {stats.replaced} peers replaced")
+    if stats.uploads:
+        durations = sorted(stats.upload_seconds)
+        print(f"uploads: {stats.uploads} done, {stats.upload_errors} failed, "
+              f"{stats.upload_bytes / elapsed / 1048576:.1f} MB/s aggregate, "
+              f"median {durations[len(durations) // 2]:.2f}s, worst {durations[-1]:.2f}s")
+    after = scrape(args.metrics_url) if before is not None else None
+    if not after:
+        return
+    received = after.get(('snapsend_beacons_received_total', ''), 0) - before.get(
+        ('snapsend_beacons_received_total', ''), 0)
+    expired = after.get(('snapsend_peer_expirations_total', ''), 0) - before.get(
+        ('snapsend_peer_expirations_total', ''), 0)
+    print(f"target: {received:.0f} beacons received ({received / max(stats.beacons, 1):.1%}), "
+          f"{expired:.0f} devices expired")
+    if listed:
+        counts = [count for _, count in listed]
+        print(f"target listed {min(counts):.0f}-{max(counts):.0f} peers, {counts[-1]:.0f} at the end; "
+              + (f"all {args.peers} listed after {all_listed_at:.0f}s" if all_listed_at is not None
+                 else f"never all {args.peers}"))
+    for label, name in HISTOGRAMS:
+        p50, p99 = quantile(before, after, name, 0.5), quantile(before, after, name, 0.99)
+        if p50 is not None:
+            print(f"{label:18} p50 <= {p50 * 1000:8.2f} ms  p99 <= {p99 * 1000:8.2f} ms")
+    received_bytes = sum(value - before.get(key, 0) for key, value in after.items()
+                         if key[0] == 'snapsend_transfer_bytes_total' and 'direction="receive"' in key[1])
+    if received_bytes:
+        print(f"target received {received_bytes / elapsed / 1048576:.1f} MB/s")
+
+
+if __name__ == '__main__':
+    main()
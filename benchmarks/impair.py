@@ -0,0 +1,491 @@
+"""Network impairment proxy for running SnapSend transfers over realistic links.
+
+The proxy listens for TCP on one address and forwards to a receiver on
+another. Each direction passes through a Link, which applies:
+- a bandwidth cap, with a drop-tail bottleneck queue;
+- latency and jitter;
+- random or bursty loss;
+- reordering.
+
+TCP streams only see the rate, delay and jitter. A userspace proxy
+cannot drop segments, so a loss blackout stalls the stream instead. For
+real TCP loss, use tc netem, as udp_vs_tcp.py --netem does.
+
+When the receiver's reply offers a UDP port, the proxy opens a relay
+port of its own and rewrites the reply to point at it. The datagrams of
+SnapSend's UDP mode then cross the same profile, with loss and
+reordering.
+
+Profiles are scripted as phases that repeat, so a profile can model
+interference that comes and goes. Rates, delays and losses apply to each
+direction separately. Run with --list to see them.
+
+Run as a proxy in front of a receiver. When both sides use port 32769
+on one machine, the listen address must differ from the target's:
+
+    python benchmarks/impair.py --profile busy-office-wifi --listen 127.0.0.2 --target 127.0.0.1
+
+Or measure SnapSend's own send path against an in-process receiver,
+for each profile, transport and number of parallel streams:
+
+    python benchmarks/impair.py --bench --profile gigabit-lan,busy-office-wifi --transport tcp,udp --streams 1,4
+"""
+import argparse
+import contextlib
+import hashlib
+import heapq
+import itertools
+import json
+import os
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, deque
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from snapsend import DeviceDiscoveryScreen, FileTransferManager, LinkProfiles, StreamHeader  # noqa: E402
+
+# Each profile is a list of phases repeated in order. A phase holds
+# seconds (ignored if it is the only phase), rate_mbps (0 means
+# unlimited), delay_ms, jitter_ms, loss (a fraction), burst (the chance
+# that the packet after a lost one is lost too) and reorder (the share
+# of datagrams held back past their successors).
+PROFILES = {
+    'loopback': [{}],
+    'gigabit-lan': [{'rate_mbps': 940, 'delay_ms': 0.15, 'jitter_ms': 0.05}],
+    'fast-ethernet': [{'rate_mbps': 94, 'delay_ms': 0.3, 'jitter_ms': 0.1}],
+    'home-wifi': [{'rate_mbps': 180, 'delay_ms': 2, 'jitter_ms': 1.5, 'loss': 0.002, 'burst': 0.2,
+                   'reorder': 0.005}],
+    # Contention from neighbouring stations every ten seconds
+    'busy-office-wifi': [
+        {'seconds': 8, 'rate_mbps': 40, 'delay_ms': 6, 'jitter_ms': 8, 'loss': 0.01, 'burst': 0.3,
+         'reorder': 0.02},
+        {'seconds': 2, 'rate_mbps': 8, 'delay_ms': 25, 'jitter_ms': 30, 'loss': 0.05, 'burst': 0.5,
+         'reorder': 0.05},
+    ],
+    'weak-wifi': [{'rate_mbps': 12, 'delay_ms': 10, 'jitter_ms': 15, 'loss': 0.03, 'burst': 0.4,
+                   'reorder': 0.03}],
+    # An access point handoff every fifteen seconds
+    'wifi-roaming': [
+        {'seconds': 14, 'rate_mbps': 120, 'delay_ms': 3, 'jitter_ms': 2, 'loss': 0.003, 'reorder': 0.01},
+        {'seconds': 1, 'loss': 1.0},
+    ],
+    'vpn-wan': [{'rate_mbps': 50, 'delay_ms': 20, 'jitter_ms': 3, 'loss': 0.001}],
+}
+
+
+class Link:
+    """One direction of an impaired path: a rate-limited bottleneck queue, then delay, jitter, loss and reordering.
+
+    Every connection and datagram relay of a proxy shares its two Links,
+    as traffic shares one radio.
+    """
+
+    def __init__(self, phases, queue_ms=50):
+        self.lock = threading.Lock()
+        self.phases = phases
+        self.queue = queue_ms / 1000
+        self.started = time.monotonic()
+        self.random = random.Random()
+        self.free_at = 0.0  # When the bottleneck has sent everything queued so far
+        self.last_release = 0.0
+        self.losing = False  # Gilbert-Elliott state for bursty loss
+        self.stats = Counter()
+
+    def phase(self, now):
+        """The phase in effect at now and when it ends"""
+        if len(self.phases) == 1:
+            return self.phases[0], float('inf')
+        cycle = sum(phase['seconds'] for phase in self.phases)
+        elapsed = (now - self.started) % cycle
+        for phase in self.phases:
+            if elapsed < phase['seconds']:
+                return phase, now + phase['seconds'] - elapsed
+            elapsed -= phase['seconds']
+        return self.phases[-1], now
+
+    def backlog(self, now):
+        """Seconds of data queued at the bottleneck"""
+        return max(0.0, self.free_at - now)
+
+    def admit(self, size, now, stream=False):
+        """When a packet, or a chunk of a stream, entering now leaves the link; None if it is lost.
+
+        A stream is never dropped or reordered. A blackout holds it until
+        the phase ends.
+        """
+        with self.lock:
+            return self._admit(size, now, stream)
+
+    def _admit(self, size, now, stream):
+        phase, ends_at = self.phase(now)
+        self.stats['stream chunks' if stream else 'datagrams'] += 1
+        loss = phase.get('loss', 0)
+        start = max(now, self.free_at)
+        if stream and loss >= 1:
+            start = max(start, ends_at)
+        rate = phase.get('rate_mbps', 0) * 125000
+        if not stream:
+            if rate and start - now > self.queue:
+                self.stats['queue_drops'] += 1
+                return None
+            if self.random.random() < (phase.get('burst', loss) if self.losing else loss):
+                self.losing = True
+                self.stats['lost'] += 1
+                return None
+            self.losing = False
+        self.free_at = start + (size / rate if rate else 0)
+        jitter = phase.get('jitter_ms', 0) / 1000
+        release = self.free_at + phase.get('delay_ms', 0) / 1000 + abs(self.random.gauss(0, jitter))
+        if not stream and self.random.random() < phase.get('reorder', 0):
+            self.stats['reordered'] += 1
+            return release + max(2 * jitter, 0.001)
+        # Jitter alone does not reorder: a queue releases in order
+        self.last_release = release = max(release, self.last_release)
+        return release
+
+
+class UdpRelay:
+    """Relays datagrams between whoever sends to listen and target through a Link per direction"""
+
+    def __init__(self, listen, target, uplink, downlink):
+        self.target = target
+        self.client = None
+        self.uplink = uplink
+        self.downlink = downlink
+        self.front = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.front.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 8 * 1048576)
+        self.front.bind(listen)
+        self.back = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.back.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 8 * 1048576)
+        self.back.connect(target)
+        self.pending = []
+        self.order = itertools.count()
+        self.condition = threading.Condition()
+        self.closed = False
+        threading.Thread(target=self._receive, args=(self.front, True), daemon=True).start()
+        threading.Thread(target=self._receive, args=(self.back, False), daemon=True).start()
+        threading.Thread(target=self._deliver, daemon=True).start()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.front.close()
+        self.back.close()
+
+    def _receive(self, sock, upstream):
+        link = self.uplink if upstream else self.downlink
+        while True:
+            try:
+                data, address = sock.recvfrom(65535)
+            except OSError:
+                return
+            if upstream:
+                self.client = address
+            release = link.admit(len(data) + 28, time.monotonic())
+            if release is None:
+                continue
+            with self.condition:
+                heapq.heappush(self.pending, (release, next(self.order), upstream, data))
+                self.condition.notify()
+
+    def _deliver(self):
+        while True:
+            with self.condition:
+                while not self.closed and (not self.pending or self.pending[0][0] > time.monotonic()):
+                    self.condition.wait(self.pending[0][0] - time.monotonic() if self.pending else None)
+                if self.closed:
+                    return
+                release, _, upstream, data = heapq.heappop(self.pending)
+            try:
+                if upstream:
+                    self.back.send(data)
+                elif self.client:
+                    self.front.sendto(data, self.client)
+            except OSError:
+                pass
+
+
+class ImpairmentProxy:
+    """Forwards TCP connections from listen to target through impaired Links, relaying offered UDP ports too"""
+
+    def __init__(self, listen, target, profile, queue_ms=50):
+        self.target = target
+        self.uplink = Link(profile, queue_ms)  # Towards the receiver
+        self.downlink = Link(profile, queue_ms)
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(listen)
+        self.server.listen(64)
+        self.address = self.server.getsockname()
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def close(self):
+        with contextlib.suppress(OSError):
+            self.server.shutdown(socket.SHUT_RDWR)  # Wakes the accept() so the port is released
+        self.server.close()
+
+    def _accept(self):
+        while True:
+            try:
+                client, _ = self.server.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._serve, args=(client,), daemon=True).start()
+
+    def _serve(self, client):
+        try:
+            upstream = socket.create_connection(self.target)
+        except OSError as e:
+            print(f"Could not reach {self.target}: {e}")
+            client.close()
+            return
+        relays = []
+        for sock in (client, upstream):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        forward = threading.Thread(target=self._pump, args=(client, upstream, self.uplink))
+        forward.start()
+        self._pump(upstream, client, self.downlink, relays)
+        forward.join()
+        for relay in relays:
+            relay.close()
+        client.close()
+        upstream.close()
+
+    def _pump(self, source, destination, link, relays=None):
+        """Copy source to destination through link; relays collects UDP relays opened for a reply"""
+        queue = deque()
+        condition = threading.Condition()
+
+        def write():
+            while True:
+                with condition:
+                    while not queue:
+                        condition.wait()
+                    release, data = queue.popleft()
+                delay = release - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                try:
+                    if data is None:
+                        destination.shutdown(socket.SHUT_WR)
+                        return
+                    destination.sendall(data)
+                except OSError:
+                    return
+
+        writer = threading.Thread(target=write, daemon=True)
+        writer.start()
+        def enqueue(data):
+            now = time.monotonic()
+            # A full bottleneck queue pushes back on the sender, as TCP flow control would
+            backlog = link.backlog(now) - link.queue
+            if backlog > 0:
+                time.sleep(backlog)
+                now = time.monotonic()
+            release = link.admit(len(data), now, stream=True) if data else max(now, link.last_release)
+            with condition:
+                queue.append((release, data or None))
+                condition.notify()
+
+        reply = bytearray() if relays is not None else None
+        while True:
+            try:
+                data = source.recv(16384)
+            except OSError:
+                data = b''
+            if reply is not None:
+                # Hold the receiver's first reply until it is complete, in case it needs rewriting
+                reply += data
+                forward = self._rewrite_reply(reply, relays) if data else bytes(reply)
+                if forward is None:
+                    continue
+                reply = None
+                if forward:
+                    enqueue(forward)
+                if data:
+                    continue
+            enqueue(data)
+            if not data:
+                break
+        writer.join()
+
+    def _rewrite_reply(self, buffer, relays):
+        """The bytes to forward once the first reply is complete, or None until then.
+
+        A reply offering udp_port gets a UDP relay, and the port is swapped
+        for the relay's.
+        """
+        if len(buffer) < StreamHeader.REPLY.size:
+            return None
+        status, length = StreamHeader.REPLY.unpack_from(buffer)
+        if status not in (StreamHeader.ACCEPT, StreamHeader.REJECT) or length > StreamHeader.MAX_BODY:
+            return bytes(buffer)  # Not a SnapSend reply, e.g. TLS
+        end = StreamHeader.REPLY.size + length
+        if len(buffer) < end:
+            return None
+        try:
+            info = json.loads(bytes(buffer[StreamHeader.REPLY.size:end]) or b'{}')
+        except ValueError:
+            return bytes(buffer)
+        if not info.get('udp_port'):
+            return bytes(buffer)
+        try:
+            relay = UdpRelay((self.address[0], 0), (self.target[0], info['udp_port']), self.uplink, self.downlink)
+        except OSError as e:
+            print(f"Could not relay UDP port {info['udp_port']} ({e}); it will bypass the proxy")
+            return bytes(buffer)
+        relays.append(relay)
+        info['udp_port'] = relay.front.getsockname()[1]
+        payload = json.dumps(info).encode()
+        return StreamHeader.REPLY.pack(status, len(payload)) + payload + bytes(buffer[end:])
+
+
+class Receiver:
+    """Just enough of DeviceDiscoveryScreen to run its receive path without a window"""
+    handle_file_reception = DeviceDiscoveryScreen.handle_file_reception
+    receive_file_data = DeviceDiscoveryScreen.receive_file_data
+    reuse_local_copy = DeviceDiscoveryScreen.reuse_local_copy
+    receive_sync = DeviceDiscoveryScreen.receive_sync
+    join_swarm = DeviceDiscoveryScreen.join_swarm
+
+    class app:
+        show_receiving_popup = update_receiving_progress = close_receiving_popup = staticmethod(lambda *args: None)
+
+    def __init__(self, downloads_path, rcvbuf):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(64)
+        self.address = self.server.getsockname()
+        self.downloads_path = downloads_path
+        self.rcvbuf = rcvbuf
+        self.finished = 0
+        self.condition = threading.Condition()
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            client, addr = self.server.accept()
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            client.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf)
+            threading.Thread(target=self._serve, args=(client, addr), daemon=True).start()
+
+    def _serve(self, client, addr):
+        self.handle_file_reception(client, addr, self.downloads_path)
+        with self.condition:
+            self.finished += 1
+            self.condition.notify_all()
+
+    def wait(self, count, timeout):
+        """Wait until count receptions have ended since the last call"""
+        with self.condition:
+            self.condition.wait_for(lambda: self.finished >= count, timeout)
+            self.finished = max(0, self.finished - count)
+
+
+def digest(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1048576), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def bench(args):
+    workdir = tempfile.mkdtemp(prefix='snapsend-bench-')
+    try:
+        downloads_path = os.path.join(workdir, 'downloads')
+        os.makedirs(downloads_path)
+        source = os.path.join(workdir, 'source.bin')
+        size = int(args.size_mb * 1048576)
+        with open(source, 'wb') as f:
+            f.write(os.urandom(size))
+        expected = digest(source)
+        receiver = Receiver(downloads_path, args.rcvbuf_kb * 1024)
+        FileTransferManager.dedup = False
+        LinkProfiles.configure(None)
+
+        print(f"{'profile':18} {'transport':9} {'streams':>7} {'MB/s':>8} {'seconds':>8}  result")
+        for name in args.profile.split(','):
+            proxy = ImpairmentProxy((args.listen, 32769), receiver.address, PROFILES[name], args.queue_ms)
+            for transport in args.transport.split(','):
+                for streams in (int(count) for count in args.streams.split(',')):
+                    if not args.keep_history:
+                        LinkProfiles.clear()
+                    FileTransferManager.use_udp = transport == 'udp'
+                    errors = []
+
+                    def send(index):
+                        try:
+                            FileTransferManager.send_stream(
+                                args.listen, f"copy{index}.bin", size,
+                                FileTransferManager.file_chunks(source, size), file_path=source)
+                        except Exception as e:
+                            errors.append(str(e))
+
+                    started = time.perf_counter()
+                    threads = [threading.Thread(target=send, args=(index,)) for index in range(streams)]
+                    for thread in threads:
+                        thread.start()
+                    for thread in threads:
+                        thread.join()
+                    # A sender is done once its data is in flight; the receiver decides when it arrived
+                    receiver.wait(streams, timeout=300)
+                    elapsed = time.perf_counter() - started
+                    corrupt = sum(digest(os.path.join(downloads_path, f"copy{index}.bin")) != expected
+                                  for index in range(streams) if not errors)
+                    result = (f"failed: {errors[0]}" if errors
+                              else f"{corrupt} corrupt" if corrupt else "verified")
+                    print(f"{name:18} {transport:9} {streams:7} {streams * size / elapsed / 1048576:8.1f} "
+                          f"{elapsed:8.2f}  {result}")
+            proxy.close()
+            print(f"{'':18} towards the receiver: {dict(proxy.uplink.stats)}")
+    finally:
+        shutil.rmtree(workdir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--list', action='store_true', help="show the profiles and exit")
+    parser.add_argument('--profile', default='busy-office-wifi', help="comma-separated with --bench")
+    parser.add_argument('--listen', default='127.0.0.2', help="address the proxy listens on")
+    parser.add_argument('--port', type=int, default=32769)
+    parser.add_argument('--target', default='127.0.0.1', help="receiver address")
+    parser.add_argument('--target-port', type=int, default=32769)
+    parser.add_argument('--queue-ms', type=float, default=50, help="bottleneck queue length in time at the capped rate")
+    parser.add_argument('--bench', action='store_true', help="measure SnapSend sends through the proxy")
+    parser.add_argument('--size-mb', type=float, default=32)
+    parser.add_argument('--transport', default='tcp,udp')
+    parser.add_argument('--streams', default='1', help="comma-separated counts of parallel sends")
+    parser.add_argument('--rcvbuf-kb', type=int, default=1024, help="receiver socket buffer")
+    parser.add_argument('--keep-history', action='store_true',
+                        help="let link history from earlier runs size buffers and pick transports")
+    args = parser.parse_args()
+
+    if args.list:
+        for name, phases in PROFILES.items():
+            print(name)
+            for phase in phases:
+                print('   ', ', '.join(f"{key}={value}" for key, value in phase.items()) or 'unimpaired')
+        return
+    if args.bench:
+        bench(args)
+        return
+    proxy = ImpairmentProxy((args.listen, args.port), (args.target, args.target_port),
+                            PROFILES[args.profile], args.queue_ms)
+    print(f"{args.profile}: {args.listen}:{args.port} -> {args.target}:{args.target_port}")
+    try:
+        while True:
+            time.sleep(10)
+            print(f"towards the receiver: {dict(proxy.uplink.stats)}, back: {dict(proxy.downlink.stats)}")
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
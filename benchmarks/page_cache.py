@@ -0,0 +1,144 @@
+"""Measure how much page cache a transfer leaves behind, with and without PageCache.
+
+Sends a file over loopback TCP through FileTransferManager.file_chunks
+into receive_file_data and samples, every --interval seconds, how many
+pages of the source and the received copy are resident (mincore). The
+run is repeated with the cache-friendly mode off, with drop-behind, and
+with drop-behind plus direct reads. Before each run, the source is dropped
+from the cache so every mode starts cold. Reports throughput, the peak and
+final resident size of both files, and how much the system's Cached
+figure grew.
+
+Linux only. Use a file larger than a few WINDOWs for the bound to show,
+and a disk-backed --dir (tmpfs pages cannot be dropped).
+
+    python benchmarks/page_cache.py --size-mb 2000
+    python benchmarks/page_cache.py --size-mb 4000 --dir /var/tmp
+"""
+import argparse
+import ctypes
+import mmap
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from snapsend import DeviceDiscoveryScreen, FileTransferManager, PageCache, TransferProgress  # noqa: E402
+
+MODES = (
+    ('off', 0, False),
+    ('drop-behind', 1, False),
+    ('direct reads', 1, True),
+)
+
+libc = ctypes.CDLL(None, use_errno=True)
+libc.mincore.argtypes = (ctypes.c_void_p, ctypes.c_size_t, ctypes.POINTER(ctypes.c_ubyte))
+
+
+def resident(path):
+    """Bytes of path currently in the page cache"""
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        return 0
+    if not size:
+        return 0
+    with open(path, 'rb') as f:
+        m = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_COPY)  # Writable, so ctypes can take its address
+        pages = (size + mmap.PAGESIZE - 1) // mmap.PAGESIZE
+        vector = (ctypes.c_ubyte * pages)()
+        base = ctypes.c_char.from_buffer(m)
+        try:
+            if libc.mincore(ctypes.addressof(base), size, vector):
+                raise OSError(ctypes.get_errno(), "mincore failed")
+        finally:
+            del base
+            m.close()
+    return sum(page & 1 for page in vector) * mmap.PAGESIZE
+
+
+def cached():
+    with open('/proc/meminfo') as f:
+        for line in f:
+            if line.startswith('Cached:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def run(source, size, destination, interval):
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    done = threading.Event()
+    peak = {'source': 0, 'received': 0}
+
+    def receive():
+        client, _ = server.accept()
+        DeviceDiscoveryScreen.receive_file_data(None, client, destination, size, TransferProgress(size))
+        client.close()
+
+    def sample():
+        while not done.wait(interval):
+            peak['source'] = max(peak['source'], resident(source))
+            peak['received'] = max(peak['received'], resident(destination))
+
+    receiver = threading.Thread(target=receive)
+    sampler = threading.Thread(target=sample)
+    cached_before = cached()
+    receiver.start()
+    sampler.start()
+    started = time.perf_counter()
+    with socket.create_connection(server.getsockname()) as sock:
+        for block in FileTransferManager.file_chunks(source, size):
+            sock.sendall(block)
+        receiver.join()
+    elapsed = time.perf_counter() - started
+    done.set()
+    sampler.join()
+    server.close()
+    final = {'source': resident(source), 'received': resident(destination)}
+    return elapsed, peak, final, cached() - cached_before
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size-mb', type=int, default=1000)
+    parser.add_argument('--dir', help="where to create the files (default: the system temp directory)")
+    parser.add_argument('--interval', type=float, default=0.2, help="seconds between residency samples")
+    args = parser.parse_args()
+
+    if not hasattr(os, 'posix_fadvise'):
+        sys.exit("posix_fadvise is not available here")
+    workdir = tempfile.mkdtemp(prefix='snapsend-bench-', dir=args.dir)
+    try:
+        source = os.path.join(workdir, 'source.bin')
+        size = args.size_mb * 1048576
+        with open(source, 'wb') as f:
+            for _ in range(args.size_mb):
+                f.write(os.urandom(1048576))
+            f.flush()
+            os.fsync(f.fileno())
+        print(f"window {PageCache.WINDOW // 1048576} MB, file {args.size_mb} MB\n"
+              f"{'mode':13} {'MB/s':>8}  {'source peak/final MB':>21}  {'received peak/final MB':>23}  cache growth MB")
+        for name, min_size, direct_io in MODES:
+            PageCache.min_size, PageCache.direct_io = min_size, direct_io
+            destination = os.path.join(workdir, 'received.bin')
+            with open(source, 'rb') as f:
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+            elapsed, peak, final, growth = run(source, size, destination, args.interval)
+            ok = os.path.getsize(destination) == size
+            os.unlink(destination)
+            print(f"{name:13} {size / elapsed / 1048576:8.1f}  "
+                  f"{peak['source'] / 1048576:10.0f} / {final['source'] / 1048576:8.0f}  "
+                  f"{peak['received'] / 1048576:12.0f} / {final['received'] / 1048576:8.0f}  "
+                  f"{growth / 1048576:15.0f}{'' if ok else '  SHORT'}")
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""Compare the receiver's CPU cost with and without the kernel splice path.
+
+Sends a file over loopback TCP to receive_file_data, once with Splice
+disabled (recv into Python, then write) and once with it enabled
+(os.splice through a pipe, Linux only). With --streams, several
+transfers run at once. The sender is a separate process, so its CPU is
+not counted. CPU time is taken from the receiving threads alone.
+
+    python benchmarks/splice_receive.py --size-mb 1000
+    python benchmarks/splice_receive.py --size-mb 500 --streams 4
+"""
+import argparse
+import hashlib
+import multiprocessing
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from snapsend import DeviceDiscoveryScreen, Splice, TransferProgress  # noqa: E402
+
+
+def send(address, source, streams):
+    """Runs in its own process: open streams connections and send source on each"""
+    def send_one():
+        with socket.create_connection(address) as sock, open(source, 'rb') as f:
+            sock.sendfile(f)
+
+    threads = [threading.Thread(target=send_one) for _ in range(streams)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def digest(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1048576), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def run(source, size, workdir, streams):
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(streams)
+    cpu = []
+    lock = threading.Lock()
+
+    def receive(client, index):
+        started = time.thread_time()
+        DeviceDiscoveryScreen.receive_file_data(None, client, os.path.join(workdir, f'received{index}.bin'),
+                                                size, TransferProgress(size))
+        with lock:
+            cpu.append(time.thread_time() - started)
+        client.close()
+
+    sender = multiprocessing.Process(target=send, args=(server.getsockname(), source, streams))
+    started = time.perf_counter()
+    sender.start()
+    receivers = []
+    for index in range(streams):
+        client, _ = server.accept()
+        receivers.append(threading.Thread(target=receive, args=(client, index)))
+        receivers[-1].start()
+    for receiver in receivers:
+        receiver.join()
+    elapsed = time.perf_counter() - started
+    sender.join()
+    server.close()
+    return elapsed, sum(cpu)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size-mb', type=int, default=500)
+    parser.add_argument('--streams', type=int, default=1, help="simultaneous transfers")
+    args = parser.parse_args()
+
+    if not hasattr(os, 'splice'):
+        sys.exit("os.splice is not available here (Linux and Python 3.10 or later)")
+    workdir = tempfile.mkdtemp(prefix='snapsend-bench-')
+    try:
+        source = os.path.join(workdir, 'source.bin')
+        size = args.size_mb * 1048576
+        with open(source, 'wb') as f:
+            for _ in range(args.size_mb):
+                f.write(os.urandom(1048576))
+        expected = digest(source)
+        total = size * args.streams
+        for name, enabled in (('recv + write', False), ('splice', True)):
+            Splice.enabled = enabled
+            elapsed, cpu = run(source, size, workdir, args.streams)
+            ok = all(digest(os.path.join(workdir, f'received{index}.bin')) == expected
+                     for index in range(args.streams))
+            print(f"{name:13} {total / elapsed / 1048576:8.1f} MB/s  {cpu / total * 1073741824:6.2f} CPU s/GB  "
+                  f"{'verified' if ok else 'CORRUPT'}")
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+"""Measure what SnapSend's encrypted mode costs against a plaintext send.
+
+Streams a file over loopback TCP the way send_file does (1 MiB blocks
+into sendall, recv_exact into the file on the other side), once in
+plaintext and then over TLS with each cipher SnapSend offers. Reports
+throughput and the CPU time both ends spent per GB moved. The TLS
+identity is created in a temporary directory, as on a first start.
+
+    python benchmarks/tls_overhead.py --size-mb 500
+    python benchmarks/tls_overhead.py --size-mb 500 --repeat 3
+"""
+import argparse
+import hashlib
+import os
+import shutil
+import socket
+import ssl
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from snapsend import DeviceDiscoveryScreen, FileTransferManager, SecureTransport, TransferProgress  # noqa: E402
+
+
+def tls12_context(cipher):
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    context.maximum_version = ssl.TLSVersion.TLSv1_2
+    context.set_ciphers(cipher)
+    return context
+
+
+VARIANTS = (
+    ('plaintext', None),
+    ('tls1.3 default', lambda: SecureTransport.client_context),
+    ('tls1.2 aes128-gcm', lambda: tls12_context('ECDHE-ECDSA-AES128-GCM-SHA256')),
+    ('tls1.2 aes256-gcm', lambda: tls12_context('ECDHE-ECDSA-AES256-GCM-SHA384')),
+    ('tls1.2 chacha20', lambda: tls12_context('ECDHE-ECDSA-CHACHA20-POLY1305')),
+)
+
+
+def digest(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1048576), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def run(source, size, destination, context):
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    cipher = []
+
+    def receive():
+        client, _ = server.accept()
+        client = SecureTransport.accept(client, 30)
+        DeviceDiscoveryScreen.receive_file_data(None, client, destination, size, TransferProgress(size))
+        client.close()
+
+    receiver = threading.Thread(target=receive)
+    receiver.start()
+    wall, cpu = time.perf_counter(), time.process_time()
+    sock = socket.create_connection(server.getsockname())
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    if context:
+        sock = context.wrap_socket(sock)
+        cipher = sock.cipher()
+    for block in FileTransferManager.file_chunks(source, size):
+        sock.sendall(block)
+    receiver.join()
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    sock.close()
+    server.close()
+    return wall, cpu, cipher
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size-mb', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=1, help="runs per variant; the fastest is reported")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='snapsend-bench-')
+    try:
+        SecureTransport.configure(os.path.join(workdir, 'tls'))
+        if SecureTransport.client_context is None:
+            sys.exit("Could not create a TLS identity (install cryptography or the openssl CLI)")
+        print(f"kTLS: {'requested' if getattr(ssl, 'OP_ENABLE_KTLS', 0) else 'not exposed by this Python'}, "
+              f"{ssl.OPENSSL_VERSION}")
+        source = os.path.join(workdir, 'source.bin')
+        size = args.size_mb * 1048576
+        with open(source, 'wb') as f:
+            for _ in range(args.size_mb):
+                f.write(os.urandom(1048576))
+        expected = digest(source)
+        run(source, size, os.path.join(workdir, 'warmup.bin'), None)  # The first pass pays for the page cache
+
+        baseline = None
+        for name, make_context in VARIANTS:
+            destination = os.path.join(workdir, 'received.bin')
+            try:
+                wall, cpu, cipher = min((run(source, size, destination, make_context and make_context())
+                                         for _ in range(args.repeat)), key=lambda result: result[0])
+            except ssl.SSLError as e:
+                print(f"{name:18}  unavailable: {e}")
+                continue
+            ok = digest(destination) == expected
+            os.unlink(destination)
+            rate = size / wall / 1048576
+            baseline = baseline or rate
+            print(f"{name:18} {rate:8.1f} MB/s  {rate / baseline:6.1%}  {cpu / size * 1073741824:6.2f} CPU s/GB  "
+                  f"{cipher[0] if cipher else '':30} {'verified' if ok else 'CORRUPT'}")
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
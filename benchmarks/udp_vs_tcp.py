@@ -0,0 +1,206 @@
+"""Compare SnapSend's UDP transport with plain TCP on an impaired loopback link.
+
+By default a userspace relay drops and delays UDP datagrams, which exercises
+the NACK/FEC paths. A userspace relay cannot drop TCP segments, so in that
+mode TCP only sees the added delay. For an apples-to-apples comparison run
+as root on Linux with --netem, which applies the same loss and delay to the
+loopback interface with tc for both protocols.
+
+    python benchmarks/udp_vs_tcp.py --size-mb 200 --loss 2 --delay-ms 10
+    python benchmarks/udp_vs_tcp.py --size-mb 200 --loss 2 --delay-ms 10 --fec
+    sudo python benchmarks/udp_vs_tcp.py --size-mb 200 --loss 2 --delay-ms 10 --netem
+"""
+import argparse
+import hashlib
+import heapq
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from snapsend import DeviceDiscoveryScreen, TransferProgress, UdpTransport  # noqa: E402
+
+
+class LossyUdpRelay:
+    """Forwards datagrams between a sender and target_address with loss and delay"""
+
+    def __init__(self, target_address, loss, delay, jitter):
+        self.target_address = target_address
+        self.loss = loss
+        self.delay = delay
+        self.jitter = jitter
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 8 * 1048576)
+        self.sock.bind(('127.0.0.1', 0))
+        self.address = self.sock.getsockname()
+        self.client = None
+        self.pending = []
+        self.lock = threading.Condition()
+        self.dropped = 0
+        self.forwarded = 0
+        threading.Thread(target=self._receive, daemon=True).start()
+        threading.Thread(target=self._deliver, daemon=True).start()
+
+    def _receive(self):
+        while True:
+            data, address = self.sock.recvfrom(65535)
+            if address != self.target_address:
+                self.client = address
+                destination = self.target_address
+            else:
+                destination = self.client
+            if random.random() < self.loss:
+                self.dropped += 1
+                continue
+            due = time.monotonic() + self.delay + random.uniform(0, self.jitter)
+            with self.lock:
+                heapq.heappush(self.pending, (due, self.forwarded, data, destination))
+                self.forwarded += 1
+                self.lock.notify()
+
+    def _deliver(self):
+        while True:
+            with self.lock:
+                while not self.pending:
+                    self.lock.wait()
+                due, _, data, destination = self.pending[0]
+                wait = due - time.monotonic()
+                if wait > 0:
+                    self.lock.wait(wait)
+                    continue
+                heapq.heappop(self.pending)
+            self.sock.sendto(data, destination)
+
+
+class DelayTcpRelay:
+    """Forwards a TCP connection to target_address, delaying each read by delay"""
+
+    def __init__(self, target_address, delay):
+        self.target_address = target_address
+        self.delay = delay
+        self.server = socket.socket()
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(1)
+        self.address = self.server.getsockname()
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        client, _ = self.server.accept()
+        upstream = socket.create_connection(self.target_address)
+        threading.Thread(target=self._pipe, args=(client, upstream), daemon=True).start()
+        threading.Thread(target=self._pipe, args=(upstream, client), daemon=True).start()
+
+    def _pipe(self, source, destination):
+        while True:
+            data = source.recv(65536)
+            if not data:
+                destination.shutdown(socket.SHUT_WR)
+                return
+            if self.delay:
+                time.sleep(self.delay)
+            destination.sendall(data)
+
+
+def netem(enable, loss, delay_ms):
+    if enable:
+        subprocess.run(['tc', 'qdisc', 'add', 'dev', 'lo', 'root', 'netem',
+                        'loss', f'{loss * 100}%', 'delay', f'{delay_ms}ms'], check=True)
+    else:
+        subprocess.run(['tc', 'qdisc', 'del', 'dev', 'lo', 'root'], check=False)
+
+
+def digest(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1048576), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def run_udp(source, size, destination, args):
+    control_sender, control_receiver = socket.socketpair()
+    udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    udp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 8 * 1048576)
+    udp_sock.bind(('127.0.0.1', 0))
+    if args.netem:
+        target = udp_sock.getsockname()
+    else:
+        relay = LossyUdpRelay(udp_sock.getsockname(), args.loss, args.delay_ms / 1000, args.jitter_ms / 1000)
+        target = relay.address
+
+    receiver = threading.Thread(target=UdpTransport.receive, args=(
+        control_receiver, udp_sock, destination, size, TransferProgress(size), None, args.fec))
+    receiver.start()
+    start = time.time()
+    UdpTransport.send(control_sender, target, source, size, TransferProgress(size),
+                      fec=args.fec, rtt=2 * args.delay_ms / 1000)
+    receiver.join()
+    return time.time() - start
+
+
+def run_tcp(source, size, destination, args):
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    target = server.getsockname() if args.netem else DelayTcpRelay(server.getsockname(), args.delay_ms / 1000).address
+
+    def receive():
+        client, _ = server.accept()
+        DeviceDiscoveryScreen.receive_file_data(None, client, destination, size, TransferProgress(size))
+        client.close()
+
+    receiver = threading.Thread(target=receive)
+    receiver.start()
+    start = time.time()
+    sock = socket.create_connection(target)
+    with open(source, 'rb') as f:
+        for block in iter(lambda: f.read(1048576), b''):
+            sock.sendall(block)
+    receiver.join()
+    sock.close()
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size-mb', type=int, default=100)
+    parser.add_argument('--loss', type=float, default=1.0, help="packet loss in percent")
+    parser.add_argument('--delay-ms', type=float, default=5.0, help="one-way delay")
+    parser.add_argument('--jitter-ms', type=float, default=0.0)
+    parser.add_argument('--fec', action='store_true', help="enable XOR forward error correction")
+    parser.add_argument('--netem', action='store_true', help="impair lo with tc netem instead of the relay")
+    args = parser.parse_args()
+    args.loss /= 100
+
+    workdir = tempfile.mkdtemp(prefix='snapsend-bench-')
+    source = os.path.join(workdir, 'source.bin')
+    size = args.size_mb * 1048576
+    with open(source, 'wb') as f:
+        for _ in range(args.size_mb):
+            f.write(os.urandom(1048576))
+    expected = digest(source)
+
+    if args.netem:
+        netem(True, args.loss, args.delay_ms)
+    try:
+        for name, run in (('tcp', run_tcp), ('udp', run_udp)):
+            destination = os.path.join(workdir, f'{name}.bin')
+            elapsed = run(source, size, destination, args)
+            ok = digest(destination) == expected
+            print(f"{name}: {size / elapsed / 1048576:8.1f} MB/s in {elapsed:6.2f}s  "
+                  f"{'verified' if ok else 'CORRUPT'}")
+    finally:
+        if args.netem:
+            netem(False, args.loss, args.delay_ms)
+        for name in os.listdir(workdir):
+            os.unlink(os.path.join(workdir, name))
+        os.rmdir(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -9,9 +9,11 @@ from kivy.uix.widget import Widget
 from kivy.uix.gridlayout import GridLayout
 from kivy.uix.progressbar import ProgressBar
 from kivy.uix.popup import Popup
+from kivy.uix.togglebutton import ToggleButton
 from kivy.clock import Clock
 from kivy.properties import ListProperty, StringProperty, ObjectProperty, NumericProperty
 from kivy.core.window import Window
+from kivy.core.clipboard import Clipboard
 from kivy.graphics import Line, Color, Rectangle, Ellipse
 from kivy.uix.relativelayout import RelativeLayout
 import socket
@@ -20,11 +22,30 @@ import time
 import tkinter as tk
 from tkinter import filedialog
 import os
-import zipfile
-import tempfile
 import sys
-from collections import deque
+import shutil
+import struct
+import queue
+import select
+import json
+import hashlib
+import base64
+import uuid
+import random
+import ssl
+import subprocess
+import webbrowser
+from collections import deque, Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 import platform
+import stat
+import zlib
+import sqlite3
+import contextlib
+import errno
+import mmap
+import cProfile
 from kivy.lang import Builder
 
 
@@ -110,117 +131,4304 @@ class DeviceCard(BoxLayout):
             upload_screen.set_device_info(self.name, self.ip)
         return super().on_touch_down(touch)
 
+class TransferProgress:
+    """Throttled progress and speed reporting shared by the send and receive loops"""
+
+    def __init__(self, total_size, callback=None, metrics=None, interval=0.1):
+        self.total_size = total_size
+        self.callback = callback
+        self.metrics = metrics
+        self.interval = interval
+        self.done = 0
+        self.start_time = time.time()
+        self.last_update = self.start_time
+        self.chunk_start_time = self.start_time
+        self.speed_history = deque(maxlen=10)  # Keep last 10 measurements for smoothing
+
+    def advance(self, nbytes):
+        self.done += nbytes
+        if self.metrics:
+            self.metrics.add_bytes(nbytes)
+        current_time = time.time()
+
+        # Calculate instantaneous speed
+        chunk_time = current_time - self.chunk_start_time
+        if chunk_time > 0:
+            self.speed_history.append(nbytes / chunk_time / (1024 * 1024))  # MB/s
+        self.chunk_start_time = current_time
+
+        if self.callback and current_time - self.last_update >= self.interval:
+            progress = (self.done / self.total_size) * 100 if self.total_size else 0
+            if self.speed_history:
+                avg_speed = sum(self.speed_history) / len(self.speed_history)
+                speed_text = f"{avg_speed:.1f} MB/s"
+            else:
+                avg_speed = 0
+                speed_text = "0 MB/s"
+            Clock.schedule_once(
+                lambda dt, p=progress, s=speed_text, sp=avg_speed:
+                self._notify(p, s, sp)
+            )
+            self.last_update = current_time
+
+    def phase(self, name):
+        return self.metrics.phase(name) if self.metrics else NO_PHASE
+
+    def _notify(self, progress, speed_text, speed_value):
+        with self.phase('ui'):
+            self.callback(progress, speed_text, speed_value)
+
+    def finish(self):
+        elapsed_time = time.time() - self.start_time
+        if elapsed_time > 0:
+            final_speed = self.total_size / elapsed_time / (1024 * 1024)
+            speed_text = f"{final_speed:.1f} MB/s"
+        else:
+            final_speed = 0
+            speed_text = "0 MB/s"
+        if self.callback:
+            Clock.schedule_once(lambda dt: self._notify(100, speed_text, final_speed))
+        return final_speed
+
+
+class Metrics:
+    """Process-wide counters, gauges and histograms for transfers and discovery.
+
+    Values are always collected; configure() decides whether they are
+    served in Prometheus text format over HTTP and whether each finished
+    transfer is also appended to a JSON-lines log.
+    """
+    LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+    PROCESSING_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.1)
+    DURATION_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600)
+    THROUGHPUT_BUCKETS = tuple(mb * 1048576 for mb in (1, 5, 10, 25, 50, 100, 250, 500, 1000))
+
+    HELP = {
+        'snapsend_transfers_total': ('counter', "Finished transfers by direction, transport and result"),
+        'snapsend_transfer_bytes_total': ('counter', "Payload bytes moved by direction and transport"),
+        'snapsend_transfer_retries_total': ('counter', "Retransmitted packets, pieces and transport fallbacks"),
+        'snapsend_transfer_errors_total': ('counter', "Failed transfers by direction"),
+        'snapsend_active_transfers': ('gauge', "Transfers in progress by direction"),
+        'snapsend_transfer_duration_seconds': ('histogram', "Wall time of finished transfers"),
+        'snapsend_transfer_throughput_bytes': ('histogram', "Average throughput of finished transfers in bytes/s"),
+        'snapsend_transfer_ttfb_seconds': ('histogram', "Time from the start of a transfer to its first payload byte"),
+        'snapsend_handshake_seconds': ('histogram', "Connect plus header exchange latency"),
+        'snapsend_beacons_sent_total': ('counter', "Discovery beacons broadcast"),
+        'snapsend_beacon_errors_total': ('counter', "Discovery beacons that failed to send"),
+        'snapsend_beacons_received_total': ('counter', "Discovery beacons received"),
+        'snapsend_peers': ('gauge', "Devices currently listed"),
+        'snapsend_peer_expirations_total': ('counter', "Devices dropped after missing beacons"),
+        'snapsend_beacon_processing_seconds': ('histogram', "Time from receiving a beacon to recording its device"),
+        'snapsend_device_card_lag_seconds': ('histogram', "Delay before a newly discovered device's card is shown"),
+        'snapsend_device_sweep_seconds': ('histogram', "Time spent expiring silent devices on each sweep"),
+        'snapsend_snippets_sent_total': ('counter', "Text snippets delivered by transport"),
+        'snapsend_snippets_received_total': ('counter', "Text snippets received, duplicates excluded"),
+        'snapsend_snippet_latency_seconds': ('histogram', "Time from sending a snippet to its acknowledgement"),
+    }
+
+    lock = threading.Lock()
+    values = {}      # (name, labels) -> counter or gauge value
+    histograms = {}  # (name, labels) -> [bucket bounds, bucket counts, sum, count]
+    server = None
+    log_path = None
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    @staticmethod
+    def inc(name, value=1, **labels):
+        key = Metrics._key(name, labels)
+        with Metrics.lock:
+            Metrics.values[key] = Metrics.values.get(key, 0) + value
+
+    @staticmethod
+    def set(name, value, **labels):
+        with Metrics.lock:
+            Metrics.values[Metrics._key(name, labels)] = value
+
+    @staticmethod
+    def observe(name, value, buckets, **labels):
+        key = Metrics._key(name, labels)
+        with Metrics.lock:
+            histogram = Metrics.histograms.setdefault(key, [buckets, [0] * len(buckets), 0.0, 0])
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram[1][i] += 1
+            histogram[2] += value
+            histogram[3] += 1
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ''
+        escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+        return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+    @staticmethod
+    def render():
+        """Everything collected so far in the Prometheus text exposition format"""
+        with Metrics.lock:
+            values = dict(Metrics.values)
+            histograms = {key: [h[0], list(h[1]), h[2], h[3]] for key, h in Metrics.histograms.items()}
+        lines = []
+        for name, (kind, text) in Metrics.HELP.items():
+            lines.append(f"# HELP {name} {text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == 'histogram':
+                for (metric, labels), (buckets, counts, total, count) in sorted(histograms.items()):
+                    if metric != name:
+                        continue
+                    for bound, bucket_count in zip(buckets, counts):
+                        lines.append(f"{name}_bucket{Metrics._labels(labels, [('le', bound)])} {bucket_count}")
+                    lines.append(f"{name}_bucket{Metrics._labels(labels, [('le', '+Inf')])} {count}")
+                    lines.append(f"{name}_sum{Metrics._labels(labels)} {total}")
+                    lines.append(f"{name}_count{Metrics._labels(labels)} {count}")
+            else:
+                for (metric, labels), value in sorted(values.items()):
+                    if metric == name:
+                        lines.append(f"{name}{Metrics._labels(labels)} {value}")
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def log(record):
+        path = Metrics.log_path
+        if not path:
+            return
+        line = json.dumps(record) + '\n'
+        try:
+            with Metrics.lock:
+                with open(path, 'a', encoding='utf-8') as f:
+                    f.write(line)
+        except OSError as e:
+            print("Metrics log error:", e)
+
+    @staticmethod
+    def configure(enabled, port, bind='127.0.0.1', log_path=None):
+        """Start, move or stop the HTTP endpoint and set the JSON-lines log path"""
+        Metrics.log_path = log_path
+        server = Metrics.server
+        if server and (not enabled or server.server_address[1] != port):
+            Metrics.server = None
+            threading.Thread(target=server.shutdown, daemon=True).start()
+            server = None
+        if enabled and not server:
+            try:
+                Metrics.server = ThreadingHTTPServer((bind, port), MetricsRequestHandler)
+                Metrics.server.daemon_threads = True
+                threading.Thread(target=Metrics.server.serve_forever, daemon=True).start()
+                print(f"Metrics available at http://{bind}:{port}/metrics")
+            except OSError as e:
+                print("Metrics server error:", e)
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = Metrics.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Scrapes every few seconds would flood the console
+
+
+NO_PHASE = contextlib.nullcontext()
+
+
+class TransferProfile:
+    """Opt-in per-phase timing for one transfer, written out as a Chrome trace.
+
+    Enabled by SNAPSEND_PROFILE=1 or the profiling setting. Each phase
+    (connect, handshake, read, send, recv, write, throttle, ui, ...)
+    records wall and thread CPU time. With SNAPSEND_PROFILE=cprofile or
+    the cProfile setting the transfer thread also runs under cProfile. A
+    .trace.json (load it in chrome://tracing or Perfetto) and, with
+    cProfile, a .prof file are written per transfer.
+    """
+    ENV = os.environ.get('SNAPSEND_PROFILE', '').lower()
+    MAX_EVENTS = 100000
+    enabled = ENV not in ('', '0')
+    use_cprofile = ENV == 'cprofile'
+    output_dir = os.environ.get('SNAPSEND_PROFILE_DIR') or os.path.abspath('profiles')
+
+    @staticmethod
+    def configure(enabled, use_cprofile, output_dir):
+        TransferProfile.enabled = enabled or TransferProfile.ENV not in ('', '0')
+        TransferProfile.use_cprofile = use_cprofile or TransferProfile.ENV == 'cprofile'
+        TransferProfile.output_dir = os.environ.get('SNAPSEND_PROFILE_DIR') or output_dir
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.totals = {}  # phase -> [wall seconds, cpu seconds, count]
+        self.events = []
+        self.lock = threading.Lock()
+        self.profiler = None
+        self.profiler_thread = None
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        wall_start = time.perf_counter()
+        cpu_start = time.thread_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall_start
+            cpu = time.thread_time() - cpu_start
+            with self.lock:
+                totals = self.totals.setdefault(name, [0.0, 0.0, 0])
+                totals[0] += wall
+                totals[1] += cpu
+                totals[2] += 1
+                if len(self.events) < self.MAX_EVENTS:
+                    self.events.append({
+                        'name': name, 'ph': 'X', 'pid': os.getpid(), 'tid': threading.get_ident(),
+                        'ts': wall_start * 1e6, 'dur': wall * 1e6, 'args': {'cpu_us': round(cpu * 1e6)},
+                    })
+
+    def start_profiler(self):
+        """Run the calling thread under cProfile until finish()"""
+        if not self.use_cprofile or self.profiler:
+            return
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError as e:  # Another profiler already owns the interpreter
+            print("Profiler unavailable:", e)
+            return
+        self.profiler = profiler
+        self.profiler_thread = threading.get_ident()
+
+    def finish(self, duration):
+        if self.profiler and self.profiler_thread == threading.get_ident():
+            self.profiler.disable()
+        metrics = self.metrics
+        summary = ', '.join(f"{name} {wall * 1000:.1f} ms (cpu {cpu * 1000:.1f} ms, {count}x)"
+                            for name, (wall, cpu, count) in sorted(self.totals.items(), key=lambda item: -item[1][0]))
+        print(f"Profile {metrics.direction} {metrics.name or '?'} {metrics.peer}: "
+              f"{duration * 1000:.1f} ms total; {summary or 'no phases'}")
+
+        safe_name = ''.join(c if c.isalnum() or c in '._-' else '_' for c in metrics.name or 'transfer')
+        base = os.path.join(self.output_dir,
+                            f"{time.strftime('%Y%m%d-%H%M%S')}-{metrics.direction}-{safe_name}-{id(self):x}")
+        started = time.perf_counter() - duration
+        with self.lock:
+            events = list(self.events)
+            totals = {name: {'wall': wall, 'cpu': cpu, 'count': count}
+                      for name, (wall, cpu, count) in self.totals.items()}
+        events.append({'name': f"{metrics.direction} {metrics.name}", 'ph': 'X', 'pid': os.getpid(),
+                       'tid': threading.get_ident(), 'ts': started * 1e6, 'dur': duration * 1e6,
+                       'args': {'peer': metrics.peer, 'bytes': metrics.bytes, 'transport': metrics.transport}})
+        try:
+            os.makedirs(self.output_dir, exist_ok=True)
+            with open(base + '.trace.json', 'w', encoding='utf-8') as f:
+                json.dump({'traceEvents': events, 'displayTimeUnit': 'ms', 'otherData': {'phases': totals}}, f)
+            if self.profiler:
+                self.profiler.dump_stats(base + '.prof')
+        except OSError as e:
+            print("Profile dump error:", e)
+
+
+class TransferMetrics:
+    """Timings for one transfer, reported to Metrics when it finishes.
+
+    Attached to a TransferProgress, which feeds it every payload byte, so
+    the time to first byte needs no extra hooks in the send/receive loops.
+    """
+
+    def __init__(self, direction, peer, name='', kind='file', transport='tcp'):
+        self.direction = direction
+        self.peer = peer
+        self.name = name
+        self.kind = kind
+        self.transport = transport
+        self.started = time.time()
+        self.handshake = None
+        self.first_byte = None
+        self.bytes = 0
+        self.retries = 0
+        self.rtt = None
+        self.loss = None  # Fraction of sent bytes the kernel had to retransmit
+        self.finished = False
+        self.profile = TransferProfile(self) if TransferProfile.enabled else None
+        Metrics.inc('snapsend_active_transfers', direction=direction)
+
+    def phase(self, name):
+        """Context manager timing one phase; free when profiling is off"""
+        return self.profile.phase(name) if self.profile else NO_PHASE
+
+    def start_profiler(self):
+        if self.profile:
+            self.profile.start_profiler()
+
+    def handshake_done(self):
+        self.handshake = time.time() - self.started
+
+    def add_bytes(self, nbytes):
+        if self.first_byte is None:
+            self.first_byte = time.time() - self.started
+        self.bytes += nbytes
+
+    def retry(self, count=1):
+        self.retries += count
+
+    def finish(self, error=None):
+        if self.finished:
+            return
+        self.finished = True
+        duration = time.time() - self.started
+        throughput = self.bytes / duration if duration > 0 else 0
+        direction, transport = self.direction, self.transport
+        Metrics.inc('snapsend_active_transfers', -1, direction=direction)
+        Metrics.inc('snapsend_transfers_total', direction=direction, transport=transport,
+                    result='error' if error else 'ok')
+        Metrics.inc('snapsend_transfer_bytes_total', self.bytes, direction=direction, transport=transport)
+        if self.retries:
+            Metrics.inc('snapsend_transfer_retries_total', self.retries, direction=direction, transport=transport)
+        if error:
+            Metrics.inc('snapsend_transfer_errors_total', direction=direction)
+        else:
+            Metrics.observe('snapsend_transfer_duration_seconds', duration, Metrics.DURATION_BUCKETS,
+                            direction=direction)
+            Metrics.observe('snapsend_transfer_throughput_bytes', throughput, Metrics.THROUGHPUT_BUCKETS,
+                            direction=direction)
+        if self.first_byte is not None:
+            Metrics.observe('snapsend_transfer_ttfb_seconds', self.first_byte, Metrics.LATENCY_BUCKETS,
+                            direction=direction)
+        if self.handshake is not None:
+            Metrics.observe('snapsend_handshake_seconds', self.handshake, Metrics.LATENCY_BUCKETS,
+                            direction=direction)
+        Metrics.log({
+            'time': self.started,
+            'direction': direction,
+            'peer': self.peer,
+            'name': self.name,
+            'kind': self.kind,
+            'transport': transport,
+            'bytes': self.bytes,
+            'duration': round(duration, 6),
+            'throughput': round(throughput),
+            'ttfb': None if self.first_byte is None else round(self.first_byte, 6),
+            'handshake': None if self.handshake is None else round(self.handshake, 6),
+            'retries': self.retries,
+            'error': str(error) if error else None,
+        })
+        if self.profile:
+            self.profile.finish(duration)
+        if direction == 'send':
+            LinkProfiles.record(self, error)
+
+    def sample_link(self, sock, final=False):
+        """Take RTT, and at the end the retransmission rate, from sock's TCP_INFO"""
+        info = LinkProfiles.tcp_info(sock)
+        if not info:
+            return
+        rtt, retransmits, mss = info
+        if rtt:
+            self.rtt = rtt
+        if final and self.bytes:
+            self.loss = min(1.0, retransmits * mss / self.bytes)
+
+
+class LinkProfiles:
+    """What each device's link achieved before, kept in links.json to seed the next send.
+
+    Profiles are keyed by device ID (the IP for older builds) and updated
+    from every finished send: throughput per transport and RTT as moving
+    averages, TCP retransmission rate, failures, and how UDP and multipath
+    fared. New transfers use them to size socket buffers to the measured
+    bandwidth-delay product, start UDP pacing near the last delivery rate,
+    skip a UDP offer that keeps falling back and skip multipath where a
+    single stream was faster.
+    """
+    ALPHA = 0.3  # Weight of the newest sample
+    MIN_SAMPLE_BYTES = 4 * 1048576  # Shorter sends say little about throughput
+    UDP_FAILURE_LIMIT = 2  # Consecutive fallbacks before UDP is no longer offered
+    REPROBE_AGE = 86400  # Retry a transport that lost out once its verdict is a day old
+    MIN_BUFFER = 1048576
+    MAX_BUFFER = 16 * 1048576
+    MAX_PEERS = 256
+
+    lock = threading.Lock()
+    profiles = {}
+    path = None
+
+    @staticmethod
+    def configure(path):
+        with LinkProfiles.lock:
+            if path == LinkProfiles.path:
+                return
+            LinkProfiles.path = path
+            LinkProfiles.profiles = {}
+            if not path:
+                return
+            try:
+                with open(path) as f:
+                    LinkProfiles.profiles = json.load(f)
+            except FileNotFoundError:
+                pass
+            except (OSError, ValueError) as e:
+                print(f"Could not load link profiles from {path}: {e}")
+
+    @staticmethod
+    def _save():
+        if not LinkProfiles.path:
+            return
+        if len(LinkProfiles.profiles) > LinkProfiles.MAX_PEERS:
+            stale = sorted(LinkProfiles.profiles, key=lambda key: LinkProfiles.profiles[key].get('updated', 0))
+            for key in stale[:len(LinkProfiles.profiles) - LinkProfiles.MAX_PEERS]:
+                del LinkProfiles.profiles[key]
+        temp_path = LinkProfiles.path + '.tmp'
+        try:
+            with open(temp_path, 'w') as f:
+                json.dump(LinkProfiles.profiles, f, indent=1)
+            os.replace(temp_path, LinkProfiles.path)
+        except OSError as e:
+            print(f"Could not save link profiles: {e}")
+
+    @staticmethod
+    def _key(ip):
+        return PeerDirectory.device_for(ip) or ip
+
+    @staticmethod
+    def get(ip):
+        with LinkProfiles.lock:
+            return dict(LinkProfiles.profiles.get(LinkProfiles._key(ip), {}))
+
+    @staticmethod
+    def all():
+        with LinkProfiles.lock:
+            return [dict(profile) for profile in LinkProfiles.profiles.values()]
+
+    @staticmethod
+    def clear():
+        with LinkProfiles.lock:
+            LinkProfiles.profiles = {}
+            LinkProfiles._save()
+
+    @staticmethod
+    def _average(old, sample):
+        return sample if old is None else old + LinkProfiles.ALPHA * (sample - old)
+
+    @staticmethod
+    def _update(ip, change):
+        with LinkProfiles.lock:
+            key = LinkProfiles._key(ip)
+            profile = LinkProfiles.profiles.setdefault(key, {'throughput': {}, 'transfers': 0, 'failures': 0})
+            profile['address'] = ip
+            profile['name'] = PeerDirectory.name_for(ip) or profile.get('name') or ip
+            profile['updated'] = time.time()
+            change(profile)
+            LinkProfiles._save()
+
+    @staticmethod
+    def record(metrics, error=None):
+        """Fold a finished send into its peer's profile"""
+        duration = time.time() - metrics.started
+
+        def change(profile):
+            profile['transfers'] += 1
+            if error:
+                profile['failures'] += 1
+                return
+            if metrics.rtt:
+                profile['rtt'] = LinkProfiles._average(profile.get('rtt'), metrics.rtt)
+            if metrics.loss is not None:
+                profile['loss'] = LinkProfiles._average(profile.get('loss'), metrics.loss)
+            if metrics.bytes >= LinkProfiles.MIN_SAMPLE_BYTES and duration > 0:
+                throughput = profile['throughput']
+                transport = metrics.transport
+                throughput[transport] = LinkProfiles._average(throughput.get(transport), metrics.bytes / duration)
+                if transport == 'multipath':
+                    profile['multipath_checked'] = time.time()
+
+        LinkProfiles._update(metrics.peer, change)
+
+    @staticmethod
+    def udp_result(ip, delivered):
+        def change(profile):
+            profile['udp_failures'] = 0 if delivered else profile.get('udp_failures', 0) + 1
+            if not delivered:
+                profile['udp_checked'] = time.time()
+        LinkProfiles._update(ip, change)
+
+    @staticmethod
+    def prefer_udp(ip):
+        profile = LinkProfiles.get(ip)
+        return (profile.get('udp_failures', 0) < LinkProfiles.UDP_FAILURE_LIMIT
+                or time.time() - profile.get('udp_checked', 0) > LinkProfiles.REPROBE_AGE)
+
+    @staticmethod
+    def best_streams(profile):
+        """2 when striping beat a single stream, 1 when it didn't, None until both were tried"""
+        multipath, single = profile.get('throughput', {}).get('multipath'), profile.get('throughput', {}).get('tcp')
+        if multipath is None or single is None:
+            return None
+        return 2 if multipath > single else 1
+
+    @staticmethod
+    def prefer_multipath(ip):
+        profile = LinkProfiles.get(ip)
+        return (LinkProfiles.best_streams(profile) != 1
+                or time.time() - profile.get('multipath_checked', 0) > LinkProfiles.REPROBE_AGE)
+
+    @staticmethod
+    def buffer_size(ip):
+        """Socket buffer for ip: twice the bandwidth-delay product seen before, within bounds"""
+        profile = LinkProfiles.get(ip)
+        throughput = max(profile.get('throughput', {}).values(), default=0)
+        bdp = 2 * throughput * profile.get('rtt', 0)
+        return int(min(max(LinkProfiles.MIN_BUFFER, bdp), LinkProfiles.MAX_BUFFER))
+
+    @staticmethod
+    def udp_start_rate(ip):
+        rate = LinkProfiles.get(ip).get('throughput', {}).get('udp')
+        return max(UdpTransport.MIN_RATE, rate * 0.8) if rate else UdpTransport.INITIAL_RATE
+
+    @staticmethod
+    def rtt(ip):
+        return LinkProfiles.get(ip).get('rtt')
+
+    @staticmethod
+    def tcp_info(sock):
+        """(rtt seconds, total retransmitted segments, send MSS) from the kernel, or None where unsupported"""
+        if not hasattr(socket, 'TCP_INFO'):
+            return None
+        try:
+            info = sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, 104)
+        except OSError:
+            return None
+        if len(info) < 104:
+            return None
+        # Offsets into Linux's struct tcp_info
+        mss = struct.unpack_from('I', info, 16)[0]
+        rtt = struct.unpack_from('I', info, 68)[0] / 1e6
+        retransmits = struct.unpack_from('I', info, 100)[0]
+        return rtt, retransmits, mss
+
+
+def recv_exact(sock, size):
+    """Read exactly size bytes from sock, or fewer if the peer closes early"""
+    buf = bytearray(size)
+    view = memoryview(buf)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:], size - received)
+        if not n:
+            break
+        received += n
+    return bytes(view[:received])
+
+
+class TokenBucket:
+    """Token bucket rate limiter; a rate of 0 means unlimited.
+
+    consume() may put the bucket into debt and then waits it off in short
+    slices, so a changed rate takes effect within a few milliseconds even
+    in the middle of a long wait.
+    """
+    WAIT_SLICE = 0.01
+
+    def __init__(self, rate=0):
+        self._lock = threading.Lock()
+        self.rate = 0
+        self.capacity = 0
+        self.tokens = 0
+        self.timestamp = time.monotonic()
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        with self._lock:
+            self._refill()
+            self.rate = max(0, rate)
+            # Allow bursts of ~50 ms of traffic, but never less than one slice
+            self.capacity = max(self.rate * 0.05, BandwidthLimiter.SLICE)
+            self.tokens = min(self.tokens, self.capacity)
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate:
+            self.tokens = min(self.capacity, self.tokens + (now - self.timestamp) * self.rate)
+        self.timestamp = now
+
+    def consume(self, nbytes):
+        with self._lock:
+            if not self.rate:
+                return
+            self._refill()
+            self.tokens -= nbytes
+        while True:
+            with self._lock:
+                if not self.rate:
+                    self.tokens = 0
+                    return
+                self._refill()
+                if self.tokens >= 0:
+                    return
+                wait = -self.tokens / self.rate
+            time.sleep(min(wait, self.WAIT_SLICE))
+
+
+class BandwidthLimiter:
+    """Global and per-peer token buckets shared by every send and receive loop"""
+    SLICE = 65536
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.global_bucket = TokenBucket()
+        self.peer_rate = 0
+        self.peer_buckets = {}
+
+    def configure(self, global_rate, peer_rate):
+        """Update limits in bytes/s (0 = unlimited); running transfers pick them up immediately"""
+        self.global_bucket.set_rate(global_rate)
+        with self._lock:
+            self.peer_rate = peer_rate
+            for bucket in self.peer_buckets.values():
+                bucket.set_rate(peer_rate)
+
+    @property
+    def enabled(self):
+        return bool(self.global_bucket.rate or self.peer_rate)
+
+    def _peer_bucket(self, peer):
+        with self._lock:
+            bucket = self.peer_buckets.get(peer)
+            if bucket is None:
+                bucket = self.peer_buckets[peer] = TokenBucket(self.peer_rate)
+            return bucket
+
+    def throttle(self, peer, nbytes):
+        if not self.enabled:
+            return
+        self._peer_bucket(peer).consume(nbytes)
+        self.global_bucket.consume(nbytes)
+
+    def chunk_size(self, default):
+        """Socket read/write size to use; small slices keep limited traffic smooth"""
+        return self.SLICE if self.enabled else default
+
+    def send(self, sock, peer, data):
+        if not self.enabled:
+            sock.sendall(data)
+            return
+        view = memoryview(data)
+        for offset in range(0, len(view), self.SLICE):
+            piece = view[offset:offset + self.SLICE]
+            self.throttle(peer, len(piece))
+            sock.sendall(piece)
+
+
+class StreamHeader:
+    """Versioned, length-prefixed header that opens every transfer connection.
+
+    PREFIX (magic, version, body length) is followed by a body of FIELDS
+    (size, mtime_ns, mode, flags, name length), the UTF-8 name and an
+    options JSON object holding the kind, the transport and anything added
+    later. The payload follows straight away: the receiver answers with a
+    REPLY frame (status, JSON length, JSON) while the data is already in
+    flight, so no round trip is spent before the first byte. Only
+    FLAG_WAIT, used for the UDP offer, makes the sender hold the payload
+    until the reply has arrived.
+
+    Headers that do not start with MAGIC are read as the old
+    name|size[|kind[|transport]] text and answered with ACK/UDP.
+    """
+    MAGIC = b'SNAP'
+    VERSION = 1
+    PREFIX = struct.Struct('!4sBI')
+    FIELDS = struct.Struct('!QqIIH')
+    REPLY = struct.Struct('!BI')
+    MAX_BODY = 65536
+    IDLE_TIMEOUT = 120  # How long a receiver keeps a connection that has not sent a header yet
+    FLAG_WAIT = 1
+    ACCEPT = 0
+    REJECT = 1
+
+    @staticmethod
+    def pack(name, size, mtime_ns=0, mode=0, flags=0, options=None):
+        name = name.encode()
+        body = (StreamHeader.FIELDS.pack(size, mtime_ns, mode, flags, len(name)) + name
+                + json.dumps(options or {}).encode())
+        return StreamHeader.PREFIX.pack(StreamHeader.MAGIC, StreamHeader.VERSION, len(body)) + body
+
+    @staticmethod
+    def read(sock):
+        """Read a header; returns a dict with name, size, mtime_ns, mode, flags, options and legacy.
+
+        Returns None if the connection closes or stays idle for IDLE_TIMEOUT
+        before the first byte, which is how unused pre-warmed connections end.
+        """
+        # TLS sockets cannot peek, and no legacy sender speaks TLS
+        secure = isinstance(sock, ssl.SSLSocket)
+        sock.settimeout(StreamHeader.IDLE_TIMEOUT)
+        try:
+            peek = sock.recv(len(StreamHeader.MAGIC)) if secure else sock.recv(len(StreamHeader.MAGIC), socket.MSG_PEEK)
+        except (socket.timeout, ConnectionResetError):
+            return None
+        finally:
+            sock.settimeout(None)
+        if not peek:
+            return None
+        if not secure and not StreamHeader.MAGIC.startswith(peek):
+            return StreamHeader._read_legacy(sock)
+        if not secure:
+            peek = b''
+        prefix = peek + recv_exact(sock, StreamHeader.PREFIX.size - len(peek))
+        if len(prefix) < StreamHeader.PREFIX.size or not prefix.startswith(StreamHeader.MAGIC):
+            raise Exception("Malformed header")
+        magic, version, length = StreamHeader.PREFIX.unpack(prefix)
+        if version != StreamHeader.VERSION:
+            raise Exception(f"Unsupported header version {version}")
+        if length > StreamHeader.MAX_BODY:
+            raise Exception("Header too large")
+        body = recv_exact(sock, length)
+        if len(body) < length:
+            raise Exception("Connection closed during header")
+        size, mtime_ns, mode, flags, name_len = StreamHeader.FIELDS.unpack_from(body)
+        offset = StreamHeader.FIELDS.size
+        return {
+            'name': body[offset:offset + name_len].decode(),
+            'size': size,
+            'mtime_ns': mtime_ns,
+            'mode': mode,
+            'flags': flags,
+            'options': json.loads(body[offset + name_len:] or b'{}'),
+            'legacy': False,
+        }
+
+    @staticmethod
+    def _read_legacy(sock):
+        # Old senders write the whole text header with a single send()
+        fields = sock.recv(1024).decode().split('|')
+        options = {'kind': fields[2] if len(fields) > 2 else 'file'}
+        if len(fields) > 3:
+            options['transport'] = fields[3]
+        return {'name': fields[0], 'size': int(fields[1]), 'mtime_ns': 0, 'mode': 0,
+                'flags': StreamHeader.FLAG_WAIT, 'options': options, 'legacy': True}
+
+    @staticmethod
+    def reply(sock, header, status=ACCEPT, **info):
+        if header['legacy']:
+            if status == StreamHeader.ACCEPT:
+                sock.sendall(b'UDP' + struct.pack('!H', info['udp_port']) if 'udp_port' in info else b'ACK')
+            return
+        payload = json.dumps(info).encode()
+        sock.sendall(StreamHeader.REPLY.pack(status, len(payload)) + payload)
+
+    @staticmethod
+    def read_reply(sock):
+        """Returns (status, info) or raises if the receiver hung up first"""
+        head = recv_exact(sock, StreamHeader.REPLY.size)
+        if len(head) < StreamHeader.REPLY.size:
+            raise Exception("Receiver closed the connection")
+        status, length = StreamHeader.REPLY.unpack(head)
+        payload = recv_exact(sock, length)
+        return status, json.loads(payload or b'{}')
+
+    @staticmethod
+    def safe_name(name):
+        """The last component of a name a peer sent, or None if it names nothing"""
+        name = os.path.basename(name.replace('\\', '/'))
+        return None if name in ('', '.', '..') else name
+
+    @staticmethod
+    def apply_attributes(path, header, mode=True):
+        """Carry the sender's modification time and permission bits over to path"""
+        try:
+            if header['mtime_ns']:
+                os.utime(path, ns=(header['mtime_ns'], header['mtime_ns']))
+            if mode and header['mode']:
+                os.chmod(path, header['mode'] | 0o600)  # Never lock the user out of their own file
+        except OSError as e:
+            print(f"Could not set attributes on {path}: {e}")
+
+
+class ContentIndex:
+    """SHA-256 fingerprints of local files, cached by path, size, mtime and inode.
+
+    The sender fingerprints a file before offering it; the receiver looks
+    the fingerprint up among same-sized files under its downloads folder,
+    hashing a candidate only when the cache has nothing current for it.
+    Offers are only looked up for devices found by discovery, since the
+    answer reveals whether the receiver holds the file.
+
+    Recent entries live in memory; once configure() is given a database
+    path they are also kept in SQLite so an unchanged file is never re-read
+    across restarts. The table is bounded and evicts the least recently used
+    rows. Folders fingerprinted by a checksum sync are remembered and
+    re-hashed in the background at startup, so the next sync finds them
+    warm.
+    """
+    HASH_CHUNK = 1048576
+    BLOCK_SIZE = HASH_CHUNK  # One SHA-256 block signature per chunk
+    MEMORY_ENTRIES = 50000
+    TOUCH_BATCH = 256
+    WATCH_LIMIT = 16
+
+    lock = threading.Lock()
+    cache = OrderedDict()  # path -> ((size, mtime_ns, inode), hex digest)
+    db = None
+    db_path = None
+    max_entries = 100000
+    touched = {}  # path -> last use, written to the database in batches
+    pending = 0  # Rows inserted since the last commit
+    committed = 0.0
+
+    @staticmethod
+    def configure(db_path, max_entries):
+        """Open (or switch to) the persistent cache; db_path None keeps it in memory only"""
+        with ContentIndex.lock:
+            ContentIndex.max_entries = max_entries
+            if db_path == ContentIndex.db_path:
+                if ContentIndex.db:
+                    ContentIndex._evict()
+                return
+            ContentIndex._close()
+            ContentIndex.db_path = db_path
+            if db_path:
+                ContentIndex.db = ContentIndex._open(db_path)
+            if not ContentIndex.db:
+                return
+            ContentIndex._evict()
+        threading.Thread(target=ContentIndex._warm, daemon=True).start()
+
+    @staticmethod
+    def close():
+        with ContentIndex.lock:
+            with contextlib.suppress(sqlite3.Error):
+                ContentIndex._close()
+            ContentIndex.db = None
+            ContentIndex.db_path = None
+
+    @staticmethod
+    def _open(db_path):
+        for attempt in range(2):
+            try:
+                os.makedirs(os.path.dirname(db_path), exist_ok=True)
+                db = sqlite3.connect(db_path, check_same_thread=False)
+                db.execute('PRAGMA journal_mode=WAL')
+                db.execute('PRAGMA synchronous=NORMAL')
+                db.execute('CREATE TABLE IF NOT EXISTS hashes (path TEXT PRIMARY KEY, size INTEGER, '
+                           'mtime_ns INTEGER, inode INTEGER, sha256 TEXT, blocks BLOB, used REAL)')
+                db.execute('CREATE INDEX IF NOT EXISTS hashes_used ON hashes (used)')
+                db.execute('CREATE TABLE IF NOT EXISTS watched (path TEXT PRIMARY KEY, used REAL)')
+                db.commit()
+                return db
+            except (sqlite3.Error, OSError) as e:
+                print(f"Hash cache unavailable at {db_path}: {e}")
+                if attempt or not os.path.exists(db_path):
+                    return None
+                # It is only a cache: start over rather than run without one
+                for suffix in ('', '-wal', '-shm'):
+                    with contextlib.suppress(OSError):
+                        os.remove(db_path + suffix)
+        return None
+
+    @staticmethod
+    def _close():
+        if ContentIndex.db:
+            ContentIndex._flush()
+            ContentIndex.db.close()
+            ContentIndex.db = None
+
+    @staticmethod
+    def _flush():
+        if ContentIndex.touched:
+            ContentIndex.db.executemany('UPDATE hashes SET used = ? WHERE path = ?',
+                                        [(used, path) for path, used in ContentIndex.touched.items()])
+            ContentIndex.touched.clear()
+        ContentIndex.db.commit()
+        ContentIndex.pending = 0
+        ContentIndex.committed = time.time()
+
+    @staticmethod
+    def _evict():
+        ContentIndex._flush()
+        ContentIndex.db.execute('DELETE FROM hashes WHERE path IN '
+                                '(SELECT path FROM hashes ORDER BY used DESC LIMIT -1 OFFSET ?)',
+                                (ContentIndex.max_entries,))
+        ContentIndex.db.commit()
+
+    @staticmethod
+    def _remember(path, key, digest):
+        ContentIndex.cache[path] = (key, digest)
+        ContentIndex.cache.move_to_end(path)
+        if len(ContentIndex.cache) > ContentIndex.MEMORY_ENTRIES:
+            ContentIndex.cache.popitem(last=False)
+
+    @staticmethod
+    def _lookup(path, key, blocks=False):
+        """Cached (digest, blocks) for path if key still matches; call with the lock held"""
+        entry = ContentIndex.cache.get(path)
+        if entry and entry[0] == key and not blocks:
+            ContentIndex.cache.move_to_end(path)
+            if ContentIndex.db:
+                ContentIndex._touch(path)
+            return entry[1], None
+        if not ContentIndex.db:
+            return None
+        try:
+            row = ContentIndex.db.execute('SELECT size, mtime_ns, inode, sha256, blocks FROM hashes WHERE path = ?',
+                                          (path,)).fetchone()
+        except sqlite3.Error as e:
+            print(f"Hash cache lookup failed: {e}")
+            return None
+        if not row or tuple(row[:3]) != key or (blocks and row[4] is None):
+            return None
+        ContentIndex._remember(path, key, row[3])
+        ContentIndex._touch(path)
+        return row[3], row[4]
+
+    @staticmethod
+    def _touch(path):
+        ContentIndex.touched[path] = time.time()
+        if len(ContentIndex.touched) >= ContentIndex.TOUCH_BATCH:
+            try:
+                ContentIndex._evict()
+            except sqlite3.Error as e:
+                ContentIndex.touched.clear()
+                print(f"Hash cache update failed: {e}")
+
+    @staticmethod
+    def _store(path, key, digest, blocks):
+        ContentIndex._remember(path, key, digest)
+        if not ContentIndex.db:
+            return
+        ContentIndex.touched.pop(path, None)
+        try:
+            now = time.time()
+            ContentIndex.db.execute('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                    (path, *key, digest, blocks, now))
+            ContentIndex.pending += 1
+            # Commit in batches; a crash only loses hashes of the last second
+            if ContentIndex.pending >= ContentIndex.TOUCH_BATCH or now - ContentIndex.committed >= 1:
+                ContentIndex._flush()
+        except sqlite3.Error as e:
+            print(f"Hash cache update failed: {e}")
+
+    @staticmethod
+    def _key(info):
+        return (info.st_size, info.st_mtime_ns, info.st_ino)
+
+    @staticmethod
+    def _hash(path, with_blocks):
+        """Read path once: (hex SHA-256, concatenated per-block SHA-256 digests or None)"""
+        digest = hashlib.sha256()
+        blocks = bytearray() if with_blocks else None
+        buffer = bytearray(ContentIndex.HASH_CHUNK)
+        view = memoryview(buffer)
+        with open(path, 'rb', buffering=0) as f:
+            while True:
+                n = f.readinto(buffer)
+                if not n:
+                    break
+                digest.update(view[:n])
+                if with_blocks:
+                    blocks += hashlib.sha256(view[:n]).digest()
+        return digest.hexdigest(), (bytes(blocks) if with_blocks else None)
+
+    @staticmethod
+    def _compute(path, with_blocks):
+        info = os.stat(path)
+        key = ContentIndex._key(info)
+        with ContentIndex.lock:
+            cached = ContentIndex._lookup(path, key, with_blocks)
+        if cached:
+            return cached
+        digest, blocks = ContentIndex._hash(path, with_blocks)
+        if ContentIndex._key(os.stat(path)) == key:  # Don't cache a file that changed while it was read
+            with ContentIndex.lock:
+                ContentIndex._store(path, key, digest, blocks)
+        return digest, blocks
+
+    @staticmethod
+    def fingerprint(path):
+        return ContentIndex._compute(path, False)[0]
+
+    @staticmethod
+    def blocks(path):
+        """SHA-256 of each BLOCK_SIZE block of path, in order"""
+        blocks = ContentIndex._compute(path, True)[1]
+        return [blocks[i:i + 32] for i in range(0, len(blocks), 32)]
+
+    @staticmethod
+    def watch(folder_path):
+        """Remember folder_path for the startup warm-up"""
+        with ContentIndex.lock:
+            if not ContentIndex.db:
+                return
+            try:
+                ContentIndex.db.execute('INSERT OR REPLACE INTO watched VALUES (?, ?)',
+                                        (os.path.abspath(folder_path), time.time()))
+                ContentIndex.db.execute('DELETE FROM watched WHERE path IN '
+                                        '(SELECT path FROM watched ORDER BY used DESC LIMIT -1 OFFSET ?)',
+                                        (ContentIndex.WATCH_LIMIT,))
+                ContentIndex.db.commit()
+            except sqlite3.Error as e:
+                print(f"Hash cache update failed: {e}")
+
+    @staticmethod
+    def _warm():
+        with ContentIndex.lock:
+            if not ContentIndex.db:
+                return
+            folders = [row[0] for row in ContentIndex.db.execute('SELECT path FROM watched ORDER BY used DESC')]
+        hashed = 0
+        started = time.time()
+        for folder_path in folders:
+            if not os.path.isdir(folder_path):
+                continue
+            try:
+                files = FolderSync.scan(folder_path)[1]
+            except OSError:
+                continue
+            for size, mtime_ns, path in files.values():
+                try:
+                    ContentIndex.fingerprint(path)
+                    hashed += 1
+                except OSError:
+                    continue
+        if hashed:
+            print(f"Hash cache warm-up checked {hashed} files in {time.time() - started:.1f}s")
+
+    @staticmethod
+    def find(root, size, digest):
+        """Path of a file under root with this size and SHA-256, or None"""
+        for dirpath, dirs, files in os.walk(root):
+            dirs[:] = [d for d in dirs if not d.startswith('.')]  # Skip .snapsend-partial staging
+            for name in files:
+                if name.startswith('.'):
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    if os.path.getsize(path) == size and ContentIndex.fingerprint(path) == digest:
+                        return path
+                except OSError:
+                    continue
+        return None
+
+
+class ChunkTree:
+    """Merkle tree over the CHUNK-sized chunks of a file, to verify a transfer and repair only what broke.
+
+    Both ends hash chunks while the payload moves, the sender the blocks
+    it reads and the receiver the blocks it receives, before writing them.
+    Neither end reads the file a second time. The hashing runs on a shared
+    thread pool. hashlib releases the GIL, so it keeps several cores busy
+    next to the transfer without copying each chunk to another process.
+
+    After the payload the sender sends its root. Only if the receiver's
+    root differs do the leaves follow. The receiver answers with the chunk
+    ranges whose leaves differ, then rewrites and re-hashes them in place
+    as the sender sends them again, for up to MAX_ROUNDS rounds.
+
+    The receiver's bytes must pass through Python to be hashed, so a
+    verified transfer is received with the copy loop rather than splice.
+    """
+    CHUNK = ContentIndex.BLOCK_SIZE
+    ROOT = struct.Struct('!32sQ')  # root, chunk count
+    MAX_ROUNDS = 3
+    MAX_PENDING = 16  # Chunks queued for hashing before add() waits
+
+    pool = None
+    pool_lock = threading.Lock()
+
+    def __init__(self):
+        self.futures = []
+        self.waited = 0
+        self.carry = bytearray()
+
+    @staticmethod
+    def _pool():
+        with ChunkTree.pool_lock:
+            if ChunkTree.pool is None:
+                ChunkTree.pool = ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 2),
+                                                    thread_name_prefix='chunk-hash')
+            return ChunkTree.pool
+
+    @staticmethod
+    def _digest(data):
+        return hashlib.sha256(data).digest()
+
+    def _submit(self, data):
+        self.futures.append(ChunkTree._pool().submit(ChunkTree._digest, data))
+        if len(self.futures) - self.waited > ChunkTree.MAX_PENDING:
+            self.futures[self.waited].result()
+            self.waited += 1
+
+    def add(self, data):
+        """Hash the next bytes of the file, in whatever blocks they come"""
+        view = memoryview(data)
+        if self.carry:
+            take = min(ChunkTree.CHUNK - len(self.carry), len(view))
+            self.carry += view[:take]
+            view = view[take:]
+            if len(self.carry) < ChunkTree.CHUNK:
+                return
+            self._submit(bytes(self.carry))
+            self.carry = bytearray()
+        while len(view) >= ChunkTree.CHUNK:
+            self._submit(view[:ChunkTree.CHUNK])
+            view = view[ChunkTree.CHUNK:]
+        self.carry += view
+
+    def finish(self):
+        """The leaf digests, once the last partial chunk is hashed"""
+        if self.carry:
+            self._submit(bytes(self.carry))
+            self.carry = bytearray()
+        return [future.result() for future in self.futures]
+
+    @staticmethod
+    def root(leaves):
+        level = list(leaves) or [hashlib.sha256(b'').digest()]
+        while len(level) > 1:
+            level = [hashlib.sha256(b''.join(level[i:i + 2])).digest() if i + 1 < len(level) else level[i]
+                     for i in range(0, len(level), 2)]
+        return level[0]
+
+    @staticmethod
+    def ranges(expected, leaves):
+        """[start, end) chunk index ranges where leaves differ from expected"""
+        ranges = []
+        for index, (want, have) in enumerate(zip(expected, leaves)):
+            if want != have:
+                if ranges and ranges[-1][1] == index:
+                    ranges[-1][1] = index + 1
+                else:
+                    ranges.append([index, index + 1])
+        return ranges
+
+    @staticmethod
+    def send(sock, peer, file_path, size, leaves, metrics):
+        """Sender's side once the payload is out; returns how many bytes had to be sent again"""
+        sock.settimeout(FileTransferManager.REPLY_TIMEOUT)  # The receiver may still be hashing
+        sock.sendall(ChunkTree.ROOT.pack(ChunkTree.root(leaves), len(leaves)))
+        info = FileTransferManager.finish_stream(sock)
+        if info.get('verified'):
+            return 0
+        sock.sendall(b''.join(leaves))
+        resent = 0
+        with open(file_path, 'rb') as f:
+            while True:
+                info = FileTransferManager.finish_stream(sock)
+                if 'ranges' not in info:
+                    return resent
+                print(f"{peer} asked for {sum(end - start for start, end in info['ranges'])} chunks again")
+                for start, end in info['ranges']:
+                    metrics.retry(end - start)
+                    offset = start * ChunkTree.CHUNK
+                    end = min(end * ChunkTree.CHUNK, size)
+                    while offset < end:
+                        data = os.pread(f.fileno(), min(ChunkTree.CHUNK, end - offset), offset)
+                        if not data:
+                            raise Exception(f"{file_path} shrank while it was being sent")
+                        FileTransferManager.limiter.send(sock, peer, data)
+                        offset += len(data)
+                        resent += len(data)
+
+    @staticmethod
+    def receive(sock, header, f, size, tree, peer=None):
+        """Receiver's side once the payload is in f; raises if chunks still differ after MAX_ROUNDS"""
+        leaves = tree.finish()
+        head = recv_exact(sock, ChunkTree.ROOT.size)
+        if len(head) < ChunkTree.ROOT.size:
+            raise Exception("Connection closed before verification")
+        root, count = ChunkTree.ROOT.unpack(head)
+        if count == len(leaves) and root == ChunkTree.root(leaves):
+            StreamHeader.reply(sock, header, verified=True)
+            return
+        if count != len(leaves):
+            StreamHeader.reply(sock, header, StreamHeader.REJECT, error="Chunk count mismatch")
+            raise Exception(f"Sender has {count} chunks, {len(leaves)} were received")
+        StreamHeader.reply(sock, header, leaves=True)
+        data = recv_exact(sock, count * 32)
+        if len(data) < count * 32:
+            raise Exception("Connection closed during verification")
+        expected = [data[i:i + 32] for i in range(0, len(data), 32)]
+        for _ in range(ChunkTree.MAX_ROUNDS):
+            ranges = ChunkTree.ranges(expected, leaves)
+            if not ranges:
+                StreamHeader.reply(sock, header, verified=True)
+                return
+            print(f"{sum(end - start for start, end in ranges)} chunks from {peer} failed verification")
+            StreamHeader.reply(sock, header, ranges=ranges)
+            for start, end in ranges:
+                offset = start * ChunkTree.CHUNK
+                end = min(end * ChunkTree.CHUNK, size)
+                while offset < end:
+                    length = min(ChunkTree.CHUNK, end - offset)
+                    data = recv_exact(sock, length)
+                    if len(data) < length:
+                        raise Exception("Connection closed during repair")
+                    FileTransferManager.limiter.throttle(peer, length)
+                    leaves[offset // ChunkTree.CHUNK] = ChunkTree._digest(data)
+                    os.pwrite(f.fileno(), data, offset)
+                    offset += length
+        failed = sum(end - start for start, end in ChunkTree.ranges(expected, leaves))
+        if failed:
+            StreamHeader.reply(sock, header, StreamHeader.REJECT, error=f"{failed} chunks failed verification")
+            raise Exception(f"{failed} chunks from {peer} still differ after {ChunkTree.MAX_ROUNDS} repairs")
+        StreamHeader.reply(sock, header, verified=True)
+
+
+class FolderStream:
+    """Wire format for folder transfers.
+
+    A folder is streamed as a flat sequence of entries instead of a zip, so the
+    receiver can recreate the tree while the data arrives. Each entry is an
+    ENTRY header (type, path length, size), the UTF-8 relative path using '/'
+    separators and, for files, the file contents.
+    """
+    ENTRY = struct.Struct('!BHQ')
+    DIR = 0
+    FILE = 1
+
+    @staticmethod
+    def scan(folder_path):
+        """Walk folder_path and return (entries, stream_size).
+
+        entries holds (type, relative path, absolute path, size) tuples in the
+        order they are sent; directories always precede their contents.
+        """
+        entries = []
+        stream_size = 0
+        for root, dirs, files in os.walk(folder_path):
+            dirs.sort()
+            rel_root = os.path.relpath(root, folder_path)
+            if rel_root != '.':
+                rel = rel_root.replace(os.sep, '/')
+                entries.append((FolderStream.DIR, rel, root, 0))
+                stream_size += FolderStream.ENTRY.size + len(rel.encode())
+            for file in sorted(files):
+                file_path = os.path.join(root, file)
+                try:
+                    size = os.path.getsize(file_path)
+                except OSError:
+                    continue
+                rel = file if rel_root == '.' else f"{rel_root.replace(os.sep, '/')}/{file}"
+                entries.append((FolderStream.FILE, rel, file_path, size))
+                stream_size += FolderStream.ENTRY.size + len(rel.encode()) + size
+        return entries, stream_size
+
+    @staticmethod
+    def scan_batch(paths):
+        """scan() for several files and folders sent together as one 'batch' stream.
+
+        Each item becomes a top-level entry under its own name; a name that
+        repeats gets a ' (n)' suffix.
+        """
+        entries = []
+        stream_size = 0
+        used = set()
+        for path in paths:
+            is_dir = os.path.isdir(path)
+            base = os.path.basename(os.path.normpath(path))
+            stem, extension = (base, '') if is_dir else os.path.splitext(base)
+            top = base
+            counter = 1
+            while top in used:
+                top = f"{stem} ({counter}){extension}"
+                counter += 1
+            used.add(top)
+            if is_dir:
+                entries.append((FolderStream.DIR, top, path, 0))
+                stream_size += FolderStream.ENTRY.size + len(top.encode())
+                for entry_type, rel, entry_path, size in FolderStream.scan(path)[0]:
+                    rel = f"{top}/{rel}"
+                    entries.append((entry_type, rel, entry_path, size))
+                    stream_size += FolderStream.ENTRY.size + len(rel.encode()) + size
+            else:
+                try:
+                    size = os.path.getsize(path)
+                except OSError:
+                    continue
+                entries.append((FolderStream.FILE, top, path, size))
+                stream_size += FolderStream.ENTRY.size + len(top.encode()) + size
+        return entries, stream_size
+
+    @staticmethod
+    def iter_chunks(entries, buffer_size=1048576, offset=0):
+        """Yield the stream for entries, starting offset bytes into it"""
+        position = 0
+        for entry_type, rel, path, size in entries:
+            encoded = rel.encode()
+            header = FolderStream.ENTRY.pack(entry_type, len(encoded), size) + encoded
+            if offset < position + len(header):
+                yield header[max(0, offset - position):]
+            position += len(header)
+            if entry_type != FolderStream.FILE:
+                continue
+            if offset >= position + size:
+                position += size
+                continue
+            skip = max(0, offset - position)
+            remaining = size - skip
+            with open(path, 'rb') as f:
+                f.seek(skip)
+                while remaining > 0:
+                    data = f.read(min(buffer_size, remaining))
+                    if not data:
+                        raise Exception(f"{rel} shrank while sending")
+                    remaining -= len(data)
+                    yield data
+            position += size
+
+    @staticmethod
+    def safe_join(root, relative_path):
+        """Join a peer-supplied relative path onto root, rejecting anything
+        that would escape it (absolute paths, drive letters, '..' parts)."""
+        parts = relative_path.replace('\\', '/').split('/')
+        if (not relative_path or relative_path.startswith('/')
+                or ':' in parts[0]
+                or any(part in ('', '.', '..') for part in parts)):
+            raise ValueError(f"Unsafe path in folder transfer: {relative_path!r}")
+        path = os.path.join(root, *parts)
+        real_root = os.path.realpath(root)
+        if os.path.commonpath([real_root, os.path.realpath(path)]) != real_root:
+            raise ValueError(f"Unsafe path in folder transfer: {relative_path!r}")
+        return path
+
+
+class FolderStreamWriter:
+    """Recreates a folder stream under a hidden staging directory.
+
+    Small files are buffered and handed to a thread pool so trees with many
+    files are not bound by one create/write/close at a time; large files are
+    written straight from the socket. The staging directory is renamed into
+    place by finish(), so the folder only appears once the transfer ends.
+    """
+    SMALL_FILE_LIMIT = 4 * 1048576
+    MAX_PENDING_BYTES = 64 * 1048576
+
+    def __init__(self, downloads_path, folder_name, workers=8):
+        self.downloads_path = downloads_path
+        self.folder_name = folder_name
+        # Unique per transfer, so two transfers of the same folder never share a staging tree
+        self.staging_path = os.path.join(downloads_path, f".{folder_name}.{uuid.uuid4().hex[:8]}.snapsend-partial")
+        os.makedirs(self.staging_path)
+        self._start_pool(workers)
+
+    def _start_pool(self, workers):
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.pending = deque()
+        self.pending_budget = threading.BoundedSemaphore(self.MAX_PENDING_BYTES // self.SMALL_FILE_LIMIT)
+
+    def receive(self, sock, stream_size, progress, peer=None):
+        limiter = FileTransferManager.limiter
+        received = 0
+        while received < stream_size:
+            with progress.phase('recv'):
+                header = recv_exact(sock, FolderStream.ENTRY.size)
+                if len(header) < FolderStream.ENTRY.size:
+                    raise Exception("Connection closed during folder transfer")
+                entry_type, path_len, size = FolderStream.ENTRY.unpack(header)
+                relative_path = recv_exact(sock, path_len).decode()
+            path = FolderStream.safe_join(self.staging_path, relative_path)
+            entry_size = FolderStream.ENTRY.size + path_len
+            progress.advance(entry_size)
+            received += entry_size
+
+            if entry_type == FolderStream.DIR:
+                with progress.phase('mkdir'):
+                    os.makedirs(path, exist_ok=True)
+                continue
+            if entry_type != FolderStream.FILE:
+                raise Exception(f"Unknown folder entry type {entry_type}")
+
+            with progress.phase('mkdir'):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            if size <= self.SMALL_FILE_LIMIT:
+                with progress.phase('recv'):
+                    data = recv_exact(sock, size)
+                if len(data) < size:
+                    raise Exception("Connection closed during folder transfer")
+                with progress.phase('throttle'):
+                    limiter.throttle(peer, size)
+                with progress.phase('write-queue'):
+                    self.pending_budget.acquire()
+                    self.pending.append(self.pool.submit(self._write_small_file, path, data))
+                progress.advance(size)
+            else:
+                self._write_large_file(sock, path, size, progress, peer)
+            received += size
+            self._reap_pending()
+
+    def _output_path(self, path):
+        return path
+
+    def _commit_file(self, path):
+        pass
+
+    def _write_small_file(self, path, data):
+        try:
+            with open(self._output_path(path), 'wb') as f:
+                f.write(data)
+            self._commit_file(path)
+        finally:
+            self.pending_budget.release()
+
+    def _write_large_file(self, sock, path, size, progress, peer):
+        limiter = FileTransferManager.limiter
+        remaining = size
+        with open(self._output_path(path), 'wb') as f:
+            while remaining > 0:
+                with progress.phase('recv'):
+                    data = recv_exact(sock, min(limiter.chunk_size(1048576), remaining))
+                if not data:
+                    raise Exception("Connection closed during folder transfer")
+                with progress.phase('throttle'):
+                    limiter.throttle(peer, len(data))
+                with progress.phase('write'):
+                    f.write(data)
+                remaining -= len(data)
+                progress.advance(len(data))
+        self._commit_file(path)
+
+    def _reap_pending(self):
+        # Surface write errors early instead of at the end of a long transfer
+        while self.pending and self.pending[0].done():
+            self.pending.popleft().result()
+
+    def _drain(self):
+        try:
+            while self.pending:
+                self.pending.popleft().result()
+        finally:
+            self.pool.shutdown(wait=True)
+
+    def finish(self):
+        """Wait for outstanding writes and move the folder into place"""
+        self._drain()
+        final_path = self._unused_path(self.folder_name)
+        os.rename(self.staging_path, final_path)
+        return final_path
+
+    def _unused_path(self, name):
+        final_path = os.path.join(self.downloads_path, name)
+        counter = 1
+        while os.path.exists(final_path):
+            final_path = os.path.join(self.downloads_path, f"{name} ({counter})")
+            counter += 1
+        return final_path
+
+    def abort(self):
+        self.pool.shutdown(wait=True, cancel_futures=True)
+        shutil.rmtree(self.staging_path, ignore_errors=True)
+
+
+class BatchStreamWriter(FolderStreamWriter):
+    """Receives a 'batch' stream: its top-level items land directly in the downloads folder.
+
+    Files replace an existing file of the same name, as a single file
+    transfer does; folders get a ' (n)' suffix, as a folder transfer does.
+    """
+
+    def __init__(self, downloads_path, workers=8):
+        super().__init__(downloads_path, "batch", workers)
+
+    def finish(self):
+        self._drain()
+        final_paths = []
+        for name in sorted(os.listdir(self.staging_path)):
+            staged = os.path.join(self.staging_path, name)
+            if os.path.isdir(staged):
+                final_path = self._unused_path(name)
+                os.rename(staged, final_path)
+            else:
+                final_path = os.path.join(self.downloads_path, name)
+                os.replace(staged, final_path)
+            final_paths.append(final_path)
+        os.rmdir(self.staging_path)
+        return final_paths
+
+
+class FolderSyncWriter(FolderStreamWriter):
+    """Writes a sync delta straight into an existing folder.
+
+    Each file goes to a hidden temporary name next to its target and is
+    renamed over it when complete, so an interrupted sync never leaves a
+    half-written file under the real name. Files get the mtime from the
+    sender's manifest so the next sync sees them as unchanged.
+    """
+
+    def __init__(self, folder_path, mtimes, workers=8):
+        self.staging_path = folder_path
+        self.mtimes = mtimes  # target path -> mtime_ns
+        self._start_pool(workers)
+
+    def _output_path(self, path):
+        return os.path.join(os.path.dirname(path), f".{os.path.basename(path)}{FolderSync.PARTIAL_SUFFIX}")
+
+    def _commit_file(self, path):
+        os.replace(self._output_path(path), path)
+        mtime_ns = self.mtimes.get(path)
+        if mtime_ns is not None:
+            os.utime(path, ns=(mtime_ns, mtime_ns))
+
+    def finish(self):
+        self._drain()
+        return self.staging_path
+
+    def abort(self):
+        # Finished files stay; leftover temporaries are hidden and replaced next time
+        self.pool.shutdown(wait=True, cancel_futures=True)
+
+
+class FolderSync:
+    """Mirrors a folder to a peer, sending only new and changed files.
+
+    The sender's payload for a 'sync' header is a manifest: zlib-compressed
+    JSON with the directory list and [path, size, mtime_ns(, sha256)] per
+    file. The receiver compares it with its copy under the downloads
+    folder and answers with a REPLY frame listing the indices of the files
+    it wants, which the sender streams in the FolderStream format. A file
+    is wanted when it is missing or its size or mtime differs; with
+    checksums, when its SHA-256 differs. With mirror_deletes the receiver
+    also removes what the sender no longer has, if accept_deletes allows
+    it on this side. A last REPLY frame reports how many files were
+    written and deleted.
+    """
+    PARTIAL_SUFFIX = '.snapsend-partial'
+    MAX_MANIFEST = 64 * 1048576  # Compressed; millions of files fit
+    MAX_MANIFEST_JSON = 512 * 1048576
+
+    accept_deletes = False  # Receiver side: let senders' mirror_deletes remove files here
+
+    @staticmethod
+    def scan(folder_path):
+        """One scandir pass: (dirs, files), files mapping path -> (size, mtime_ns, absolute path).
+
+        Paths are relative with '/' separators and directories come before
+        their contents. Sync temporaries are left out.
+        """
+        dirs = []
+        files = {}
+        stack = [('', folder_path)]
+        while stack:
+            rel_root, root = stack.pop()
+            with os.scandir(root) as entries:
+                for entry in entries:
+                    rel = f"{rel_root}/{entry.name}" if rel_root else entry.name
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            dirs.append(rel)
+                            stack.append((rel, entry.path))
+                        elif entry.is_file() and not entry.name.endswith(FolderSync.PARTIAL_SUFFIX):
+                            info = entry.stat()
+                            files[rel] = (info.st_size, info.st_mtime_ns, entry.path)
+                    except OSError:
+                        continue
+        return dirs, files
+
+    @staticmethod
+    def prepare(folder_path, checksum=False):
+        """Scan folder_path once for any number of targets: (paths, files, manifest bytes)"""
+        dirs, files = FolderSync.scan(folder_path)
+        if checksum:
+            ContentIndex.watch(folder_path)
+        paths = sorted(files)
+        records = []
+        for rel in paths:
+            size, mtime_ns, path = files[rel]
+            record = [rel, size, mtime_ns]
+            if checksum:
+                record.append(ContentIndex.fingerprint(path))
+            records.append(record)
+        manifest = json.dumps({'dirs': dirs, 'files': records}, separators=(',', ':')).encode()
+        return paths, files, zlib.compress(manifest, 1)
+
+    @staticmethod
+    def send(target_ip, folder_path, prepared, progress_callback=None, mirror_deletes=False):
+        """Sync one target; returns the receiver's summary ({'written': n, 'deleted': n})"""
+        paths, files, manifest = prepared
+        name = os.path.basename(os.path.normpath(folder_path))
+        metrics = TransferMetrics('send', target_ip, name, 'sync')
+        try:
+            sock, reply = FileTransferManager.negotiate_stream(
+                target_ip, name, len(manifest), 'sync', metrics=metrics, source_path=folder_path,
+                options={'mirror_deletes': mirror_deletes})
+        except Exception as e:
+            metrics.finish(e)
+            raise
+        metrics.handshake_done()
+        try:
+            with metrics.phase('manifest'):
+                sock.sendall(manifest)
+                FileTransferManager.finish_stream(sock)
+                # Comparing (and with checksums, hashing) can take the receiver a while
+                sock.settimeout(FileTransferManager.REPLY_TIMEOUT)
+                want = FileTransferManager.finish_stream(sock)['want']
+                sock.settimeout(30)
+
+            entries = [(FolderStream.FILE, paths[i], files[paths[i]][2], files[paths[i]][0]) for i in want]
+            stream_size = sum(FolderStream.ENTRY.size + len(rel.encode()) + size for _, rel, _, size in entries)
+            progress = TransferProgress(stream_size, progress_callback, metrics)
+            chunks = FolderStream.iter_chunks(entries)
+            while True:
+                with metrics.phase('read'):
+                    data = next(chunks, None)
+                if data is None:
+                    break
+                with metrics.phase('send'):
+                    FileTransferManager.limiter.send(sock, target_ip, data)
+                progress.advance(len(data))
+            with metrics.phase('reply'):
+                result = FileTransferManager.finish_stream(sock)
+            progress.finish()
+            metrics.finish()
+            return result
+        except Exception as e:
+            metrics.finish(e)
+            raise
+        finally:
+            sock.close()
+
+    @staticmethod
+    def receive(sock, header, folder_path, progress_callback=None, metrics=None, peer=None):
+        """Apply a sync to folder_path; returns (written, deleted)"""
+        if header['size'] > FolderSync.MAX_MANIFEST:
+            raise Exception("Sync manifest too large")
+        data = recv_exact(sock, header['size'])
+        if len(data) < header['size']:
+            raise Exception("Connection closed during sync manifest")
+        decompressor = zlib.decompressobj()
+        data = decompressor.decompress(data, FolderSync.MAX_MANIFEST_JSON)
+        if decompressor.unconsumed_tail:
+            raise Exception("Sync manifest too large")
+        manifest = json.loads(data)
+        os.makedirs(folder_path, exist_ok=True)
+        local_dirs, local_files = FolderSync.scan(folder_path)
+
+        want = []
+        for index, record in enumerate(manifest['files']):
+            rel, size, mtime_ns = record[:3]
+            local = local_files.get(rel)
+            if local is None or local[0] != size:
+                want.append(index)
+            elif len(record) > 3:
+                if ContentIndex.fingerprint(local[2]) != record[3]:
+                    want.append(index)
+                elif local[1] != mtime_ns:
+                    os.utime(local[2], ns=(mtime_ns, mtime_ns))
+            elif local[1] != mtime_ns:
+                want.append(index)
+
+        deleted = 0
+        if header['options'].get('mirror_deletes') and FolderSync.accept_deletes:
+            remote_files = {record[0] for record in manifest['files']}
+            remote_dirs = set(manifest['dirs'])
+            for rel, (size, mtime_ns, path) in local_files.items():
+                if rel not in remote_files:
+                    os.unlink(path)
+                    deleted += 1
+            for rel in sorted(local_dirs, reverse=True):
+                if rel not in remote_dirs:
+                    shutil.rmtree(os.path.join(folder_path, *rel.split('/')), ignore_errors=True)
+        for rel in manifest['dirs']:
+            os.makedirs(FolderStream.safe_join(folder_path, rel), exist_ok=True)
+
+        StreamHeader.reply(sock, header, want=want)
+        wanted = [manifest['files'][index] for index in want]
+        stream_size = sum(FolderStream.ENTRY.size + len(record[0].encode()) + record[1] for record in wanted)
+        progress = TransferProgress(stream_size, progress_callback, metrics)
+        writer = FolderSyncWriter(folder_path, {FolderStream.safe_join(folder_path, record[0]): record[2]
+                                                for record in wanted})
+        try:
+            writer.receive(sock, stream_size, progress, peer)
+            writer.finish()
+        except Exception:
+            writer.abort()
+            raise
+        StreamHeader.reply(sock, header, written=len(want), deleted=deleted)
+        progress.finish()
+        return len(want), deleted
+
+
+class UdpFallback(Exception):
+    """Raised by the UDP sender when the data path does not work out"""
+
+
+class UdpTransport:
+    """Paced UDP data path with selective retransmission and optional XOR FEC.
+
+    It is negotiated per transfer: the sender offers 'udp' in the header
+    options, with 'fec' if it will send parity, and waits for the reply; a
+    receiver that supports it includes udp_port in the reply.
+    The TCP connection stays open as the control channel: the sender writes
+    'U' before the first datagram, or 'T' to fall back to streaming the
+    whole file over TCP, and the receiver writes 'D' once it has everything.
+
+    Datagrams carry PAYLOAD bytes at offset seq * PAYLOAD. The receiver
+    reports its cumulative ack, the highest sequence seen, the bytes
+    received and up to MAX_NACKS missing sequences every FEEDBACK_INTERVAL.
+    The send rate follows the delivery rate the receiver measures, so
+    random loss on Wi-Fi costs a retransmission rather than a rate cut.
+    With FEC, each FEC_GROUP data packets are followed by an XOR parity
+    packet, which lets the receiver rebuild one lost packet per group
+    without waiting for a retransmission.
+    """
+    PAYLOAD = 1400
+    PACKET = struct.Struct('!BI')  # type, sequence (group index for parity)
+    FEEDBACK = struct.Struct('!BIiQH')  # type, cumulative, highest, bytes, nack count
+    NACK = struct.Struct('!I')
+    TYPE_DATA = 1
+    TYPE_PARITY = 2
+    TYPE_FEEDBACK = 3
+    FEC_GROUP = 16
+    MAX_NACKS = 128
+    REORDER_DISTANCE = 64
+    REORDER_WAIT = 0.05
+    TAIL_PROBE = 4
+    WINDOW = 16384
+    INITIAL_RATE = 20 * 1048576
+    MIN_RATE = 1048576
+    CONGESTION_RATIO = 0.7
+    FEEDBACK_INTERVAL = 0.02
+    PROBE_TIMEOUT = 2
+    STALL_TIMEOUT = 10
+
+    @staticmethod
+    def packet_count(size):
+        return (size + UdpTransport.PAYLOAD - 1) // UdpTransport.PAYLOAD
+
+    @staticmethod
+    def xor_into(accumulator, data):
+        """XOR data into the PAYLOAD-sized bytearray accumulator in place"""
+        mixed = int.from_bytes(accumulator, 'big') ^ int.from_bytes(data.ljust(UdpTransport.PAYLOAD, b'\0'), 'big')
+        accumulator[:] = mixed.to_bytes(UdpTransport.PAYLOAD, 'big')
+
+    @staticmethod
+    def send(control, udp_address, file_path, size, progress, fec=False, peer=None, rtt=0.01,
+             start_rate=INITIAL_RATE):
+        total = UdpTransport.packet_count(size)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4 * 1048576)
+        sock.connect(udp_address)
+        sock.setblocking(False)
+        control.sendall(b'U')
+        limiter = FileTransferManager.limiter
+
+        retransmit_guard = max(2 * rtt, 0.03)
+        rate = start_rate
+        next_seq = 0
+        cumulative = 0
+        highest = -1
+        acked_bytes = 0
+        retransmit = deque()
+        queued = set()
+        resent_at = {}
+        parity = bytearray(UdpTransport.PAYLOAD)
+        pending_parity = None
+        started = last_feedback = last_progress = last_advance = time.monotonic()
+        sample_time, sample_bytes, sample_sent = started, 0, 0
+        sent_bytes = 0
+        pacing_time = started
+        heard_back = False
+        feedback = bytearray(65535)
+
+        try:
+            with open(file_path, 'rb') as f:
+                def read_packet(seq):
+                    f.seek(seq * UdpTransport.PAYLOAD)
+                    return f.read(UdpTransport.PAYLOAD)
+
+                while cumulative < total:
+                    # Feedback from the receiver
+                    while True:
+                        try:
+                            n = sock.recv_into(feedback)
+                        except (BlockingIOError, InterruptedError):
+                            break
+                        except ConnectionRefusedError:
+                            raise UdpFallback("UDP port unreachable")
+                        if n < UdpTransport.FEEDBACK.size or feedback[0] != UdpTransport.TYPE_FEEDBACK:
+                            continue
+                        _, cumulative_ack, highest_seen, received_bytes, nack_count = UdpTransport.FEEDBACK.unpack_from(feedback)
+                        now = time.monotonic()
+                        heard_back = True
+                        last_feedback = now
+                        if cumulative_ack > cumulative or highest_seen > highest:
+                            last_progress = last_advance = now
+                        cumulative = max(cumulative, cumulative_ack)
+                        highest = max(highest, highest_seen)
+                        if received_bytes > acked_bytes:
+                            progress.advance(received_bytes - acked_bytes)
+                            acked_bytes = received_bytes
+                        for i in range(min(nack_count, UdpTransport.MAX_NACKS)):
+                            seq = UdpTransport.NACK.unpack_from(feedback, UdpTransport.FEEDBACK.size + i * 4)[0]
+                            if seq not in queued and now - resent_at.get(seq, 0) > retransmit_guard:
+                                retransmit.append(seq)
+                                queued.add(seq)
+                        # Follow the delivery rate instead of backing off on loss:
+                        # only a large gap between what was sent and what arrived
+                        # (a queue building up) lowers the rate
+                        if now - sample_time >= 0.1:
+                            delivered = received_bytes - sample_bytes
+                            if delivered >= (sent_bytes - sample_sent) * UdpTransport.CONGESTION_RATIO:
+                                rate *= 1.25
+                            else:
+                                rate = delivered / (now - sample_time) * 1.1
+                            rate = max(UdpTransport.MIN_RATE, rate)
+                            sample_time, sample_bytes, sample_sent = now, received_bytes, sent_bytes
+
+                    now = time.monotonic()
+                    if not heard_back and now - started > UdpTransport.PROBE_TIMEOUT:
+                        raise UdpFallback("No UDP feedback from receiver")
+                    if now - min(last_feedback, last_advance) > UdpTransport.STALL_TIMEOUT:
+                        raise UdpFallback("UDP transfer stalled")
+
+                    # Tail loss probe: if the last packets were lost the receiver
+                    # never learns how far the file goes, so resend the final few;
+                    # once it has them it NACKs any remaining gaps itself
+                    if (next_seq >= total and not retransmit and highest < total - 1
+                            and now - last_progress > max(4 * rtt, 0.1)):
+                        for seq in range(max(cumulative, highest + 1, total - UdpTransport.TAIL_PROBE), total):
+                            if seq not in queued:
+                                retransmit.append(seq)
+                                queued.add(seq)
+                        last_progress = now
+
+                    # Paced burst
+                    pacing_time = max(pacing_time, now - 0.01)
+                    sent_any = False
+                    while pacing_time <= now:
+                        if retransmit:
+                            seq = retransmit.popleft()
+                            queued.discard(seq)
+                            if seq < cumulative:
+                                continue
+                            resent_at[seq] = now
+                            if progress.metrics:
+                                progress.metrics.retry()
+                            data = read_packet(seq)
+                        elif next_seq < total and next_seq < cumulative + UdpTransport.WINDOW:
+                            seq = next_seq
+                            next_seq += 1
+                            data = read_packet(seq)
+                            if fec:
+                                UdpTransport.xor_into(parity, data)
+                                if seq % UdpTransport.FEC_GROUP == UdpTransport.FEC_GROUP - 1 or seq == total - 1:
+                                    pending_parity = UdpTransport.PACKET.pack(
+                                        UdpTransport.TYPE_PARITY, seq // UdpTransport.FEC_GROUP) + parity
+                                    parity = bytearray(UdpTransport.PAYLOAD)
+                        else:
+                            break
+                        try:
+                            sock.send(UdpTransport.PACKET.pack(UdpTransport.TYPE_DATA, seq) + data)
+                        except BlockingIOError:
+                            retransmit.appendleft(seq)
+                            queued.add(seq)
+                            break
+                        except ConnectionRefusedError:
+                            raise UdpFallback("UDP port unreachable")
+                        sent_any = True
+                        sent_bytes += len(data)
+                        limiter.throttle(peer, len(data))
+                        pacing_time += len(data) / rate
+                        if pending_parity:
+                            try:
+                                sock.send(pending_parity)
+                                pacing_time += UdpTransport.PAYLOAD / rate
+                            except BlockingIOError:
+                                pass  # Parity is best effort; NACKs still cover the group
+                            pending_parity = None
+                    if not sent_any:
+                        select.select([sock], [], [], max(0.0005, min(pacing_time - now, UdpTransport.FEEDBACK_INTERVAL)))
+
+            # Wait for the receiver to confirm it has written everything
+            control.settimeout(UdpTransport.STALL_TIMEOUT)
+            if control.recv(1) != b'D':
+                raise Exception("Receiver did not confirm UDP transfer")
+            if size > acked_bytes:
+                progress.advance(size - acked_bytes)
+        finally:
+            sock.close()
+
+    @staticmethod
+    def receive(control, udp_sock, file_path, size, progress, peer=None, fec=False):
+        """Receive into file_path; returns False if the sender fell back to TCP.
+
+        fec says whether the sender announced parity packets; without it
+        no parity groups are kept. Only datagrams from the host at the
+        other end of control count, and only from the first address of
+        that host a packet arrives from.
+        """
+        total = UdpTransport.packet_count(size)
+        start = recv_exact(control, 1)
+        if start == b'T':
+            return False
+        if start != b'U':
+            raise Exception("Unexpected UDP control message")
+
+        udp_sock.setblocking(False)
+        limiter = FileTransferManager.limiter
+        received = bytearray(total)
+        received_count = 0
+        received_bytes = 0
+        cumulative = 0
+        highest = -1
+        groups = {}    # group -> [received count, XOR of received payloads]
+        parities = {}  # group -> parity payload
+        done = bytearray(total // UdpTransport.FEC_GROUP + 1 if fec else 0)  # Groups complete or recovered
+        host = control.getpeername()[0]
+        sender = None
+        last_packet = last_feedback = time.monotonic()
+        buffer = bytearray(UdpTransport.PACKET.size + UdpTransport.PAYLOAD)
+
+        def packet_length(seq):
+            return min(UdpTransport.PAYLOAD, size - seq * UdpTransport.PAYLOAD)
+
+        def group_size(group):
+            return min(UdpTransport.FEC_GROUP, total - group * UdpTransport.FEC_GROUP)
+
+        with open(file_path, 'wb') as f:
+            def store(seq, data):
+                nonlocal received_count, received_bytes
+                f.seek(seq * UdpTransport.PAYLOAD)
+                f.write(data)
+                received[seq] = 1
+                received_count += 1
+                received_bytes += len(data)
+                progress.advance(len(data))
+                limiter.throttle(peer, len(data))
+
+            def try_recover(group):
+                state = groups.get(group)
+                if group not in parities or state is None or state[0] != group_size(group) - 1:
+                    return
+                first = group * UdpTransport.FEC_GROUP
+                for seq in range(first, first + group_size(group)):
+                    if not received[seq]:
+                        payload = bytearray(parities.pop(group))
+                        UdpTransport.xor_into(payload, bytes(state[1]))
+                        store(seq, bytes(payload[:packet_length(seq)]))
+                        break
+                groups.pop(group, None)
+                done[group] = 1
+
+            while received_count < total:
+                readable, _, _ = select.select([udp_sock, control], [], [], UdpTransport.FEEDBACK_INTERVAL)
+                if control in readable:
+                    message = control.recv(1)
+                    if message == b'T':
+                        return False
+                    if not message:
+                        raise Exception("Sender closed the control connection")
+                while True:
+                    try:
+                        n, address = udp_sock.recvfrom_into(buffer)
+                    except (BlockingIOError, InterruptedError):
+                        break
+                    if n < UdpTransport.PACKET.size or address[0] != host or sender not in (None, address):
+                        continue
+                    sender = address
+                    last_packet = time.monotonic()
+                    packet_type, seq = UdpTransport.PACKET.unpack_from(buffer)
+                    payload = bytes(buffer[UdpTransport.PACKET.size:n])
+                    if packet_type == UdpTransport.TYPE_DATA and seq < total and not received[seq]:
+                        store(seq, payload)
+                        highest = max(highest, seq)
+                        if not fec:
+                            continue
+                        group = seq // UdpTransport.FEC_GROUP
+                        state = groups.setdefault(group, [0, bytearray(UdpTransport.PAYLOAD)])
+                        state[0] += 1
+                        UdpTransport.xor_into(state[1], payload)
+                        if state[0] == group_size(group):
+                            groups.pop(group, None)
+                            parities.pop(group, None)
+                            done[group] = 1
+                        else:
+                            try_recover(group)
+                    elif fec and packet_type == UdpTransport.TYPE_PARITY and seq * UdpTransport.FEC_GROUP < total:
+                        if not done[seq]:
+                            parities[seq] = payload
+                            try_recover(seq)
+
+                while cumulative < total and received[cumulative]:
+                    cumulative += 1
+                now = time.monotonic()
+                if sender and (now - last_feedback >= UdpTransport.FEEDBACK_INTERVAL or received_count == total):
+                    nacks = []
+                    seq = cumulative
+                    # Packets just behind the highest one seen are more likely
+                    # reordered than lost, so leave them out of the NACK list
+                    # (until the sender goes quiet, e.g. at the end of the file)
+                    if now - last_packet < UdpTransport.REORDER_WAIT:
+                        nack_limit = highest - UdpTransport.REORDER_DISTANCE
+                    else:
+                        nack_limit = highest + 1
+                    while seq < nack_limit and len(nacks) < UdpTransport.MAX_NACKS and seq < cumulative + UdpTransport.WINDOW:
+                        if not received[seq]:
+                            nacks.append(seq)
+                        seq += 1
+                    message = UdpTransport.FEEDBACK.pack(UdpTransport.TYPE_FEEDBACK, cumulative, highest,
+                                                         received_bytes, len(nacks))
+                    message += b''.join(UdpTransport.NACK.pack(seq) for seq in nacks)
+                    try:
+                        udp_sock.sendto(message, sender)
+                    except (BlockingIOError, InterruptedError):
+                        pass
+                    last_feedback = now
+                if now - last_packet > UdpTransport.STALL_TIMEOUT + UdpTransport.PROBE_TIMEOUT:
+                    raise Exception("UDP transfer stalled")
+
+        # Repeat the final ack in case one is lost, then confirm over TCP
+        if sender:
+            final = UdpTransport.FEEDBACK.pack(UdpTransport.TYPE_FEEDBACK, total, total - 1, received_bytes, 0)
+            for _ in range(3):
+                try:
+                    udp_sock.sendto(final, sender)
+                except (BlockingIOError, InterruptedError):
+                    pass
+        control.sendall(b'D')
+        return True
+
+
+class NetworkInterfaces:
+    """Usable IPv4 interfaces, found without contacting any outside address.
+
+    Uses psutil when it is installed, the SIOCGIF* ioctls on Linux, and
+    the addresses the host name resolves to elsewhere. Loopback and down
+    interfaces are skipped. Entries are (ip, netmask, broadcast); netmask
+    is None when the platform doesn't report it.
+    """
+    CACHE_SECONDS = 10
+    SIOCGIFFLAGS = 0x8913
+    SIOCGIFADDR = 0x8915
+    SIOCGIFBRDADDR = 0x8919
+    SIOCGIFNETMASK = 0x891b
+    IFF_UP = 0x1
+    IFF_BROADCAST = 0x2
+    IFF_LOOPBACK = 0x8
+
+    lock = threading.Lock()
+    cached = []
+    cached_at = 0.0
+
+    @staticmethod
+    def list():
+        with NetworkInterfaces.lock:
+            if time.time() - NetworkInterfaces.cached_at >= NetworkInterfaces.CACHE_SECONDS:
+                interfaces = None
+                for source in (NetworkInterfaces._from_psutil, NetworkInterfaces._from_ioctl,
+                               NetworkInterfaces._from_hostname):
+                    try:
+                        interfaces = source()
+                    except Exception as e:
+                        print(f"Interface enumeration failed: {e}")
+                    if interfaces:
+                        break
+                NetworkInterfaces.cached = interfaces or []
+                NetworkInterfaces.cached_at = time.time()
+            return list(NetworkInterfaces.cached)
+
+    @staticmethod
+    def _entry(ip, netmask, broadcast=None):
+        if not broadcast and netmask:
+            mask = struct.unpack('!I', socket.inet_aton(netmask))[0]
+            address = struct.unpack('!I', socket.inet_aton(ip))[0]
+            broadcast = socket.inet_ntoa(struct.pack('!I', address | (~mask & 0xFFFFFFFF)))
+        return ip, netmask, broadcast or '255.255.255.255'
+
+    @staticmethod
+    def _from_psutil():
+        try:
+            import psutil
+        except ImportError:
+            return None
+        stats = psutil.net_if_stats()
+        interfaces = []
+        for name, addresses in psutil.net_if_addrs().items():
+            if name in stats and not stats[name].isup:
+                continue
+            for address in addresses:
+                if address.family == socket.AF_INET and not address.address.startswith('127.'):
+                    interfaces.append(NetworkInterfaces._entry(address.address, address.netmask, address.broadcast))
+        return interfaces
+
+    @staticmethod
+    def _from_ioctl():
+        if not sys.platform.startswith('linux'):
+            return None
+        import fcntl
+        interfaces = []
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            for index, name in socket.if_nameindex():
+                request = struct.pack('256s', name.encode()[:15])
+                flags = struct.unpack('H', fcntl.ioctl(s, NetworkInterfaces.SIOCGIFFLAGS, request)[16:18])[0]
+                if not flags & NetworkInterfaces.IFF_UP or flags & NetworkInterfaces.IFF_LOOPBACK:
+                    continue
+                try:
+                    ip = socket.inet_ntoa(fcntl.ioctl(s, NetworkInterfaces.SIOCGIFADDR, request)[20:24])
+                    netmask = socket.inet_ntoa(fcntl.ioctl(s, NetworkInterfaces.SIOCGIFNETMASK, request)[20:24])
+                except OSError:
+                    continue  # No IPv4 address
+                broadcast = None
+                if flags & NetworkInterfaces.IFF_BROADCAST:
+                    broadcast = socket.inet_ntoa(fcntl.ioctl(s, NetworkInterfaces.SIOCGIFBRDADDR, request)[20:24])
+                interfaces.append(NetworkInterfaces._entry(ip, netmask, broadcast))
+        return interfaces
+
+    @staticmethod
+    def _from_hostname():
+        addresses = {info[4][0] for info in socket.getaddrinfo(socket.gethostname(), None, socket.AF_INET)}
+        return [NetworkInterfaces._entry(ip, None) for ip in sorted(addresses) if not ip.startswith('127.')]
+
+    @staticmethod
+    def local_for(remote_ip):
+        """Our address on the subnet of remote_ip, or None to let the OS route"""
+        remote = struct.unpack('!I', socket.inet_aton(remote_ip))[0]
+        for ip, netmask, broadcast in NetworkInterfaces.list():
+            if netmask:
+                mask = struct.unpack('!I', socket.inet_aton(netmask))[0]
+                if struct.unpack('!I', socket.inet_aton(ip))[0] & mask == remote & mask:
+                    return ip
+        return None
+
+
+class PeerDirectory:
+    """Every address each discovered device announces, grouped by device ID.
+
+    Beacons are 'name|ip|device_id|certificate fingerprint', one per
+    interface. A beacon from an older build has no ID, so its IP stands in
+    for one, and no fingerprint. The device card keeps the first address
+    seen while it stays alive. An address stays with a device whose
+    certificate is pinned, so another ID announced on it is ignored until
+    the pins are forgotten.
+    """
+    TIMEOUT = 6  # Seconds without a beacon before an address is dropped
+
+    device_id = ''  # Ours, from the app config
+    lock = threading.Lock()
+    peers = {}  # device_id -> {'primary': ip, 'name': name, 'fingerprint': str, 'addresses': {ip: last seen}}
+    by_ip = {}  # ip -> device_id
+
+    @staticmethod
+    def seen(device_id, ip, name=None, fingerprint=None):
+        """Record a beacon; returns the address the device is listed under, or None if it was ignored"""
+        now = time.time()
+        with PeerDirectory.lock:
+            previous = PeerDirectory.by_ip.get(ip)
+            if previous and previous != device_id and previous in SecureTransport.pins:
+                return None
+            peer = PeerDirectory.peers.setdefault(device_id, {'primary': ip, 'addresses': {}})
+            peer['name'] = name or peer.get('name')
+            peer['fingerprint'] = fingerprint or peer.get('fingerprint')
+            peer['addresses'][ip] = now
+            PeerDirectory.by_ip[ip] = device_id
+            if now - peer['addresses'].get(peer['primary'], 0) > PeerDirectory.TIMEOUT:
+                peer['primary'] = ip  # The listed address went quiet
+            return peer['primary']
+
+    @staticmethod
+    def device_for(ip):
+        with PeerDirectory.lock:
+            return PeerDirectory.by_ip.get(ip)
+
+    @staticmethod
+    def name_for(ip):
+        with PeerDirectory.lock:
+            peer = PeerDirectory.peers.get(PeerDirectory.by_ip.get(ip))
+            return peer and peer.get('name')
+
+    @staticmethod
+    def fingerprint_for(ip):
+        """The certificate fingerprint the device at ip announces, if any"""
+        with PeerDirectory.lock:
+            peer = PeerDirectory.peers.get(PeerDirectory.by_ip.get(ip))
+            return peer and peer.get('fingerprint')
+
+    @staticmethod
+    def addresses(ip):
+        """Live addresses of the device at ip, starting with ip itself"""
+        now = time.time()
+        with PeerDirectory.lock:
+            device_id = PeerDirectory.by_ip.get(ip)
+            peer = PeerDirectory.peers.get(device_id)
+            if not peer:
+                return [ip]
+            for address, last_seen in list(peer['addresses'].items()):
+                if now - last_seen > PeerDirectory.TIMEOUT:
+                    del peer['addresses'][address]
+                    if device_id not in SecureTransport.pins:
+                        PeerDirectory.by_ip.pop(address, None)
+            return [ip] + [address for address in peer['addresses'] if address != ip]
+
+
+class SparseFile:
+    """Sends only the data extents of sparse files, so holes cross neither the wire nor the receiver's disk.
+
+    The sender finds extents with SEEK_DATA/SEEK_HOLE and offers 'sparse'
+    (the data byte count) in the header. A receiver that replies
+    sparse=True gets each extent as EXTENT (offset, length) followed by
+    its bytes, ending with an EXTENT of length 0 at the file size. It
+    sizes the file first and seeks past the holes, which leaves them
+    unallocated on filesystems that support sparse files.
+    """
+    EXTENT = struct.Struct('!QQ')
+    MIN_SIZE = 16 * 1048576
+    MIN_HOLE_SHARE = 0.1  # Below this, framing and the extra round trip cost more than they save
+    CHUNK = 1048576
+
+    @staticmethod
+    def extents(path):
+        """[(offset, length)] of the data in path, or None if it is dense or the platform can't tell"""
+        if not hasattr(os, 'SEEK_DATA'):
+            return None
+        info = os.stat(path)
+        size = info.st_size
+        allocated = getattr(info, 'st_blocks', None)
+        if size < SparseFile.MIN_SIZE or allocated is None or allocated * 512 > size * (1 - SparseFile.MIN_HOLE_SHARE):
+            return None
+        extents = []
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            offset = 0
+            while offset < size:
+                try:
+                    start = os.lseek(fd, offset, os.SEEK_DATA)
+                except OSError as e:
+                    if e.errno == errno.ENXIO:
+                        break  # Only a hole remains
+                    raise
+                offset = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+                extents.append((start, offset - start))
+        except OSError:
+            return None  # The filesystem does not report holes
+        finally:
+            os.close(fd)
+        return extents
+
+    @staticmethod
+    def data_size(extents):
+        return sum(length for offset, length in extents)
+
+    @staticmethod
+    def send(sock, target_ip, file_path, size, extents, progress, metrics):
+        limiter = FileTransferManager.limiter
+        with open(file_path, 'rb') as f:
+            for offset, length in extents:
+                sock.sendall(SparseFile.EXTENT.pack(offset, length))
+                f.seek(offset)
+                remaining = length
+                while remaining:
+                    with metrics.phase('read'):
+                        data = f.read(min(SparseFile.CHUNK, remaining))
+                    if not data:
+                        raise Exception(f"{os.path.basename(file_path)} shrank while being sent")
+                    with metrics.phase('send'):
+                        limiter.send(sock, target_ip, data)
+                    remaining -= len(data)
+                    progress.advance(len(data))
+        sock.sendall(SparseFile.EXTENT.pack(size, 0))
+
+    @staticmethod
+    def receive(sock, file_path, size, progress, peer=None):
+        limiter = FileTransferManager.limiter
+        with open(file_path, 'wb') as f:
+            f.truncate(size)
+            position = 0
+            while True:
+                head = recv_exact(sock, SparseFile.EXTENT.size)
+                if len(head) < SparseFile.EXTENT.size:
+                    raise Exception(f"Connection closed at offset {position} of {size}")
+                offset, length = SparseFile.EXTENT.unpack(head)
+                if not length:
+                    break
+                if offset < position or offset + length > size:
+                    raise Exception(f"Extent {offset}+{length} out of order")
+                f.seek(offset)
+                position = offset + length
+                while offset < position:
+                    with progress.phase('recv'):
+                        data = recv_exact(sock, min(limiter.chunk_size(SparseFile.CHUNK), position - offset))
+                    if not data:
+                        raise Exception(f"Connection closed at offset {offset} of {size}")
+                    with progress.phase('throttle'):
+                        limiter.throttle(peer, len(data))
+                    with progress.phase('write'):
+                        f.write(data)
+                    offset += len(data)
+                    progress.advance(len(data))
+
+
+class PageCache:
+    """Keeps huge transfers from pushing everything else out of the page cache.
+
+    Files of min_size or more are read and written through DropBehind,
+    so only the last few WINDOWs of a transfer stay cached. With
+    direct_io, such files are read with O_DIRECT where the OS and
+    filesystem allow it, which bypasses the cache entirely.
+    """
+    WINDOW = 32 * 1048576
+    ALIGN = 4096  # O_DIRECT offsets and buffer sizes must be multiples of the block size
+
+    min_size = 1024 * 1048576  # 0 turns the mode off
+    direct_io = False
+
+    @staticmethod
+    def applies(size):
+        return bool(PageCache.min_size) and size >= PageCache.min_size and hasattr(os, 'posix_fadvise')
+
+    @staticmethod
+    def read(file_path, file_size, buffer_size, offset=0):
+        """Yield the file from offset like FileTransferManager.file_chunks, leaving little of it cached"""
+        if PageCache.direct_io and hasattr(os, 'O_DIRECT') and not (offset | buffer_size) % PageCache.ALIGN:
+            try:
+                fd = os.open(file_path, os.O_RDONLY | os.O_DIRECT)
+            except OSError:
+                fd = None  # e.g. tmpfs, which has no direct I/O
+            if fd is not None:
+                yield from PageCache._read_direct(fd, file_size, buffer_size, offset)
+                return
+        sent_size = offset
+        with open(file_path, 'rb') as f:
+            f.seek(offset)
+            cache = DropBehind(f, offset)
+            try:
+                while sent_size < file_size:
+                    data = f.read(buffer_size)
+                    if not data:
+                        break
+                    sent_size += len(data)
+                    yield data
+                    cache.advance(sent_size)
+            finally:
+                cache.finish()
+
+    @staticmethod
+    def _read_direct(fd, file_size, buffer_size, offset):
+        buffer = mmap.mmap(-1, buffer_size)  # Page-aligned, as O_DIRECT requires
+        try:
+            os.lseek(fd, offset, os.SEEK_SET)
+            while offset < file_size:
+                n = os.readv(fd, [buffer])
+                if not n:
+                    break
+                offset += n
+                yield buffer[:n]
+        finally:
+            buffer.close()
+            os.close(fd)
+
+
+class DropBehind:
+    """Drops the part of an open file already transferred from the page cache.
+
+    Call advance() with the position reached. Every WINDOW, it advises
+    POSIX_FADV_DONTNEED up to that position. On a file being written,
+    DONTNEED starts writeback of dirty pages but only drops clean ones,
+    so each range is advised twice: once to start its writeback and a
+    window later, when it is clean, to drop it. The transfer never waits
+    for the disk until finish(), which syncs and drops the rest.
+    """
+
+    def __init__(self, f, start=0, writing=False):
+        self.f = f
+        self.fd = f.fileno()
+        self.writing = writing
+        self.dropped = self.advised = start
+        os.posix_fadvise(self.fd, start, 0, os.POSIX_FADV_SEQUENTIAL)
+
+    def advance(self, position):
+        if position - self.advised < PageCache.WINDOW:
+            return
+        if self.writing:
+            self.f.flush()
+        os.posix_fadvise(self.fd, self.dropped, position - self.dropped, os.POSIX_FADV_DONTNEED)
+        self.dropped, self.advised = self.advised, position
+
+    def finish(self):
+        if self.writing:
+            self.f.flush()
+            os.fdatasync(self.fd)
+        os.posix_fadvise(self.fd, 0, 0, os.POSIX_FADV_DONTNEED)
+
+
+class Splice:
+    """Linux receive path that moves socket data into the file inside the kernel.
+
+    os.splice() carries each chunk from the socket into a pipe and from the
+    pipe into the file, so the bytes never enter Python: no copy into a
+    bytes object, no copy back out, and no GIL held while they move. Where
+    os.splice() is missing, the socket is TLS or has a timeout, or the
+    kernel refuses these descriptors, receive() moves nothing or stops
+    early and the caller's copy loop takes over.
+    """
+    PIPE_SIZE = 1048576  # Linux caps this at /proc/sys/fs/pipe-max-size, 1 MiB by default
+    UNSUPPORTED = (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, errno.EBADF)
+
+    enabled = True
+
+    @staticmethod
+    def usable(sock):
+        return (Splice.enabled and hasattr(os, 'splice') and not isinstance(sock, ssl.SSLSocket)
+                and sock.gettimeout() is None)
+
+    @staticmethod
+    def receive(sock, fd, size, progress, peer=None, cache=None):
+        """Move up to size bytes from sock to fd's current offset; returns how many were moved.
+
+        cache is the DropBehind of a file being written from its start.
+        """
+        import fcntl
+        limiter = FileTransferManager.limiter
+        received = 0
+        read_end, write_end = os.pipe()
+        try:
+            with contextlib.suppress(OSError, AttributeError):
+                fcntl.fcntl(write_end, fcntl.F_SETPIPE_SZ, Splice.PIPE_SIZE)
+            while received < size:
+                try:
+                    with progress.phase('recv'):
+                        n = os.splice(sock.fileno(), write_end, min(limiter.chunk_size(Splice.PIPE_SIZE),
+                                                                    size - received), flags=os.SPLICE_F_MOVE)
+                except OSError as e:
+                    if e.errno in Splice.UNSUPPORTED:
+                        break  # The pipe is empty, so the copy loop can carry on from here
+                    raise
+                if not n:
+                    break
+                with progress.phase('throttle'):
+                    limiter.throttle(peer, n)
+                with progress.phase('write'):
+                    spliced = Splice._drain(read_end, fd, n)
+                received += n
+                progress.advance(n)
+                if cache:
+                    cache.advance(received)
+                if not spliced:
+                    break
+        finally:
+            os.close(read_end)
+            os.close(write_end)
+        return received
+
+    @staticmethod
+    def _drain(read_end, fd, n):
+        """Write n piped bytes to fd; returns False if the file refused splice and they were copied instead"""
+        while n:
+            try:
+                n -= os.splice(read_end, fd, n, flags=os.SPLICE_F_MOVE)
+            except OSError as e:
+                if e.errno not in Splice.UNSUPPORTED:
+                    raise
+                while n:
+                    data = os.read(read_end, n)
+                    view = memoryview(data)
+                    while view:
+                        view = view[os.write(fd, view):]
+                    n -= len(data)
+                return False
+        return True
+
+
+class Multipath:
+    """One file striped across several interface pairs to the same device.
+
+    The primary connection offers 'multipath' with a token and FLAG_WAIT;
+    a receiver that supports it answers multipath=True. The sender then
+    opens one 'stripe' connection per other address of the device, each
+    bound to our interface on that address's subnet. Every connection
+    carries FRAME (offset, length) records followed by the data, and a
+    zero-length frame when it is done. Connections pull the next STRIPE
+    from a shared cursor as soon as they finish the last one, so each
+    path carries a share proportional to its measured throughput. A
+    failed stripe connection hands its range back to the others. The
+    receiver answers on the primary connection once every byte is
+    written.
+    """
+    FRAME = struct.Struct('!QI')
+    STRIPE = 4 * 1048576
+    JOIN_TIMEOUT = 60
+    RESEND_ROUNDS = 2
+
+    lock = threading.Lock()
+    sessions = {}  # token -> MultipathReceive
+
+    @staticmethod
+    def routes(target_ip):
+        """(local, remote) address pairs to target_ip's device, primary first"""
+        routes = []
+        used = set()
+        for remote in PeerDirectory.addresses(target_ip):
+            local = NetworkInterfaces.local_for(remote)
+            if local in used:
+                continue  # A second address behind the same interface adds nothing
+            if local:
+                used.add(local)
+            routes.append((local, remote))
+        return routes
+
+    @staticmethod
+    def send(sock, target_ip, routes, token, file_path, size, progress, metrics):
+        paths = [(sock, target_ip)]
+        for local, remote in routes[1:]:
+            try:
+                stripe = FileTransferManager.open_connection(remote, local)
+                stripe.sendall(StreamHeader.pack(token, size, flags=StreamHeader.FLAG_WAIT,
+                                                 options={'kind': 'stripe', 'multipath': token}))
+                FileTransferManager.finish_stream(stripe)
+                paths.append((stripe, remote))
+            except Exception as e:
+                print(f"Multipath: no stripe via {local or 'default route'} to {remote}: {e}")
+        cursor = [0]
+        returned = deque()  # Ranges handed back by failed stripes
+        in_flight = [0]
+        condition = threading.Condition()
+        sent = Counter()
+        lock = threading.Lock()
+        started = time.time()
+
+        def next_range():
+            with condition:
+                while True:
+                    if returned:
+                        rng = returned.popleft()
+                    elif cursor[0] < size:
+                        rng = (cursor[0], min(Multipath.STRIPE, size - cursor[0]))
+                        cursor[0] += rng[1]
+                    elif in_flight[0]:
+                        condition.wait()  # Another path may still fail and hand its range back
+                        continue
+                    else:
+                        return None
+                    in_flight[0] += 1
+                    return rng
+
+        def range_done(rng, failed):
+            with condition:
+                in_flight[0] -= 1
+                if failed:
+                    returned.append(rng)
+                condition.notify_all()
+
+        def send_range(f, path_sock, remote, offset, length, advance=True):
+            path_sock.sendall(Multipath.FRAME.pack(offset, length))
+            f.seek(offset)
+            while length:
+                with metrics.phase('read'):
+                    data = f.read(min(1048576, length))
+                if not data:
+                    raise Exception(f"{file_path} shrank during the transfer")
+                with metrics.phase('send'):
+                    FileTransferManager.limiter.send(path_sock, target_ip, data)
+                length -= len(data)
+                with lock:
+                    sent[remote] += len(data)
+                    if advance:
+                        progress.advance(len(data))
+
+        def run(path_sock, remote):
+            with open(file_path, 'rb') as f:
+                while True:
+                    rng = next_range()
+                    if rng is None:
+                        path_sock.sendall(Multipath.FRAME.pack(0, 0))
+                        return
+                    try:
+                        send_range(f, path_sock, remote, *rng)
+                    except Exception:
+                        range_done(rng, True)
+                        raise
+                    range_done(rng, False)
+
+        errors = {}
+
+        def worker(path_sock, remote):
+            try:
+                run(path_sock, remote)
+            except Exception as e:
+                errors[remote] = e
+                print(f"Multipath: path to {remote} failed: {e}")
+
+        threads = [threading.Thread(target=worker, args=path, daemon=True) for path in paths[1:]]
+        for thread in threads:
+            thread.start()
+        try:
+            worker(sock, target_ip)
+            for thread in threads:
+                thread.join()
+        finally:
+            for stripe, remote in paths[1:]:
+                stripe.close()
+        if target_ip in errors:
+            raise errors[target_ip]  # Without the primary connection there is no final reply
+        if len(errors) == len(paths):
+            raise Exception("Every multipath connection failed")
+        elapsed = max(time.time() - started, 1e-6)
+        print("Multipath to " + ", ".join(f"{remote} {sent[remote] / elapsed / 1048576:.1f} MB/s"
+                                          for stripe, remote in paths))
+        for attempt in range(Multipath.RESEND_ROUNDS + 1):
+            with metrics.phase('reply'):
+                missing = FileTransferManager.finish_stream(sock).get('missing')
+            if not missing:
+                return
+            if attempt == Multipath.RESEND_ROUNDS:
+                raise Exception(f"{len(missing)} stripes never arrived")
+            # Data a stripe connection had buffered when it dropped: resend it on the primary
+            metrics.retry()
+            with open(file_path, 'rb') as f:
+                for offset in missing:
+                    send_range(f, sock, target_ip, offset, min(Multipath.STRIPE, size - offset), advance=False)
+            sock.sendall(Multipath.FRAME.pack(0, 0))
+
+    @staticmethod
+    def join(sock, header):
+        """Attach a stripe connection to the transfer named by its token"""
+        token = header['options'].get('multipath')
+        with Multipath.lock:
+            session = Multipath.sessions.get(token)
+        try:
+            if not session:
+                StreamHeader.reply(sock, header, StreamHeader.REJECT, error="Unknown multipath transfer")
+                return
+            StreamHeader.reply(sock, header)
+            session.read_path(sock, primary=False)
+        except Exception as e:
+            print(f"Multipath stripe error: {e}")
+        finally:
+            sock.close()
+
+
+class MultipathReceive:
+    """Receiver side of a Multipath transfer: writes frames from every path into one file"""
+
+    def __init__(self, token, file_path, size, progress, peer=None):
+        self.token = token
+        self.file_path = file_path
+        self.size = size
+        self.progress = progress
+        self.peer = peer
+        self.received = 0
+        self.done = set()  # Offsets of completed ranges; a resent range counts once
+        self.stripes = 0
+        self.condition = threading.Condition()
+        with open(file_path, 'wb') as f:
+            f.truncate(size)
+
+    def __enter__(self):
+        with Multipath.lock:
+            Multipath.sessions[self.token] = self
+        return self
+
+    def __exit__(self, *exc_info):
+        with Multipath.lock:
+            Multipath.sessions.pop(self.token, None)
+
+    def read_path(self, sock, primary=True):
+        if not primary:
+            with self.condition:
+                self.stripes += 1
+        try:
+            with open(self.file_path, 'r+b') as f:
+                while True:
+                    with self.progress.phase('recv'):
+                        frame = recv_exact(sock, Multipath.FRAME.size)
+                    if len(frame) < Multipath.FRAME.size:
+                        raise Exception("Connection closed mid-transfer")
+                    offset, length = Multipath.FRAME.unpack(frame)
+                    if not length:
+                        return
+                    if offset + length > self.size:
+                        raise Exception("Frame outside the file")
+                    f.seek(offset)
+                    remaining = length
+                    while remaining:
+                        with self.progress.phase('recv'):
+                            data = recv_exact(sock, min(1048576, remaining))
+                        if not data:
+                            raise Exception("Connection closed mid-transfer")
+                        with self.progress.phase('throttle'):
+                            FileTransferManager.limiter.throttle(self.peer, len(data))
+                        with self.progress.phase('write'):
+                            f.write(data)
+                        remaining -= len(data)
+                    with self.condition:
+                        if offset not in self.done:
+                            self.done.add(offset)
+                            self.received += length
+                            self.progress.advance(length)
+        finally:
+            if not primary:
+                with self.condition:
+                    self.stripes -= 1
+                    self.condition.notify_all()
+
+    def wait(self):
+        """After the primary path ends: wait for the stripes, then return the offsets still missing"""
+        deadline = time.time() + Multipath.JOIN_TIMEOUT
+        with self.condition:
+            while self.stripes and self.received < self.size and time.time() < deadline:
+                self.condition.wait(1)
+            if self.received >= self.size:
+                return []
+            return [offset for offset in range(0, self.size, Multipath.STRIPE) if offset not in self.done]
+
+    def receive(self, sock, header):
+        """Run the primary path until every stripe is in, answering on it when done"""
+        StreamHeader.reply(sock, header, multipath=True)
+        for attempt in range(Multipath.RESEND_ROUNDS + 1):
+            self.read_path(sock)
+            missing = self.wait()
+            if not missing:
+                StreamHeader.reply(sock, header)
+                return
+            StreamHeader.reply(sock, header, missing=missing)
+        raise Exception(f"Multipath transfer ended after {self.received} of {self.size} bytes")
+
+
+class SecureTransport:
+    """Optional TLS for transfer and swarm connections, pinned to discovery IDs.
+
+    Each device keeps a self-signed P-256 certificate in tls/ under the user
+    data dir and announces its SHA-256 fingerprint in its beacons. A sender
+    checks the certificate a receiver presents against that fingerprint and
+    against the one pinned for the device ID the first time they talked
+    (pins.json), so another machine answering on a known device's address
+    is refused. Receivers tell TLS from plaintext by the first byte and
+    serve both on the same port unless required is set.
+
+    Only ECDHE with AES-GCM or ChaCha20-Poly1305 is offered. TLS 1.3 keeps
+    OpenSSL's default suites; peers that fall back to TLS 1.2 get AES-128
+    first. Payloads are written in 1 MiB blocks, so every record is
+    full-size, and record encryption moves into the kernel where Python
+    exposes kTLS.
+    """
+    CIPHERS = 'ECDHE+AESGCM+AES128:ECDHE+CHACHA20:ECDHE+AESGCM'
+    HANDSHAKE_TIMEOUT = 30
+    TLS_HANDSHAKE = 0x16  # Content type of the record a TLS client opens with
+    CERT_DAYS = 36500
+
+    enabled = False  # Encrypt what we send
+    required = False  # Refuse plaintext senders
+    lock = threading.Lock()
+    directory = None
+    fingerprint = None  # Ours, or None if no identity could be loaded or created
+    server_context = None
+    client_context = None
+    pins = {}  # device_id -> certificate fingerprint
+
+    @staticmethod
+    def configure(directory, enabled=False, required=False):
+        """Load (creating on first use) this device's identity from directory"""
+        with SecureTransport.lock:
+            SecureTransport.enabled = enabled
+            SecureTransport.required = required
+            if directory == SecureTransport.directory:
+                return
+            SecureTransport.directory = directory
+            SecureTransport.fingerprint = None
+            SecureTransport.server_context = SecureTransport.client_context = None
+            SecureTransport.pins = {}
+            key_path = os.path.join(directory, 'key.pem')
+            cert_path = os.path.join(directory, 'cert.pem')
+            try:
+                os.makedirs(directory, exist_ok=True)
+                if not (os.path.exists(key_path) and os.path.exists(cert_path)):
+                    SecureTransport._create_identity(key_path, cert_path)
+                SecureTransport.server_context, SecureTransport.client_context = \
+                    SecureTransport._contexts(key_path, cert_path)
+                with open(cert_path) as f:
+                    SecureTransport.fingerprint = hashlib.sha256(ssl.PEM_cert_to_DER_cert(f.read())).hexdigest()
+            except Exception as e:
+                print(f"Encryption unavailable: {e}")
+            try:
+                with open(os.path.join(directory, 'pins.json')) as f:
+                    SecureTransport.pins = json.load(f)
+            except FileNotFoundError:
+                pass
+            except (OSError, ValueError) as e:
+                print(f"Could not load pinned certificates: {e}")
+
+    @staticmethod
+    def _create_identity(key_path, cert_path):
+        """Write a self-signed key and certificate with cryptography, or the openssl CLI without it"""
+        try:
+            from cryptography import x509
+            from cryptography.hazmat.primitives import hashes, serialization
+            from cryptography.hazmat.primitives.asymmetric import ec
+            from cryptography.x509.oid import NameOID
+        except ImportError:
+            subprocess.run(['openssl', 'req', '-x509', '-newkey', 'ec', '-pkeyopt', 'ec_paramgen_curve:prime256v1',
+                            '-nodes', '-days', str(SecureTransport.CERT_DAYS), '-subj', '/CN=snapsend',
+                            '-keyout', key_path, '-out', cert_path], check=True, capture_output=True)
+            os.chmod(key_path, 0o600)
+            return
+        import datetime
+        key = ec.generate_private_key(ec.SECP256R1())
+        name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'snapsend')])
+        now = datetime.datetime.now(datetime.timezone.utc)
+        cert = (x509.CertificateBuilder().subject_name(name).issuer_name(name)
+                .public_key(key.public_key()).serial_number(x509.random_serial_number())
+                .not_valid_before(now).not_valid_after(now + datetime.timedelta(days=SecureTransport.CERT_DAYS))
+                .sign(key, hashes.SHA256()))
+        with os.fdopen(os.open(key_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb') as f:
+            f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                      serialization.NoEncryption()))
+        with open(cert_path, 'wb') as f:
+            f.write(cert.public_bytes(serialization.Encoding.PEM))
+
+    @staticmethod
+    def _contexts(key_path, cert_path):
+        server = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        server.load_cert_chain(cert_path, key_path)
+        server.num_tickets = 0  # A ticket arriving on a pooled connection would look like the peer closing it
+        client = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        client.check_hostname = False
+        client.verify_mode = ssl.CERT_NONE  # Self-signed; checked against the pins instead
+        for context in (server, client):
+            context.minimum_version = ssl.TLSVersion.TLSv1_2
+            context.set_ciphers(SecureTransport.CIPHERS)
+            context.options |= getattr(ssl, 'OP_ENABLE_KTLS', 0)
+        server.options |= ssl.OP_CIPHER_SERVER_PREFERENCE
+        return server, client
+
+    @staticmethod
+    def _save_pins():
+        temp_path = os.path.join(SecureTransport.directory, 'pins.json.tmp')
+        try:
+            with open(temp_path, 'w') as f:
+                json.dump(SecureTransport.pins, f, indent=1)
+            os.replace(temp_path, os.path.join(SecureTransport.directory, 'pins.json'))
+        except OSError as e:
+            print(f"Could not save pinned certificates: {e}")
+
+    @staticmethod
+    def forget_pins():
+        with SecureTransport.lock:
+            SecureTransport.pins = {}
+            if SecureTransport.directory:
+                SecureTransport._save_pins()
+
+    @staticmethod
+    def client(sock, ip):
+        """Run the TLS handshake on a connected socket and check the certificate ip presents.
+
+        Raises if it differs from the one
+        pinned for that device or the one the device announces. A device
+        seen for the first time is pinned.
+        """
+        if SecureTransport.client_context is None:
+            raise Exception("Encryption is on but this device has no TLS certificate")
+        sock = SecureTransport.client_context.wrap_socket(sock)
+        fingerprint = hashlib.sha256(sock.getpeercert(binary_form=True)).hexdigest()
+        device_id = PeerDirectory.device_for(ip)
+        announced = PeerDirectory.fingerprint_for(ip)
+        with SecureTransport.lock:
+            pinned = SecureTransport.pins.get(device_id) if device_id else None
+            problem = None
+            if pinned and fingerprint != pinned:
+                problem = "does not match the one pinned for that device"
+            elif announced and fingerprint != announced:
+                problem = "does not match the one the device announces"
+            elif device_id and not pinned and SecureTransport.directory:
+                SecureTransport.pins[device_id] = fingerprint
+                SecureTransport._save_pins()
+        if problem:
+            sock.close()
+            raise Exception(f"Certificate presented by {ip} {problem}")
+        return sock
+
+    @staticmethod
+    def accept(sock, timeout):
+        """Serve TLS on an accepted socket if the client opened with a handshake.
+
+        Returns the socket to use from now on, or None if the client closed
+        or sent nothing within timeout.
+        """
+        sock.settimeout(timeout)
+        try:
+            first = sock.recv(1, socket.MSG_PEEK)
+        except (socket.timeout, ConnectionResetError):
+            return None
+        finally:
+            sock.settimeout(None)
+        if not first:
+            return None
+        if first[0] != SecureTransport.TLS_HANDSHAKE or SecureTransport.server_context is None:
+            return sock
+        sock.settimeout(SecureTransport.HANDSHAKE_TIMEOUT)
+        sock = SecureTransport.server_context.wrap_socket(sock, server_side=True)
+        sock.settimeout(None)
+        return sock
+
+    @staticmethod
+    def refuses(sock):
+        """True if sock is plaintext and this device only accepts encrypted connections"""
+        return SecureTransport.required and not isinstance(sock, ssl.SSLSocket)
+
+
+class ConnectionPool:
+    """Pre-warmed transfer connections to peers the user is about to send to.
+
+    UploadScreen.set_device_info() calls warm() so the TCP connect has
+    already happened by the time a file is picked, and negotiate_stream()
+    takes a warm socket instead of dialing. Connections unused for
+    IDLE_TIMEOUT are closed; the receiver drops header-less connections
+    after StreamHeader.IDLE_TIMEOUT, which is longer.
+    """
+    SIZE = 2  # Matches TransferQueue's default per-peer limit
+    IDLE_TIMEOUT = 30
+    SWEEP_INTERVAL = 5
+
+    lock = threading.Lock()
+    idle = {}  # ip -> [(socket, opened_at)]
+    sweeping = False
+
+    @staticmethod
+    def warm(ip, count=SIZE):
+        threading.Thread(target=ConnectionPool._fill, args=(ip, count), daemon=True).start()
+
+    @staticmethod
+    def _fill(ip, count):
+        with ConnectionPool.lock:
+            missing = count - len(ConnectionPool.idle.get(ip, []))
+        for _ in range(missing):
+            try:
+                sock = FileTransferManager.open_connection(ip)
+            except Exception as e:  # Includes a certificate that fails its pin
+                print(f"Could not pre-connect to {ip}: {e}")
+                return
+            with ConnectionPool.lock:
+                ConnectionPool.idle.setdefault(ip, []).append((sock, time.time()))
+                start_sweeper = not ConnectionPool.sweeping
+                ConnectionPool.sweeping = True
+            if start_sweeper:
+                threading.Thread(target=ConnectionPool._sweep, daemon=True).start()
+
+    @staticmethod
+    def take(ip):
+        """A live warm socket to ip, or None.
+
+        Sockets opened before encryption was turned on or off are dropped.
+        """
+        while True:
+            with ConnectionPool.lock:
+                entries = ConnectionPool.idle.get(ip)
+                if not entries:
+                    return None
+                sock, opened_at = entries.pop()
+            # An idle connection has nothing to read unless the peer closed it
+            if (time.time() - opened_at < ConnectionPool.IDLE_TIMEOUT
+                    and isinstance(sock, ssl.SSLSocket) == SecureTransport.enabled
+                    and not select.select([sock], [], [], 0)[0]):
+                return sock
+            sock.close()
+
+    @staticmethod
+    def _sweep():
+        while True:
+            time.sleep(ConnectionPool.SWEEP_INTERVAL)
+            expired = []
+            now = time.time()
+            with ConnectionPool.lock:
+                for ip, entries in list(ConnectionPool.idle.items()):
+                    expired += [sock for sock, opened_at in entries if now - opened_at >= ConnectionPool.IDLE_TIMEOUT]
+                    entries[:] = [entry for entry in entries if now - entry[1] < ConnectionPool.IDLE_TIMEOUT]
+                    if not entries:
+                        del ConnectionPool.idle[ip]
+                if not ConnectionPool.idle:
+                    ConnectionPool.sweeping = False
+            for sock in expired:
+                sock.close()
+            if not ConnectionPool.sweeping:
+                return
+
+
+class Snippets:
+    """Text such as a link or the clipboard, delivered in one datagram instead of a transfer.
+
+    A snippet is a single datagram to PORT: HEADER (magic, TEXT, message
+    ID) and up to MAX_SIZE bytes of UTF-8. The receiver acknowledges every
+    copy with an ACK datagram carrying the ID and shows each ID once, so
+    the sender can resend after each of RETRY_DELAYS without duplicates.
+    If no ACK arrives, or when encrypting, the text goes over a transfer
+    connection (a pre-warmed one if there is one) as kind 'text' instead.
+    """
+    PORT = 32771
+    MAGIC = b'SNPT'
+    HEADER = struct.Struct('!4sB8s')
+    TEXT = 0
+    ACK = 1
+    MAX_SIZE = 8192  # Bigger than one MTU, so some snippets travel as IP fragments; fine on a LAN
+    RETRY_DELAYS = (0.05, 0.1, 0.2, 0.4, 0.8)
+    REMEMBERED = 256  # Message IDs kept to drop retransmitted copies
+
+    on_receive = None  # Called with (text, ip) for every new snippet
+    lock = threading.Lock()
+    seen = OrderedDict()  # (ip, message ID) -> None
+
+    @staticmethod
+    def send(ip, text):
+        """Deliver text to ip; returns the transport that did, or raises"""
+        data = text.encode()
+        if not data:
+            raise Exception("Nothing to send")
+        if len(data) > Snippets.MAX_SIZE:
+            raise Exception(f"Text is over {Snippets.MAX_SIZE // 1024} KB, send it as a file")
+        message_id = os.urandom(8)
+        started = time.perf_counter()
+        transport = 'tcp'
+        if SecureTransport.enabled or not Snippets._send_datagram(ip, message_id, data):
+            Snippets._send_stream(ip, message_id, data)
+        else:
+            transport = 'udp'
+        Metrics.inc('snapsend_snippets_sent_total', transport=transport)
+        Metrics.observe('snapsend_snippet_latency_seconds', time.perf_counter() - started, Metrics.LATENCY_BUCKETS,
+                        transport=transport)
+        return transport
+
+    @staticmethod
+    def _send_datagram(ip, message_id, data):
+        """True once ip acknowledges the snippet, False if it never does"""
+        packet = Snippets.HEADER.pack(Snippets.MAGIC, Snippets.TEXT, message_id) + data
+        ack = Snippets.HEADER.pack(Snippets.MAGIC, Snippets.ACK, message_id)
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            try:
+                # Connected, so only ip's replies arrive and a port unreachable is reported at once
+                sock.connect((ip, Snippets.PORT))
+                for delay in Snippets.RETRY_DELAYS:
+                    sock.send(packet)
+                    deadline = time.perf_counter() + delay
+                    while time.perf_counter() < deadline:
+                        sock.settimeout(max(deadline - time.perf_counter(), 0.001))
+                        try:
+                            if sock.recv(64) == ack:
+                                return True
+                        except socket.timeout:
+                            break
+            except OSError as e:  # Most often an older SnapSend with no snippet listener
+                print(f"Snippet datagram to {ip} failed: {e}")
+        return False
+
+    @staticmethod
+    def _send_stream(ip, message_id, data):
+        sock = ConnectionPool.take(ip) or FileTransferManager.open_connection(ip)
+        try:
+            sock.settimeout(30)
+            sock.sendall(StreamHeader.pack('snippet', len(data), options={'kind': 'text', 'id': message_id.hex()})
+                         + data)
+            status, info = StreamHeader.read_reply(sock)
+            if status != StreamHeader.ACCEPT:
+                raise Exception(info.get('error', "Receiver refused the text"))
+        finally:
+            sock.close()
+
+    @staticmethod
+    def listen():
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('', Snippets.PORT))
+        while True:
+            try:
+                packet, addr = sock.recvfrom(Snippets.HEADER.size + Snippets.MAX_SIZE)
+                if len(packet) < Snippets.HEADER.size:
+                    continue
+                magic, kind, message_id = Snippets.HEADER.unpack_from(packet)
+                if magic != Snippets.MAGIC or kind != Snippets.TEXT:
+                    continue
+                if SecureTransport.required:
+                    print(f"Refused unencrypted snippet from {addr[0]}")
+                    continue  # Unacknowledged, so an encrypting sender would not have used this path anyway
+                text = packet[Snippets.HEADER.size:].decode()
+                sock.sendto(Snippets.HEADER.pack(Snippets.MAGIC, Snippets.ACK, message_id), addr)
+                Snippets.deliver(text, addr[0], message_id)
+            except Exception as e:
+                print("Snippet listen error:", e)
+
+    @staticmethod
+    def receive_stream(sock, header, ip):
+        """Serve a kind 'text' connection, which a sender uses when the datagram path failed"""
+        try:
+            if header['size'] > Snippets.MAX_SIZE:
+                StreamHeader.reply(sock, header, StreamHeader.REJECT, error="Text too long")
+                return
+            data = recv_exact(sock, header['size'])
+            if len(data) < header['size']:
+                raise Exception("Connection closed during text")
+            StreamHeader.reply(sock, header)
+            message_id = header['options'].get('id')
+            Snippets.deliver(data.decode(), ip, bytes.fromhex(message_id) if message_id else os.urandom(8))
+        except Exception as e:
+            print(f"Snippet from {ip} failed: {e}")
+        finally:
+            sock.close()
+
+    @staticmethod
+    def deliver(text, ip, message_id):
+        with Snippets.lock:
+            if (ip, message_id) in Snippets.seen:
+                return  # A retry whose first copy arrived, or the stream fallback of one
+            Snippets.seen[ip, message_id] = None
+            while len(Snippets.seen) > Snippets.REMEMBERED:
+                Snippets.seen.popitem(last=False)
+        Metrics.inc('snapsend_snippets_received_total')
+        print(f"Received {len(text)} characters of text from {ip}")
+        if Snippets.on_receive:
+            Snippets.on_receive(text, ip)
+
+
 class FileTransferManager:
+    limiter = BandwidthLimiter()
+    use_udp = False
+    udp_fec = False
+    dedup = True
+    multipath = False
+    sync_mirror_deletes = False
+    sync_checksum = False
+    verify_chunks = True
+    UDP_MIN_SIZE = 1048576
+    DEDUP_MIN_SIZE = 8 * 1048576  # Below this, hashing plus a wait for the reply costs more than sending
+    REPLY_TIMEOUT = 300
+    MULTIPATH_MIN_SIZE = 64 * 1048576
+
+    @staticmethod
+    def open_connection(target_ip, source_ip=None):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, LinkProfiles.buffer_size(target_ip))
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1048576)
+        sock.settimeout(30)
+        try:
+            if source_ip:
+                sock.bind((source_ip, 0))  # Leave through that interface
+            sock.connect((target_ip, 32769))
+            if SecureTransport.enabled:
+                sock = SecureTransport.client(sock, target_ip)
+        except Exception:
+            sock.close()
+            raise
+        return sock
+
+    @staticmethod
+    def start_stream(target_ip, name, size, kind=None, metrics=None, source_path=None):
+        """Connect and send the header; the payload may follow at once.
+
+        Call finish_stream() after the payload to collect the receiver's reply.
+        """
+        sock, reply = FileTransferManager.negotiate_stream(target_ip, name, size, kind, metrics=metrics,
+                                                           source_path=source_path)
+        return sock
+
+    @staticmethod
+    def negotiate_stream(target_ip, name, size, kind=None, transport=None, metrics=None, source_path=None,
+                         fingerprint=None, options=None, multipath=None, sparse=None):
+        """Connect and send a StreamHeader, stamped with source_path's mtime and mode.
+
+        Returns (socket, reply). reply is None when the payload can follow
+        straight away. Offering a transport or a content fingerprint sets
+        FLAG_WAIT and waits for the reply, which carries udp_port if the
+        receiver accepted UDP and have=True if it already holds the content.
+        Offering a multipath token waits too; the reply has multipath=True
+        if the receiver will take stripes. Offering sparse (the data byte
+        count) waits as well; the reply has sparse=True if the receiver
+        takes extents. options adds extra entries to the header options.
+        """
+        phase = metrics.phase if metrics else lambda name: NO_PHASE
+        mtime_ns = mode = 0
+        if source_path:
+            info = os.stat(source_path)
+            mtime_ns, mode = info.st_mtime_ns, stat.S_IMODE(info.st_mode)
+        options = dict(options or {}, kind=kind or 'file')
+        flags = 0
+        if transport:
+            options['transport'] = transport
+            flags |= StreamHeader.FLAG_WAIT
+        if fingerprint:
+            options['sha256'] = fingerprint
+            flags |= StreamHeader.FLAG_WAIT
+        if multipath:
+            options['multipath'] = multipath
+            flags |= StreamHeader.FLAG_WAIT
+        if sparse is not None:
+            options['sparse'] = sparse
+            flags |= StreamHeader.FLAG_WAIT
+        with phase('connect'):
+            sock = ConnectionPool.take(target_ip) or FileTransferManager.open_connection(target_ip)
+        try:
+            with phase('handshake'):
+                sock.sendall(StreamHeader.pack(name, size, mtime_ns, mode, flags, options))
+                reply = None
+                if flags & StreamHeader.FLAG_WAIT:
+                    # The receiver may have to hash a same-sized candidate first
+                    sock.settimeout(FileTransferManager.REPLY_TIMEOUT)
+                    reply = FileTransferManager.finish_stream(sock)
+                    sock.settimeout(30)
+        except Exception:
+            sock.close()
+            raise
+        return sock, reply
+
+    @staticmethod
+    def finish_stream(sock):
+        """Wait for the receiver's reply; returns its info or raises if it rejected the transfer"""
+        status, info = StreamHeader.read_reply(sock)
+        if status != StreamHeader.ACCEPT:
+            raise Exception(info.get('error', "Transfer rejected"))
+        return info
+
+    @staticmethod
+    def send_stream(target_ip, name, size, chunks, kind=None, progress_callback=None, file_path=None):
+        """Connect, handshake and stream chunks to a single target.
+
+        file_path is the file or folder being sent; its mtime and mode go
+        into the header. For a file with UDP mode enabled, the payload is
+        offered over UdpTransport first and streamed over TCP only if the
+        receiver declines or the UDP path fails; encrypted sends stay on
+        TCP, as the UDP path has no encryption. Large files carry their
+        SHA-256 so a receiver that already has them can skip the payload;
+        returns True when that happened. With multipath enabled, a large file
+        to a device announcing several addresses is striped across them. A
+        sparse file sends only its data extents. A file streamed over plain
+        TCP is verified with a ChunkTree if the receiver supports it.
+        """
+        extents = SparseFile.extents(file_path) if file_path and not kind else None
+        transport = 'udp' if (file_path and not kind and extents is None and FileTransferManager.use_udp
+                              and not SecureTransport.enabled
+                              and size >= FileTransferManager.UDP_MIN_SIZE
+                              and LinkProfiles.prefer_udp(target_ip)) else None
+        routes = token = None
+        if (file_path and not kind and not transport and extents is None and FileTransferManager.multipath
+                and size >= FileTransferManager.MULTIPATH_MIN_SIZE and LinkProfiles.prefer_multipath(target_ip)):
+            routes = Multipath.routes(target_ip)
+        token = uuid.uuid4().hex if routes and len(routes) > 1 else None
+        verify = bool(file_path and not kind and FileTransferManager.verify_chunks)
+        fec = bool(transport and FileTransferManager.udp_fec)
+        options = {}
+        if verify:
+            options['verify'] = True
+        if fec:
+            options['fec'] = True
+        metrics = TransferMetrics('send', target_ip, name, kind or 'file')
+        metrics.start_profiler()
+        try:
+            fingerprint = None
+            # Hashing a sparse file would read every hole the send itself skips
+            if (file_path and not kind and extents is None and FileTransferManager.dedup
+                    and size >= FileTransferManager.DEDUP_MIN_SIZE):
+                with metrics.phase('fingerprint'):
+                    fingerprint = ContentIndex.fingerprint(file_path)
+            sock, reply = FileTransferManager.negotiate_stream(target_ip, name, size, kind, transport, metrics,
+                                                               source_path=file_path, fingerprint=fingerprint,
+                                                               multipath=token, options=options,
+                                                               sparse=None if extents is None else SparseFile.data_size(extents))
+        except Exception as e:
+            metrics.finish(e)
+            raise
+        metrics.handshake_done()
+        metrics.sample_link(sock)
+        udp_port = reply.get('udp_port') if reply else None
+        try:
+            progress = TransferProgress(size, progress_callback, metrics)
+            if reply and reply.get('have'):
+                metrics.transport = 'dedup'
+                progress.finish()
+                metrics.finish()
+                return True
+            if udp_port:
+                metrics.transport = 'udp'
+                try:
+                    with metrics.phase('udp'):
+                        UdpTransport.send(sock, (target_ip, udp_port), file_path, size, progress,
+                                          fec=fec, peer=target_ip,
+                                          rtt=metrics.rtt or LinkProfiles.rtt(target_ip) or metrics.handshake,
+                                          start_rate=LinkProfiles.udp_start_rate(target_ip))
+                    LinkProfiles.udp_result(target_ip, True)
+                    progress.finish()
+                    metrics.finish()
+                    return False
+                except UdpFallback as e:
+                    print(f"UDP transfer to {target_ip} failed ({e}), falling back to TCP")
+                    LinkProfiles.udp_result(target_ip, False)
+                    sock.sendall(b'T')
+                    metrics.transport = 'tcp'
+                    metrics.retry()
+                    progress = TransferProgress(size, progress_callback, metrics)
+            if reply and reply.get('sparse'):
+                metrics.transport = 'sparse'
+                progress = TransferProgress(SparseFile.data_size(extents), progress_callback, metrics)
+                SparseFile.send(sock, target_ip, file_path, size, extents, progress, metrics)
+                progress.finish()
+                metrics.finish()
+                return False
+            if reply and reply.get('multipath'):
+                metrics.transport = 'multipath'
+                Multipath.send(sock, target_ip, routes, token, file_path, size, progress, metrics)
+                progress.finish()
+                metrics.finish()
+                return False
+            tree = ChunkTree() if verify else None
+            chunks = iter(chunks)
+            while True:
+                with metrics.phase('read'):
+                    data = next(chunks, None)
+                if data is None:
+                    break
+                if tree:
+                    with metrics.phase('hash'):
+                        tree.add(data)
+                with metrics.phase('send'):
+                    FileTransferManager.limiter.send(sock, target_ip, data)
+                progress.advance(len(data))
+            if reply is None:
+                with metrics.phase('reply'):
+                    reply = FileTransferManager.finish_stream(sock)
+            if tree:
+                with metrics.phase('verify'):
+                    leaves = tree.finish()
+                    if reply.get('verify'):
+                        resent = ChunkTree.send(sock, target_ip, file_path, size, leaves, metrics)
+                        if resent:
+                            print(f"Repaired {name} on {target_ip} by sending {resent} bytes again")
+            metrics.sample_link(sock, final=True)
+            progress.finish()
+            metrics.finish()
+            return False
+        except Exception as e:
+            metrics.finish(e)
+            raise
+        finally:
+            sock.close()
+
+    @staticmethod
+    def file_chunks(file_path, file_size, buffer_size=1048576, offset=0):
+        if PageCache.applies(file_size):
+            yield from PageCache.read(file_path, file_size, buffer_size, offset)
+            return
+        sent_size = offset
+        with open(file_path, 'rb') as f:
+            f.seek(offset)
+            while sent_size < file_size:
+                data = f.read(buffer_size)
+                if not data:
+                    break
+                sent_size += len(data)
+                yield data
+
+    @staticmethod
+    def open_source(path, scan=None):
+        """Describe what sending path involves.
+
+        Returns (name, size, kind, chunks) where chunks(offset=0) yields the
+        payload from the given byte offset, so a caller can restart a stream
+        part way through.
+        """
+        if isinstance(path, (list, tuple)):
+            entries, stream_size = scan or FolderStream.scan_batch(path)
+            return (f"{len(path)} items", stream_size, 'batch',
+                    lambda offset=0: FolderStream.iter_chunks(entries, offset=offset))
+        name = os.path.basename(os.path.normpath(path))
+        if os.path.isdir(path):
+            entries, stream_size = scan or FolderStream.scan(path)
+            return name, stream_size, 'folder', lambda offset=0: FolderStream.iter_chunks(entries, offset=offset)
+        file_size = os.path.getsize(path)
+        return name, file_size, None, lambda offset=0: FileTransferManager.file_chunks(path, file_size, offset=offset)
+
+    @staticmethod
+    def send_file(file_path, target_ip, progress_callback=None, completion_callback=None):
+        def send_thread():
+            try:
+                file_name, file_size, kind, chunks = FileTransferManager.open_source(file_path)
+                skipped = FileTransferManager.send_stream(
+                    target_ip, file_name, file_size, chunks(),
+                    progress_callback=progress_callback,
+                    file_path=file_path
+                )
+                message = "Already on the device" if skipped else "File sent successfully"
+                if completion_callback:
+                    Clock.schedule_once(lambda dt: completion_callback(True, message))
+
+            except Exception as e:
+                if completion_callback:
+                    Clock.schedule_once(lambda dt, err=str(e): completion_callback(False, err))
+
+        threading.Thread(target=send_thread, daemon=True).start()
+
+    @staticmethod
+    def send_folder(folder_path, target_ip, progress_callback=None, completion_callback=None, scan=None):
+        """Stream a folder entry by entry so the receiver can rebuild it as it arrives.
+
+        folder_path may also be a list of files and folders, sent together
+        as one batch. scan may hold a FolderStream.scan() or scan_batch()
+        result computed earlier so the tree is not walked twice.
+        """
+        def send_thread():
+            try:
+                folder_name, stream_size, kind, chunks = FileTransferManager.open_source(folder_path, scan)
+                FileTransferManager.send_stream(
+                    target_ip, folder_name, stream_size, chunks(),
+                    kind=kind,
+                    progress_callback=progress_callback,
+                    file_path=None if kind == 'batch' else folder_path
+                )
+                message = f"{folder_name} sent successfully" if kind == 'batch' else "Folder sent successfully"
+                if completion_callback:
+                    Clock.schedule_once(lambda dt: completion_callback(True, message))
+
+            except Exception as e:
+                if completion_callback:
+                    Clock.schedule_once(lambda dt, err=str(e): completion_callback(False, err))
+
+        threading.Thread(target=send_thread, daemon=True).start()
+
+    @staticmethod
+    def send_sync(folder_path, target_ips, progress_callback=None, completion_callback=None,
+                  target_callback=None, prepared=None):
+        """Bring each target's copy of folder_path up to date, sending only new and changed files.
+
+        The tree is scanned once, or not at all when prepared (a
+        FolderSync.prepare result) is given; every target then gets its own
+        delta. Callbacks match send_fanout.
+        """
+        def sync_target(ip, prepared):
+            try:
+                result = FolderSync.send(
+                    ip, folder_path, prepared,
+                    (lambda p, s, sp=0: progress_callback(ip, p, s, sp)) if progress_callback else None,
+                    FileTransferManager.sync_mirror_deletes
+                )
+                success = True
+                message = f"{result.get('written', 0)} updated, {result.get('deleted', 0)} deleted"
+            except Exception as e:
+                success, message = False, str(e)
+            if target_callback:
+                Clock.schedule_once(lambda dt: target_callback(ip, success, message))
+            return success, message
+
+        def send_thread():
+            try:
+                manifest = prepared or FolderSync.prepare(folder_path, FileTransferManager.sync_checksum)
+                with ThreadPoolExecutor(max_workers=len(target_ips)) as pool:
+                    results = list(pool.map(lambda ip: sync_target(ip, manifest), target_ips))
+                success = any(ok for ok, message in results)
+                message = results[0][1] if len(results) == 1 else ("Sync finished" if success else "Sync failed")
+                if completion_callback:
+                    Clock.schedule_once(lambda dt: completion_callback(success, message))
+            except Exception as e:
+                if completion_callback:
+                    Clock.schedule_once(lambda dt, err=str(e): completion_callback(False, err))
+
+        threading.Thread(target=send_thread, daemon=True).start()
+
+    @staticmethod
+    def send_fanout(path, target_ips, progress_callback=None, completion_callback=None,
+                    target_callback=None, scan=None):
+        """Send one file or folder to several targets, reading it only once.
+
+        progress_callback(ip, progress, speed_text, speed_value) and
+        target_callback(ip, success, message) report per target;
+        completion_callback(success, message) fires once all targets finish.
+        """
+        def send_thread():
+            try:
+                FanOutSender(path, target_ips, progress_callback, target_callback, scan).run()
+                if completion_callback:
+                    Clock.schedule_once(lambda dt: completion_callback(True, "Fan-out finished"))
+            except Exception as e:
+                if completion_callback:
+                    Clock.schedule_once(lambda dt, err=str(e): completion_callback(False, err))
+
+        threading.Thread(target=send_thread, daemon=True).start()
+
+
+    @staticmethod
+    def send_swarm(file_path, target_ips, progress_callback=None, completion_callback=None,
+                   target_callback=None):
+        """Distribute a file to several targets that also trade pieces among themselves.
+
+        The origin hashes the file into pieces and invites every target
+        with the manifest over the normal transfer port; from then on the
+        receivers fetch pieces rarest-first from each other as well as from
+        the origin. Callbacks match send_fanout.
+        """
+        def send_thread():
+            try:
+                manifest = SwarmManager.build_manifest(file_path, target_ips)
+                seed = SwarmSeed(manifest, file_path, target_callback, progress_callback)
+                SwarmManager.register(seed)
+                started = time.time()
+                payload = json.dumps(manifest).encode()
+                for ip in target_ips:
+                    try:
+                        sock = FileTransferManager.start_stream(ip, manifest['name'], len(payload), 'swarm')
+                        try:
+                            sock.sendall(payload)
+                            FileTransferManager.finish_stream(sock)
+                        finally:
+                            sock.close()
+                    except Exception as e:
+                        seed.finished[ip] = False
+                        if target_callback:
+                            Clock.schedule_once(lambda dt, ip=ip, err=str(e): target_callback(ip, False, err))
+                if not seed.wait(started):
+                    raise Exception("No target completed the swarm")
+                if completion_callback:
+                    Clock.schedule_once(lambda dt: completion_callback(True, "Swarm finished"))
+            except Exception as e:
+                if completion_callback:
+                    Clock.schedule_once(lambda dt, err=str(e): completion_callback(False, err))
+
+        threading.Thread(target=send_thread, daemon=True).start()
+
+class FanOutTarget:
+    def __init__(self, ip, max_lag_chunks):
+        self.ip = ip
+        self.sock = None
+        self.chunks = queue.Queue(maxsize=max_lag_chunks)
+        self.queued = 0  # bytes handed to this target by the shared reader
+        self.detached = False
+        self.error = None
+        self.thread = None
+        self.metrics = None
+
+
+class FanOutSender:
+    """Reads each chunk once and hands the same buffer to every target.
+
+    Every target has its own writer thread and a bounded queue. While all
+    targets keep up, the reader is paced by the fastest of them. A target
+    whose queue is full while another target still has room is at least
+    MAX_LAG_CHUNKS behind the leader. That target is detached: it drains
+    what it already has and then continues from its own file reader at its
+    current offset, so a slow receiver can never stall the fast ones.
+    """
+    MAX_LAG_CHUNKS = 8
+    PUT_TIMEOUT = 0.05
+
+    def __init__(self, path, target_ips, progress_callback=None, target_callback=None, scan=None):
+        self.path = path
+        self.name, self.size, self.kind, self.chunks = FileTransferManager.open_source(path, scan)
+        self.targets = [FanOutTarget(ip, self.MAX_LAG_CHUNKS) for ip in target_ips]
+        self.progress_callback = progress_callback
+        self.target_callback = target_callback
+
+    def _report(self, target, success, message):
+        if self.target_callback:
+            Clock.schedule_once(lambda dt: self.target_callback(target.ip, success, message))
+
+    def _connect(self, target):
+        target.metrics = TransferMetrics('send', target.ip, self.name, self.kind or 'file', 'fanout')
+        try:
+            target.sock = FileTransferManager.start_stream(target.ip, self.name, self.size, self.kind, target.metrics,
+                                                           None if self.kind == 'batch' else self.path)
+            target.metrics.handshake_done()
+        except Exception as e:
+            target.error = str(e)
+            target.metrics.finish(e)
+            self._report(target, False, target.error)
+
+    def run(self):
+        connectors = [threading.Thread(target=self._connect, args=(target,), daemon=True) for target in self.targets]
+        for thread in connectors:
+            thread.start()
+        for thread in connectors:
+            thread.join()
+
+        attached = [target for target in self.targets if target.sock]
+        if not attached:
+            raise Exception("Could not connect to any target")
+        for target in attached:
+            target.thread = threading.Thread(target=self._write_target, args=(target,), daemon=True)
+            target.thread.start()
+
+        for data in self.chunks():
+            for target in list(attached):
+                if not self._hand_over(target, data, attached):
+                    attached.remove(target)
+            if not attached:
+                break
+        for target in attached:
+            target.chunks.put(None)  # End of stream
+
+        for target in self.targets:
+            if target.thread:
+                target.thread.join()
+        if all(target.error for target in self.targets):
+            raise Exception("All targets failed")
+
+    def _hand_over(self, target, data, attached):
+        """Queue data for target; returns False once the target is detached or failed"""
+        while True:
+            if target.error:
+                return False
+            try:
+                target.chunks.put(data, timeout=self.PUT_TIMEOUT)
+                target.queued += len(data)
+                return True
+            except queue.Full:
+                lagging = any(other.chunks.qsize() < self.MAX_LAG_CHUNKS
+                              for other in attached if other is not target)
+                if lagging:
+                    target.detached = True
+                    return False
+
+    def _write_target(self, target):
+        limiter = FileTransferManager.limiter
+        progress = TransferProgress(
+            self.size,
+            (lambda p, s, sp=0: self.progress_callback(target.ip, p, s, sp)) if self.progress_callback else None,
+            target.metrics
+        )
+        target.metrics.start_profiler()
+        try:
+            while True:
+                try:
+                    data = target.chunks.get(timeout=0.1)
+                except queue.Empty:
+                    # Nothing is queued after detached is set, so an empty
+                    # queue at that point means the shared part is drained
+                    if target.detached and target.chunks.empty():
+                        break
+                    continue
+                if data is None:
+                    break
+                with progress.phase('send'):
+                    limiter.send(target.sock, target.ip, data)
+                progress.advance(len(data))
+
+            if target.detached:
+                print(f"Fan-out: {target.ip} fell behind, continuing with its own reader")
+                chunks = self.chunks(target.queued)
+                while True:
+                    with progress.phase('read'):
+                        data = next(chunks, None)
+                    if data is None:
+                        break
+                    with progress.phase('send'):
+                        limiter.send(target.sock, target.ip, data)
+                    progress.advance(len(data))
+            with progress.phase('reply'):
+                FileTransferManager.finish_stream(target.sock)
+            progress.finish()
+            target.metrics.finish()
+            self._report(target, True, "Sent")
+        except Exception as e:
+            target.error = str(e)
+            target.metrics.finish(e)
+            self._report(target, False, target.error)
+        finally:
+            target.sock.close()
+
+
+class SwarmSession:
+    """State shared by the origin and the receivers of one swarm.
+
+    The file is split into fixed-size pieces listed in the manifest with
+    their SHA-256 hashes. Every participant serves the pieces it holds and
+    announces its bitfield to the others over the discovery port.
+    """
+
+    def __init__(self, manifest, path, origin, self_ip, complete):
+        self.manifest = manifest
+        self.swarm_id = manifest['id']
+        self.path = path
+        self.origin = origin
+        self.size = manifest['size']
+        self.piece_size = manifest['piece_size']
+        self.piece_count = len(manifest['hashes'])
+        self.peers = [ip for ip in manifest['peers'] + [origin] if ip and ip != self_ip]
+        self.lock = threading.Lock()
+        fill = 0xff if complete else 0
+        self.have = bytearray([fill]) * ((self.piece_count + 7) // 8)
+        self.have_count = self.piece_count if complete else 0
+        self.peer_haves = {}
+        self.peer_seen = {}
+        self.active = True
+
     @staticmethod
-    def create_zip_from_folder(folder_path):
-        temp_zip = tempfile.NamedTemporaryFile(delete=False, suffix='.zip')
-        temp_zip.close()
-        with zipfile.ZipFile(temp_zip.name, 'w', zipfile.ZIP_STORED) as zipf:
-            for root, dirs, files in os.walk(folder_path):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    arcname = os.path.relpath(file_path, folder_path)
-                    zipf.write(file_path, arcname)
-        return temp_zip.name
+    def has_bit(bitfield, index):
+        return bool(bitfield[index >> 3] & (0x80 >> (index & 7)))
 
     @staticmethod
-    def send_file(file_path, target_ip, progress_callback=None, completion_callback=None):
-        def send_thread():
-            try:
-                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-                sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1048576)
-                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1048576)
-                sock.settimeout(30)
-                sock.connect((target_ip, 32769))
-                
-                file_size = os.path.getsize(file_path)
-                file_name = os.path.basename(file_path)
-                file_info = f"{file_name}|{file_size}".encode()
-                sock.send(file_info)
-                
-                ack = sock.recv(3)
-                if ack != b'ACK':
-                    raise Exception("No acknowledgment received")
-                
-                sent_size = 0
-                start_time = time.time()
-                last_update = start_time
-                buffer_size = 1048576
-                
-                # Speed calculation variables
-                speed_history = deque(maxlen=10)  # Keep last 10 measurements for smoothing
-                
-                with open(file_path, 'rb') as f:
-                    while sent_size < file_size:
-                        chunk_start_time = time.time()
-                        data = f.read(buffer_size)
-                        if not data:
-                            break
-                            
-                        bytes_sent = 0
-                        while bytes_sent < len(data):
-                            n = sock.send(data[bytes_sent:])
-                            if n == 0:
-                                raise Exception("Connection broken")
-                            bytes_sent += n
-                            
-                        sent_size += len(data)
-                        current_time = time.time()
-                        
-                        # Calculate instantaneous speed
-                        chunk_time = current_time - chunk_start_time
-                        if chunk_time > 0:
-                            chunk_speed = len(data) / chunk_time / (1024 * 1024)  # MB/s
-                            speed_history.append(chunk_speed)
-                        
-                        if current_time - last_update >= 0.1:  # Update every 100ms
-                            progress = (sent_size / file_size) * 100
-                            
-                            # Calculate average speed from recent measurements
-                            if speed_history:
-                                avg_speed = sum(speed_history) / len(speed_history)
-                                speed_text = f"{avg_speed:.1f} MB/s"
-                            else:
-                                avg_speed = 0
-                                speed_text = "0 MB/s"
-                            
-                            if progress_callback:
-                                Clock.schedule_once(
-                                    lambda dt, p=progress, s=speed_text, sp=avg_speed: 
-                                    progress_callback(p, s, sp)
-                                )
-                            last_update = current_time
-                
-                # Final update
-                if progress_callback:
-                    elapsed_time = time.time() - start_time
-                    if elapsed_time > 0:
-                        final_speed = file_size / elapsed_time / (1024 * 1024)
-                        speed_text = f"{final_speed:.1f} MB/s"
+    def count_bits(bitfield):
+        return sum(bin(byte).count('1') for byte in bitfield)
+
+    @property
+    def complete(self):
+        return self.have_count >= self.piece_count
+
+    def piece_range(self, index):
+        offset = index * self.piece_size
+        return offset, min(self.piece_size, self.size - offset)
+
+    def read_piece(self, index):
+        if not self.has_bit(self.have, index):
+            return None
+        offset, length = self.piece_range(index)
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            return f.read(length)
+
+    def on_peer_have(self, ip, bitfield):
+        with self.lock:
+            self.peer_haves[ip] = bitfield
+            self.peer_seen[ip] = time.time()
+
+    def peer_complete(self, ip):
+        bitfield = self.peer_haves.get(ip)
+        return bitfield is not None and self.count_bits(bitfield) >= self.piece_count
+
+
+class SwarmSeed(SwarmSession):
+    """The origin side: holds every piece and tracks each receiver's progress"""
+    STALL_TIMEOUT = 60
+
+    def __init__(self, manifest, path, target_callback=None, progress_callback=None):
+        super().__init__(manifest, path, None, None, complete=True)
+        self.target_callback = target_callback
+        self.progress_callback = progress_callback
+        self.finished = {}
+
+    def on_peer_have(self, ip, bitfield):
+        super().on_peer_have(ip, bitfield)
+        if ip in self.finished or ip not in self.peers:
+            return
+        progress = self.count_bits(bitfield) / self.piece_count * 100
+        if self.progress_callback:
+            Clock.schedule_once(lambda dt: self.progress_callback(ip, progress, "Swarming", 0))
+        if progress >= 100:
+            self.finished[ip] = True
+            if self.target_callback:
+                Clock.schedule_once(lambda dt: self.target_callback(ip, True, "Received"))
+
+    def wait(self, started):
+        """Block until every receiver has the whole file or went quiet"""
+        while len(self.finished) < len(self.peers):
+            time.sleep(0.5)
+            now = time.time()
+            for ip in self.peers:
+                last_seen = self.peer_seen.get(ip, started)
+                if ip not in self.finished and now - last_seen > self.STALL_TIMEOUT:
+                    self.finished[ip] = False
+                    if self.target_callback:
+                        Clock.schedule_once(lambda dt, ip=ip: self.target_callback(ip, False, "Stalled"))
+        self.active = False
+        return any(self.finished.values())
+
+
+class SwarmDownload(SwarmSession):
+    """The receiver side: fetches pieces rarest-first from the origin and other receivers"""
+    WORKERS = 4
+    MAX_REQUESTS_PER_PEER = 2
+    MAX_ORIGIN_FAILURES = 3
+    LINGER = 120
+
+    def __init__(self, manifest, downloads_path, origin, self_ip, progress=None, completion_callback=None):
+        self.final_path = os.path.join(downloads_path, os.path.basename(manifest['name']))
+        partial_path = os.path.join(downloads_path, f".{os.path.basename(manifest['name'])}.{uuid.uuid4().hex[:8]}"
+                                                    ".snapsend-partial")
+        super().__init__(manifest, partial_path, origin, self_ip, complete=False)
+        self.progress = progress
+        self.completion_callback = completion_callback
+        self.in_flight = set()
+        self.peer_load = Counter()
+        self.availability = [0] * self.piece_count
+        self.file = open(partial_path, 'w+b')
+        self.file.truncate(self.size)
+        self.write_lock = threading.Lock()
+        self.origin_failures = 0
+        self.failed = None
+
+    def on_peer_have(self, ip, bitfield):
+        with self.lock:
+            self._update_availability(self.peer_haves.get(ip), bitfield)
+            self.peer_haves[ip] = bitfield
+            self.peer_seen[ip] = time.time()
+
+    def _forget_peer(self, ip):
+        with self.lock:
+            bitfield = self.peer_haves.pop(ip, None)
+            if bitfield is not None:
+                self._update_availability(bitfield, bytearray(len(bitfield)))
+
+    def _update_availability(self, old, new):
+        # Only walk the bytes that changed; announcements repeat every second
+        old = old or bytearray(len(new))
+        for byte_index, (was, now) in enumerate(zip(old, new)):
+            if was == now:
+                continue
+            for bit in range(8):
+                index = (byte_index << 3) + bit
+                mask = 0x80 >> bit
+                if index < self.piece_count and (was & mask) != (now & mask):
+                    self.availability[index] += 1 if now & mask else -1
+
+    def _pick_piece(self):
+        """Choose the rarest missing piece and the least busy peer holding it"""
+        with self.lock:
+            candidates = [index for index in range(self.piece_count)
+                          if index not in self.in_flight and not self.has_bit(self.have, index)]
+            if not candidates:
+                return None
+            rarest = min(self.availability[index] for index in candidates)
+            index = random.choice([i for i in candidates if self.availability[i] == rarest])
+            holders = [ip for ip, bitfield in self.peer_haves.items()
+                       if ip != self.origin and self.has_bit(bitfield, index)
+                       and self.peer_load[ip] < self.MAX_REQUESTS_PER_PEER]
+            source = min(holders, key=lambda ip: self.peer_load[ip]) if holders else self.origin
+            self.in_flight.add(index)
+            self.peer_load[source] += 1
+            return index, source
+
+    def run(self):
+        workers = [threading.Thread(target=self._fetch_loop, daemon=True) for _ in range(self.WORKERS)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.file.close()
+        if self.failed:
+            self.active = False
+            os.unlink(self.path)
+            raise Exception(self.failed)
+
+        final_path = self.final_path
+        os.replace(self.path, final_path)
+        self.path = final_path
+        if self.completion_callback:
+            self.completion_callback(final_path)
+        # Tell everyone right away; if this was the last receiver the
+        # linger loop below ends before the next periodic announcement
+        SwarmManager.announce(self)
+
+        # Keep seeding for the other receivers for a while
+        finished_at = time.time()
+        while time.time() - finished_at < self.LINGER:
+            if all(self.peer_complete(ip) for ip in self.peers if ip != self.origin):
+                break
+            time.sleep(1)
+        self.active = False
+
+    def _fetch_loop(self):
+        connections = {}
+        try:
+            while not self.complete and not self.failed:
+                choice = self._pick_piece()
+                if choice is None:
+                    time.sleep(0.1)
+                    continue
+                index, source = choice
+                phase = self.progress.phase if self.progress else lambda name: NO_PHASE
+                try:
+                    with phase('recv'):
+                        data = self._request_piece(connections, source, index)
+                    with phase('verify'):
+                        if hashlib.sha256(data).hexdigest() != self.manifest['hashes'][index]:
+                            raise Exception(f"Piece {index} from {source} failed verification")
+                    offset, length = self.piece_range(index)
+                    with phase('write'), self.write_lock:
+                        self.file.seek(offset)
+                        self.file.write(data)
+                    with self.lock:
+                        self.have[index >> 3] |= 0x80 >> (index & 7)
+                        self.have_count += 1
+                        if self.progress:
+                            self.progress.advance(length)
+                    if source == self.origin:
+                        self.origin_failures = 0
+                except Exception as e:
+                    print(f"Swarm: {e}")
+                    if self.progress and self.progress.metrics:
+                        self.progress.metrics.retry()
+                    sock = connections.pop(source, None)
+                    if sock:
+                        sock.close()
+                    if source == self.origin:
+                        self.origin_failures += 1
+                        if self.origin_failures >= self.MAX_ORIGIN_FAILURES:
+                            self.failed = f"Lost connection to {source}: {e}"
                     else:
-                        final_speed = 0
-                        speed_text = "0 MB/s"
-                    Clock.schedule_once(lambda dt: progress_callback(100, speed_text, final_speed))
-                
+                        # Wait for its next announcement before using it again
+                        self._forget_peer(source)
+                finally:
+                    with self.lock:
+                        self.in_flight.discard(index)
+                        self.peer_load[source] -= 1
+        finally:
+            for sock in connections.values():
                 sock.close()
-                
-                # Clean up temporary zip files
-                if file_path.endswith('.zip') and 'temp' in file_path:
-                    try:
-                        os.unlink(file_path)
-                    except:
-                        pass
-                        
-                if completion_callback:
-                    Clock.schedule_once(lambda dt: completion_callback(True, "File sent successfully"))
-                    
+
+    def _request_piece(self, connections, source, index):
+        sock = connections.get(source)
+        if sock is None:
+            sock = socket.create_connection((source, SwarmManager.PORT), timeout=30)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if SecureTransport.enabled:
+                try:
+                    sock = SecureTransport.client(sock, source)
+                except Exception:
+                    sock.close()
+                    raise
+            connections[source] = sock
+        sock.sendall(SwarmManager.REQUEST.pack(bytes.fromhex(self.swarm_id), index))
+        status, length = SwarmManager.RESPONSE.unpack(recv_exact(sock, SwarmManager.RESPONSE.size))
+        if status != 0:
+            raise Exception(f"{source} does not have piece {index}")
+        if length != self.piece_range(index)[1]:
+            raise Exception(f"{source} sent {length} bytes for piece {index}")
+        data = bytearray()
+        limiter = FileTransferManager.limiter
+        while len(data) < length:
+            chunk = recv_exact(sock, min(limiter.chunk_size(1048576), length - len(data)))
+            if not chunk:
+                raise Exception("Connection closed")
+            limiter.throttle(source, len(chunk))
+            data += chunk
+        return bytes(data)
+
+
+class SwarmManager:
+    """Registry of active swarms, the piece server and HAVE announcements.
+
+    Pieces are served over TCP on PORT. Bitfields are announced as
+    'SWARM|<id>|<base64 bitfield>' datagrams to the discovery port of every
+    participant, and the discovery listener hands them back to on_datagram.
+    """
+    PORT = 32770
+    REQUEST = struct.Struct('!16sI')
+    RESPONSE = struct.Struct('!BI')
+    MIN_PIECE_SIZE = 4 * 1048576
+    MAX_PIECES = 8192  # Keeps a bitfield announcement within ~1.4 KB
+    MAX_MANIFEST = 1048576  # MAX_PIECES hex hashes plus the peer list fit with room to spare
+    ANNOUNCE_INTERVAL = 1.0
+
+    sessions = {}
+    _lock = threading.Lock()
+    _started = False
+
+    @staticmethod
+    def build_manifest(path, peers):
+        size = os.path.getsize(path)
+        piece_size = SwarmManager.MIN_PIECE_SIZE
+        while size > piece_size * SwarmManager.MAX_PIECES:
+            piece_size *= 2
+        hashes = []
+        with open(path, 'rb') as f:
+            while True:
+                piece = f.read(piece_size)
+                if not piece:
+                    break
+                hashes.append(hashlib.sha256(piece).hexdigest())
+        return {
+            'id': uuid.uuid4().hex,
+            'name': os.path.basename(path),
+            'size': size,
+            'piece_size': piece_size,
+            'hashes': hashes,
+            'peers': list(peers),
+        }
+
+    @staticmethod
+    def register(session):
+        with SwarmManager._lock:
+            SwarmManager.sessions[session.swarm_id] = session
+            if not SwarmManager._started:
+                SwarmManager._started = True
+                threading.Thread(target=SwarmManager._serve, daemon=True).start()
+                threading.Thread(target=SwarmManager._announce_loop, daemon=True).start()
+
+    @staticmethod
+    def on_datagram(message, addr):
+        try:
+            _, swarm_id, encoded = message.split('|', 2)
+            session = SwarmManager.sessions.get(swarm_id)
+            if session and session.active:
+                session.on_peer_have(addr[0], bytearray(base64.b64decode(encoded)))
+        except Exception as e:
+            print("Swarm announce error:", e)
+
+    @staticmethod
+    def _announce_loop():
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        while True:
+            for swarm_id, session in list(SwarmManager.sessions.items()):
+                if not session.active:
+                    SwarmManager.sessions.pop(swarm_id, None)
+                    continue
+                if isinstance(session, SwarmSeed):
+                    continue  # Receivers assume the origin holds everything
+                SwarmManager.announce(session, sock)
+            time.sleep(SwarmManager.ANNOUNCE_INTERVAL)
+
+    @staticmethod
+    def announce(session, sock=None):
+        """Send the session's bitfield to every participant"""
+        with session.lock:
+            message = f"SWARM|{session.swarm_id}|{base64.b64encode(bytes(session.have)).decode()}".encode()
+        own_sock = sock is None
+        if own_sock:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            for ip in session.peers:
+                try:
+                    sock.sendto(message, (ip, 32768))
+                except Exception as e:
+                    print("Swarm announce error:", e)
+        finally:
+            if own_sock:
+                sock.close()
+
+    @staticmethod
+    def _serve():
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind(('', SwarmManager.PORT))
+        server.listen(64)
+        while True:
+            try:
+                client_socket, addr = server.accept()
+                client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                threading.Thread(target=SwarmManager._serve_peer, args=(client_socket, addr), daemon=True).start()
             except Exception as e:
-                if completion_callback:
-                    Clock.schedule_once(lambda dt: completion_callback(False, str(e)))
-                    
-        threading.Thread(target=send_thread, daemon=True).start()
+                print("Swarm server error:", e)
+
+    @staticmethod
+    def _serve_peer(client_socket, addr):
+        try:
+            client_socket = SecureTransport.accept(client_socket, StreamHeader.IDLE_TIMEOUT) or client_socket
+            if SecureTransport.refuses(client_socket):
+                print(f"Refused unencrypted swarm peer {addr[0]}")
+                return
+            while True:
+                request = recv_exact(client_socket, SwarmManager.REQUEST.size)
+                if len(request) < SwarmManager.REQUEST.size:
+                    break
+                swarm_id, index = SwarmManager.REQUEST.unpack(request)
+                session = SwarmManager.sessions.get(swarm_id.hex())
+                data = session.read_piece(index) if session and index < session.piece_count else None
+                if data is None:
+                    client_socket.sendall(SwarmManager.RESPONSE.pack(1, 0))
+                    continue
+                client_socket.sendall(SwarmManager.RESPONSE.pack(0, len(data)))
+                FileTransferManager.limiter.send(client_socket, addr[0], data)
+        except Exception as e:
+            print("Swarm peer error:", e)
+        finally:
+            client_socket.close()
+
+
+class TransferJob:
+    """A queued send of one file or folder to one peer"""
+    PRIORITY_INTERACTIVE = 0
+    PRIORITY_NORMAL = 1
+    PRIORITY_BULK = 2
+
+    _next_id = 0
+
+    def __init__(self, path, targets, priority=None, swarm=False, sync=False):
+        TransferJob._next_id += 1
+        self.job_id = TransferJob._next_id
+        self.path = path  # A list of paths for a batch
+        self.is_batch = isinstance(path, list)
+        self.name = f"{len(path)} items" if self.is_batch else os.path.basename(os.path.normpath(path))
+        self.targets = list(targets)  # (device name, ip) pairs
+        self.target_status = {ip: "Queued" for name, ip in self.targets}
+        self.target_progress = {ip: 0 for name, ip in self.targets}
+        self.is_folder = not self.is_batch and os.path.isdir(path)
+        # Swarm mode only applies to single files sent to several targets
+        self.swarm = swarm and not self.is_folder and not self.is_batch and len(self.targets) > 1
+        # Sync mode only applies to folders
+        self.sync = sync and self.is_folder
+        self.priority = priority
+        self.size = None
+        self.file_count = None
+        self.scan = None
+        self.prepared = None  # FolderSync.prepare() result for sync jobs
+        self.state = 'scanning'
+        self.progress = 0
+        self.speed_text = "0 MB/s"
+        self.speed_value = 0
+        self.message = ""
+
+    @property
+    def finished(self):
+        return self.state in ('done', 'failed')
+
+    @property
+    def target_ips(self):
+        return [ip for name, ip in self.targets]
+
+    @property
+    def summary(self):
+        """'12 files, 3.4 MB' once the pre-scan has run"""
+        if self.size is None:
+            return ""
+        size = f"{self.size / 1073741824:.1f} GB" if self.size >= 1073741824 else f"{self.size / 1048576:.1f} MB"
+        if not (self.is_folder or self.is_batch):
+            return size
+        return f"{self.file_count} file{'s' if self.file_count != 1 else ''}, {size}"
+
+
+class TransferQueue:
+    """Schedules sends under global and per-peer concurrency limits.
+
+    Jobs are ordered by priority and then, with shortest_job_first, by size,
+    so a few documents dropped after a large ISO start in the next free slot
+    instead of competing with it. Scheduling state is only touched from the
+    Kivy main thread; transfer threads report back through Clock.
+    """
+    SMALL_JOB_BYTES = 8 * 1048576
+    BULK_JOB_BYTES = 1024 * 1048576
+
+    def __init__(self, max_active=3, max_per_peer=2, shortest_job_first=True):
+        self.max_active = max_active
+        self.max_per_peer = max_per_peer
+        self.shortest_job_first = shortest_job_first
+        self.jobs = []
+        self.listeners = []
+        # Coalesce scheduling to once per frame so a batch submitted together
+        # is ordered as a whole rather than first-come first-served
+        self._pump_trigger = Clock.create_trigger(lambda dt: self.pump())
+
+    def bind(self, listener):
+        """Register listener(job), called whenever a job changes state or progress"""
+        self.listeners.append(listener)
+
+    def _notify(self, job):
+        for listener in self.listeners:
+            listener(job)
+
+    def submit(self, path, targets, priority=None, swarm=False, sync=False):
+        """Queue path for targets, a list of (device name, ip) pairs.
+
+        With more than one target the job is sent as a single fan-out, so
+        the data is read from disk once for all of them, or as a swarm when
+        swarm is set and path is a file. With sync set, a folder only sends
+        what each target is missing. path may also be a list of files and
+        folders, which are sent together as one batch.
+        """
+        job = TransferJob(path, targets, priority, swarm, sync)
+        self.jobs.append(job)
+        if job.is_folder or job.is_batch:
+            # Walking a large tree can take a while, keep it off the UI thread
+            self._notify(job)
+            threading.Thread(target=self._scan_job, args=(job,), daemon=True).start()
+        else:
+            try:
+                job.size = os.path.getsize(path)
+                job.file_count = 1
+                self._job_ready(job, None)
+            except OSError as e:
+                self._job_ready(job, str(e))
+        return job
+
+    def _scan_job(self, job):
+        error = None
+        try:
+            if job.sync:
+                # The manifest is built here so the sync can start talking to targets at once
+                job.prepared = FolderSync.prepare(job.path, FileTransferManager.sync_checksum)
+                files = job.prepared[1]
+                job.size = sum(size for size, mtime_ns, path in files.values())
+                job.file_count = len(files)
+            else:
+                job.scan = FolderStream.scan_batch(job.path) if job.is_batch else FolderStream.scan(job.path)
+                job.size = job.scan[1]
+                job.file_count = sum(1 for entry in job.scan[0] if entry[0] == FolderStream.FILE)
+        except Exception as e:
+            error = str(e)
+        Clock.schedule_once(lambda dt: self._job_ready(job, error))
+
+    def _job_ready(self, job, error):
+        if error:
+            job.state = 'failed'
+            job.message = error
+        else:
+            if job.priority is None:
+                job.priority = self.default_priority(job.size)
+            job.state = 'queued'
+        self._notify(job)
+        self._pump_trigger()
+
+    def default_priority(self, size):
+        if size <= self.SMALL_JOB_BYTES:
+            return TransferJob.PRIORITY_INTERACTIVE
+        if size >= self.BULK_JOB_BYTES:
+            return TransferJob.PRIORITY_BULK
+        return TransferJob.PRIORITY_NORMAL
+
+    def _sort_key(self, job):
+        return (job.priority, job.size if self.shortest_job_first else 0, job.job_id)
+
+    def pump(self):
+        """Start as many queued jobs as the concurrency limits allow"""
+        running = [job for job in self.jobs if job.state == 'running']
+        per_peer = Counter(ip for job in running for ip in job.target_ips)
+        queued = sorted((job for job in self.jobs if job.state == 'queued'), key=self._sort_key)
+        for job in queued:
+            if len(running) >= self.max_active:
+                break
+            if any(per_peer[ip] >= self.max_per_peer for ip in job.target_ips):
+                continue
+            self._start(job)
+            running.append(job)
+            per_peer.update(job.target_ips)
+
+    def _start(self, job):
+        job.state = 'running'
+        for ip in job.target_ips:
+            job.target_status[ip] = "Connecting..."
+        self._notify(job)
+
+        def on_progress(progress, speed_text, speed_value=0):
+            job.progress = progress
+            job.speed_text = speed_text
+            job.speed_value = speed_value
+            self._notify(job)
+
+        def on_target_progress(ip, progress, speed_text, speed_value=0):
+            job.target_progress[ip] = progress
+            job.target_status[ip] = speed_text
+            job.progress = min(job.target_progress.values())
+            job.speed_value = speed_value
+            self._notify(job)
+
+        def on_target_complete(ip, success, message):
+            job.target_status[ip] = "Sent" if success else f"Failed: {message}"
+            if success:
+                job.target_progress[ip] = 100
+            self._notify(job)
+
+        def on_complete(success, message):
+            job.state = 'done' if success else 'failed'
+            job.message = message
+            if success:
+                job.progress = 100
+            job.speed_value = 0
+            self._notify(job)
+            self._pump_trigger()
+
+        if job.sync:
+            FileTransferManager.send_sync(job.path, job.target_ips, on_target_progress, on_complete,
+                                          on_target_complete, prepared=job.prepared)
+        elif job.swarm:
+            FileTransferManager.send_swarm(job.path, job.target_ips, on_target_progress, on_complete,
+                                           on_target_complete)
+        elif len(job.targets) > 1:
+            FileTransferManager.send_fanout(job.path, job.target_ips, on_target_progress, on_complete,
+                                            on_target_complete, scan=job.scan)
+        elif job.is_folder or job.is_batch:
+            FileTransferManager.send_folder(job.path, job.target_ips[0], on_progress, on_complete, scan=job.scan)
+        else:
+            FileTransferManager.send_file(job.path, job.target_ips[0], on_progress, on_complete)
+
+    @property
+    def active(self):
+        return any(not job.finished for job in self.jobs)
+
+    def clear_finished(self):
+        self.jobs = [job for job in self.jobs if not job.finished]
+
 
 class DeviceDiscoveryScreen(Screen):
     discovered_devices = ListProperty([])
@@ -234,17 +4442,26 @@ class DeviceDiscoveryScreen(Screen):
         threading.Thread(target=self.listen_for_devices, daemon=True).start()
         threading.Thread(target=self.broadcast_device_name, daemon=True).start()
         threading.Thread(target=self.listen_for_files, daemon=True).start()
+        Snippets.on_receive = lambda text, ip: Clock.schedule_once(lambda dt: self.app.show_snippet(text, ip))
+        threading.Thread(target=Snippets.listen, daemon=True).start()
         Clock.schedule_interval(self.check_device_timeouts, 2)
 
-    def add_device(self, name, ip):
+    def add_device(self, name, ip, device_id=None, fingerprint=None):
+        ip = PeerDirectory.seen(device_id or ip, ip, name, fingerprint)
+        if ip is None:
+            return
         entry = f"{name}|{ip}"
         if entry not in self.discovered_devices and entry not in self._device_cards:
             self.discovered_devices.append(entry)
-            Clock.schedule_once(lambda dt: self.update_ui(name, ip))
+            Metrics.set('snapsend_peers', len(self.discovered_devices))
+            Clock.schedule_once(lambda dt, queued_at=time.perf_counter(): self.update_ui(name, ip, queued_at))
         # Mark device as seen now
         self._last_seen[entry] = time.time()
 
-    def update_ui(self, name, ip):
+    def update_ui(self, name, ip, queued_at=None):
+        if queued_at is not None:
+            Metrics.observe('snapsend_device_card_lag_seconds', time.perf_counter() - queued_at,
+                            Metrics.LATENCY_BUCKETS)
         entry = f"{name}|{ip}"
         # Prevent duplicate cards in UI
         if entry not in self._device_cards:
@@ -261,24 +4478,21 @@ class DeviceDiscoveryScreen(Screen):
             self.ids.device_grid.remove_widget(card)
 
     def check_device_timeouts(self, dt):
+        started = time.perf_counter()
         now = time.time()
-        timeout = 6  # seconds
         for entry in list(self.discovered_devices):
-            if entry not in self._last_seen or now - self._last_seen[entry] > timeout:
+            if entry not in self._last_seen or now - self._last_seen[entry] > PeerDirectory.TIMEOUT:
                 self.remove_device(entry)
                 self._last_seen.pop(entry, None)
+                Metrics.inc('snapsend_peer_expirations_total')
+        Metrics.set('snapsend_peers', len(self.discovered_devices))
+        Metrics.observe('snapsend_device_sweep_seconds', time.perf_counter() - started, Metrics.PROCESSING_BUCKETS)
 
-    # (Remove this duplicate __init__ method entirely)
-
-    def get_local_ip(self):
-        try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            s.connect(("8.8.8.8", 80))
-            ip = s.getsockname()[0]
-            s.close()
-            return ip
-        except:
-            return "0.0.0.0"
+    def on_settings_button_touch(self, touch):
+        if self.ids.settings_button.collide_point(*touch.pos):
+            self.screen_manager.current = 'settings'
+            return True
+        return False
 
     def broadcast_device_name(self):
         # Try to get device name from environment or system
@@ -290,15 +4504,28 @@ class DeviceDiscoveryScreen(Screen):
                 name = "Unknown Device"
         except Exception:
             name = "Unknown Device"
-        ip = self.get_local_ip()
-        msg = f"{name}|{ip}".encode()
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        socks = {}  # One socket per interface address, so each beacon leaves through its own interface
         while True:
-            try:
-                sock.sendto(msg, ("<broadcast>", 32768))
-            except Exception as e:
-                print("Broadcast error:", e)
+            interfaces = NetworkInterfaces.list()
+            for ip in set(socks) - {interface[0] for interface in interfaces}:
+                socks.pop(ip).close()
+            for ip, netmask, broadcast in interfaces:
+                try:
+                    sock = socks.get(ip)
+                    if sock is None:
+                        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+                        sock.bind((ip, 0))
+                        socks[ip] = sock
+                    beacon = f"{name}|{ip}|{PeerDirectory.device_id}|{SecureTransport.fingerprint or ''}"
+                    sock.sendto(beacon.encode(), (broadcast, 32768))
+                    Metrics.inc('snapsend_beacons_sent_total')
+                except Exception as e:
+                    print(f"Broadcast error on {ip}:", e)
+                    Metrics.inc('snapsend_beacon_errors_total')
+                    sock = socks.pop(ip, None)
+                    if sock:
+                        sock.close()
             time.sleep(2)
 
     def listen_for_devices(self):
@@ -306,11 +4533,19 @@ class DeviceDiscoveryScreen(Screen):
         sock.bind(("", 32768))
         while True:
             try:
-                data, addr = sock.recvfrom(1024)
+                data, addr = sock.recvfrom(65535)
+                received_at = time.perf_counter()
                 decoded = data.decode()
-                if "|" in decoded:
-                    name, ip = decoded.split("|")
-                    self.add_device(name, ip)
+                if decoded.startswith("SWARM|"):
+                    SwarmManager.on_datagram(decoded, addr)
+                elif "|" in decoded:
+                    # name|ip, plus |device_id from builds that announce every interface
+                    # and |fingerprint from builds with encryption
+                    name, ip, *rest = decoded.split("|")
+                    Metrics.inc('snapsend_beacons_received_total')
+                    self.add_device(name, ip, rest[0] if rest else None, rest[1] if len(rest) > 1 else None)
+                    Metrics.observe('snapsend_beacon_processing_seconds', time.perf_counter() - received_at,
+                                    Metrics.PROCESSING_BUCKETS)
             except Exception as e:
                 print("Listen error:", e)
 
@@ -342,98 +4577,283 @@ class DeviceDiscoveryScreen(Screen):
             print("Listen server error:", e)
 
     def handle_file_reception(self, client_socket, addr, downloads_path):
+        metrics = None
         try:
-            file_info = client_socket.recv(1024).decode()
-            file_name = file_info.split('|')[0]
-            file_size = int(file_info.split('|')[1])
-            client_socket.send(b'ACK')
+            secure_socket = SecureTransport.accept(client_socket, StreamHeader.IDLE_TIMEOUT)
+            header = StreamHeader.read(secure_socket) if secure_socket else None
+            if header is None:
+                (secure_socket or client_socket).close()  # A pre-warmed connection that was never used
+                return
+            client_socket = secure_socket
+            if SecureTransport.refuses(client_socket):
+                error = "This device only accepts encrypted transfers"
+                StreamHeader.reply(client_socket, header, StreamHeader.REJECT, error=error)
+                raise Exception(f"Refused unencrypted transfer from {addr[0]}")
+            if header['options'].get('kind') == 'stripe':
+                Multipath.join(client_socket, header)
+                return
+            if header['options'].get('kind') == 'text':
+                Snippets.receive_stream(client_socket, header, addr[0])
+                return
+            metrics = TransferMetrics('receive', addr[0])
+            metrics.start_profiler()
+            file_name = StreamHeader.safe_name(header['name'])
+            file_size = header['size']
+            kind = header['options'].get('kind', 'file')
+            transport = header['options'].get('transport', 'tcp')
+            error = None
+            if not file_name:
+                error = f"Invalid name {header['name']!r}"
+            elif kind not in ('file', 'folder', 'batch', 'swarm', 'sync'):
+                error = f"Unsupported kind {kind!r}"
+            elif kind == 'swarm' and file_size > SwarmManager.MAX_MANIFEST:
+                error = "Swarm manifest too large"
+            elif kind == 'sync' and file_size > FolderSync.MAX_MANIFEST:
+                error = "Sync manifest too large"
+            if error:
+                StreamHeader.reply(client_socket, header, StreamHeader.REJECT, error=error)
+                raise Exception(error)
+            metrics.name, metrics.kind = file_name, kind
+
+            fingerprint = header['options'].get('sha256')
+            # Answering tells the sender whether the file is here, so only discovered devices get an answer
+            if fingerprint and kind == 'file' and FileTransferManager.dedup and PeerDirectory.device_for(addr[0]):
+                with metrics.phase('dedup'):
+                    existing = ContentIndex.find(downloads_path, file_size, fingerprint)
+                if existing:
+                    self.reuse_local_copy(client_socket, header, existing, os.path.join(downloads_path, file_name))
+                    metrics.transport = 'dedup'
+                    metrics.finish()
+                    return
+
+            # The reply goes out while the sender is already streaming
+            udp_sock = None
+            verify = False
+            multipath = header['options'].get('multipath') if kind == 'file' and transport == 'tcp' else None
+            sparse = header['options'].get('sparse') if kind == 'file' and transport == 'tcp' else None
+            if transport == 'udp' and kind == 'file':
+                udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                udp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 8 * 1048576)
+                udp_sock.bind(('', 0))
+                StreamHeader.reply(client_socket, header, udp_port=udp_sock.getsockname()[1])
+            elif sparse is not None:
+                StreamHeader.reply(client_socket, header, sparse=True)
+            elif not multipath:  # MultipathReceive accepts once the file is open
+                verify = kind == 'file' and bool(header['options'].get('verify'))
+                StreamHeader.reply(client_socket, header, verify=verify)
+            metrics.handshake_done()
+
+            if kind == 'swarm':
+                metrics.finish()  # The invitation itself; join_swarm tracks the download
+                self.join_swarm(client_socket, addr, downloads_path, file_size)
+                return
+            if kind == 'sync':
+                self.receive_sync(client_socket, addr, downloads_path, header, file_name, metrics)
+                return
             
             print(f"Receiving {file_name} ({file_size} bytes) from {addr[0]}")
             Clock.schedule_once(lambda dt: self.app.show_receiving_popup(file_name, addr[0]))
-            
-            file_path = os.path.join(downloads_path, file_name)
-            buffer_size = 1048576
-            received_size = 0
-            start_time = time.time()
-            last_update = start_time
-            
-            # Speed calculation variables
-            speed_history = deque(maxlen=10)
-            
-            with open(file_path, 'wb') as f:
-                while received_size < file_size:
-                    chunk_start_time = time.time()
-                    remaining = file_size - received_size
-                    chunk_size = min(buffer_size, remaining)
-                    data = b''
-                    
-                    while len(data) < chunk_size:
-                        packet = client_socket.recv(chunk_size - len(data))
-                        if not packet:
-                            break
-                        data += packet
-                        
-                    if not data:
-                        break
-                        
-                    f.write(data)
-                    received_size += len(data)
-                    current_time = time.time()
-                    
-                    # Calculate instantaneous speed
-                    chunk_time = current_time - chunk_start_time
-                    if chunk_time > 0:
-                        chunk_speed = len(data) / chunk_time / (1024 * 1024)  # MB/s
-                        speed_history.append(chunk_speed)
-                    
-                    if current_time - last_update >= 0.1:
-                        progress = (received_size / file_size) * 100
-                        
-                        # Calculate average speed
-                        if speed_history:
-                            avg_speed = sum(speed_history) / len(speed_history)
-                            speed_text = f"{avg_speed:.1f} MB/s"
-                        else:
-                            avg_speed = 0
-                            speed_text = "0 MB/s"
-                            
-                        Clock.schedule_once(
-                            lambda dt, p=progress, s=speed_text, sp=avg_speed: 
-                            self.app.update_receiving_progress(p, s, sp)
-                        )
-                        last_update = current_time
-            
-            # Final update
-            elapsed_time = time.time() - start_time
-            if elapsed_time > 0:
-                final_speed = (file_size / (1024 * 1024)) / elapsed_time
-                speed_text = f"{final_speed:.1f} MB/s"
+            progress = TransferProgress(file_size if sparse is None else sparse,
+                                        self.app.update_receiving_progress, metrics)
+
+            if kind in ('folder', 'batch'):
+                if kind == 'batch':
+                    writer = BatchStreamWriter(downloads_path)
+                else:
+                    writer = FolderStreamWriter(downloads_path, file_name)
+                try:
+                    writer.receive(client_socket, file_size, progress, addr[0])
+                    with metrics.phase('finalize'):
+                        final_path = writer.finish()
+                        if kind == 'folder':
+                            StreamHeader.apply_attributes(final_path, header, mode=False)
+                except Exception:
+                    writer.abort()
+                    raise
+                if kind == 'batch':
+                    message = f"{len(final_path)} items received successfully"
+                    print(f"Successfully received {len(final_path)} items into {downloads_path}")
+                else:
+                    message = "Folder received successfully"
+                    print(f"Successfully received folder {final_path}")
             else:
-                final_speed = 0
-                speed_text = "0 MB/s"
-                
-            Clock.schedule_once(lambda dt: self.app.update_receiving_progress(100, speed_text, final_speed))
-            print(f"Successfully received {file_name}")
-            Clock.schedule_once(lambda dt: self.app.close_receiving_popup(True, "File received successfully"))
+                file_path = os.path.join(downloads_path, file_name)
+                received = False
+                if udp_sock:
+                    metrics.transport = 'udp'
+                    try:
+                        with metrics.phase('udp'):
+                            received = UdpTransport.receive(client_socket, udp_sock, file_path, file_size, progress,
+                                                            addr[0], bool(header['options'].get('fec')))
+                    finally:
+                        udp_sock.close()
+                    if not received:
+                        print(f"Sender fell back to TCP for {file_name}")
+                        metrics.transport = 'tcp'
+                        metrics.retry()
+                        progress = TransferProgress(file_size, self.app.update_receiving_progress, metrics)
+                if sparse is not None:
+                    metrics.transport = 'sparse'
+                    SparseFile.receive(client_socket, file_path, file_size, progress, addr[0])
+                elif multipath:
+                    metrics.transport = 'multipath'
+                    with MultipathReceive(multipath, file_path, file_size, progress, addr[0]) as session:
+                        session.receive(client_socket, header)
+                elif not received:
+                    self.receive_file_data(client_socket, file_path, file_size, progress, addr[0],
+                                           header if verify else None)
+                StreamHeader.apply_attributes(file_path, header)
+                message = "File received successfully"
+                print(f"Successfully received {file_name}")
+
+            progress.finish()
+            metrics.finish()
+            Clock.schedule_once(lambda dt: self.app.close_receiving_popup(True, message))
             client_socket.close()
             
         except Exception as e:
             print(f"Error handling file reception: {e}")
-            Clock.schedule_once(lambda dt: self.app.close_receiving_popup(False, str(e)))
+            if metrics:
+                metrics.finish(e)
+            Clock.schedule_once(lambda dt, err=str(e): self.app.close_receiving_popup(False, err))
+            client_socket.close()
+
+    def receive_sync(self, client_socket, addr, downloads_path, header, folder_name, metrics):
+        print(f"Syncing {folder_name} from {addr[0]}")
+        Clock.schedule_once(lambda dt: self.app.show_receiving_popup(folder_name, f"{addr[0]} sync"))
+        try:
+            written, deleted = FolderSync.receive(client_socket, header, os.path.join(downloads_path, folder_name),
+                                                  self.app.update_receiving_progress, metrics, addr[0])
+        finally:
             client_socket.close()
+        metrics.finish()
+        message = f"Folder synced: {written} updated, {deleted} deleted"
+        print(message)
+        Clock.schedule_once(lambda dt: self.app.close_receiving_popup(True, message))
+
+    def reuse_local_copy(self, client_socket, header, existing, file_path):
+        """Complete a transfer from a file already in the downloads folder"""
+        StreamHeader.reply(client_socket, header, have=True)
+        client_socket.close()
+        if os.path.abspath(existing) != os.path.abspath(file_path):
+            shutil.copyfile(existing, file_path)
+        StreamHeader.apply_attributes(file_path, header)
+        print(f"Already had {os.path.basename(file_path)} as {existing}, skipped the transfer")
 
+    def join_swarm(self, client_socket, addr, downloads_path, manifest_size):
+        manifest = json.loads(recv_exact(client_socket, manifest_size))
+        self_ip = client_socket.getsockname()[0]
+        client_socket.close()
+        name = StreamHeader.safe_name(manifest['name'])
+        if not name:
+            raise Exception(f"Invalid name {manifest['name']!r} in swarm manifest")
+        manifest['name'] = name
 
+        print(f"Joining swarm for {name} ({manifest['size']} bytes) from {addr[0]}")
+        Clock.schedule_once(lambda dt: self.app.show_receiving_popup(name, f"{addr[0]} swarm"))
+        metrics = TransferMetrics('receive', addr[0], name, 'file', 'swarm')
+        progress = TransferProgress(manifest['size'], self.app.update_receiving_progress, metrics)
+
+        def on_complete(final_path):
+            progress.finish()
+            metrics.finish()
+            print(f"Successfully received {final_path}")
+            Clock.schedule_once(lambda dt: self.app.close_receiving_popup(True, "File received successfully"))
+
+        download = SwarmDownload(manifest, downloads_path, addr[0], self_ip, progress, on_complete)
+        SwarmManager.register(download)
+        try:
+            download.run()
+        except Exception as e:
+            print(f"Error handling swarm: {e}")
+            metrics.finish(e)
+            Clock.schedule_once(lambda dt, err=str(e): self.app.close_receiving_popup(False, err))
+
+    def receive_file_data(self, client_socket, file_path, file_size, progress, peer=None, verify=None):
+        """Write file_size bytes from client_socket to file_path.
+
+        verify is the transfer's header when the sender asked for chunk
+        verification; the file is then checked, and repaired, before returning.
+        """
+        limiter = FileTransferManager.limiter
+        received_size = 0
+        with open(file_path, 'wb') as f:
+            cache = DropBehind(f, writing=True) if PageCache.applies(file_size) else None
+            tree = ChunkTree() if verify else None
+            if Splice.usable(client_socket) and not tree:
+                received_size = Splice.receive(client_socket, f.fileno(), file_size, progress, peer, cache)
+            while received_size < file_size:
+                remaining = file_size - received_size
+                with progress.phase('recv'):
+                    data = recv_exact(client_socket, min(limiter.chunk_size(1048576), remaining))
+                if not data:
+                    break
+                with progress.phase('throttle'):
+                    limiter.throttle(peer, len(data))
+                if tree:
+                    tree.add(data)
+                with progress.phase('write'):
+                    f.write(data)
+                received_size += len(data)
+                progress.advance(len(data))
+                if cache:
+                    cache.advance(received_size)
+            if tree and received_size == file_size:
+                f.flush()  # Repairs are written with pwrite
+                with progress.phase('verify'):
+                    ChunkTree.receive(client_socket, verify, f, file_size, tree, peer)
+            if cache and received_size == file_size:
+                with progress.phase('write'):
+                    cache.finish()
+        if received_size < file_size:
+            raise Exception(f"Connection closed after {received_size} of {file_size} bytes")
+
+
+
+class TargetToggle(ToggleButton):
+    """Chip on the upload screen that adds another device to the send"""
+    device_name = StringProperty()
+    device_ip = StringProperty()
 
 class UploadScreen(Screen):
     device_name = StringProperty("")
     device_ip = StringProperty("")
-    sending_popup = None
+    queue_popup = None
+    picker_open = False
+    DROP_DEBOUNCE = 0.3  # Seconds to wait for more paths from the same drop
+    drop_trigger = None
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.dropped_paths = []
 
     def set_device_info(self, name, ip):
         self.device_name = name
         self.device_ip = ip
         self.ids.name_label.text = f"[b]{name}[/b]"
         self.ids.ip_label.text = ip
+        self.refresh_targets()
+        ConnectionPool.warm(ip)
+
+    def refresh_targets(self):
+        """Offer every other discovered device as an extra fan-out target"""
+        selected = {toggle.device_ip for toggle in self.ids.target_list.children if toggle.state == 'down'}
+        self.ids.target_list.clear_widgets()
+        for entry in self.manager.get_screen('devices').discovered_devices:
+            name, ip = entry.split('|')
+            if ip == self.device_ip:
+                continue
+            self.ids.target_list.add_widget(TargetToggle(
+                text=name, device_name=name, device_ip=ip,
+                state='down' if ip in selected else 'normal'
+            ))
+
+    def selected_targets(self):
+        targets = [(self.device_name, self.device_ip)]
+        for toggle in reversed(self.ids.target_list.children):
+            if toggle.state == 'down':
+                targets.append((toggle.device_name, toggle.device_ip))
+        return targets
 
     def go_to_devices(self):
         self.manager.current = 'devices'
@@ -444,105 +4864,279 @@ class UploadScreen(Screen):
             return True
         return False
 
+    def send_clipboard(self):
+        self.send_snippet(Clipboard.paste())
+
+    def send_snippet(self, text):
+        if not text or not self.device_ip:
+            return
+        self.ids.snippet_input.hint_text = "Sending..."
+        threading.Thread(target=self.run_snippet_send, args=(text, self.selected_targets()), daemon=True).start()
+
+    def run_snippet_send(self, text, targets):
+        results = []
+        for name, ip in targets:
+            started = time.perf_counter()
+            try:
+                Snippets.send(ip, text)
+                results.append(f"{name} ({(time.perf_counter() - started) * 1000:.0f} ms)")
+            except Exception as e:
+                print(f"Could not send text to {name}: {e}")
+                results.append(f"{name}: {e}")
+        Clock.schedule_once(lambda dt: self.on_snippet_sent(text, "Sent to " + ", ".join(results)))
+
+    def on_snippet_sent(self, text, status):
+        if self.ids.snippet_input.text == text:
+            self.ids.snippet_input.text = ""
+        self.ids.snippet_input.hint_text = status
+
     def on_touch_down(self, touch):
         if self.ids.upload_area.collide_point(*touch.pos):
             self.show_upload_dialog()
         return super().on_touch_down(touch)
 
     def on_drop_file(self, window, file_path, x, y):
-        file_path_str = file_path.decode('utf-8')
-        self.handle_file_selection([file_path_str])
+        # The window reports each dropped path separately; gather them into one selection
+        self.dropped_paths.append(file_path.decode('utf-8'))
+        if self.drop_trigger is None:
+            self.drop_trigger = Clock.create_trigger(self.flush_dropped_paths, self.DROP_DEBOUNCE)
+        self.drop_trigger.cancel()
+        self.drop_trigger()
+
+    def flush_dropped_paths(self, dt=None):
+        file_paths, self.dropped_paths = self.dropped_paths, []
+        self.handle_file_selection(file_paths)
 
     def show_upload_dialog(self):
-        root = tk.Tk()
-        root.withdraw()
-        file_paths = filedialog.askopenfilenames(title="Select Files", filetypes=[("All files", "*.*")])
-        if not file_paths:
-            folder_path = filedialog.askdirectory(title="Select Folder")
-            if folder_path:
-                file_paths = [folder_path]
-        root.destroy()
+        if self.picker_open:
+            return
+        self.picker_open = True
+        if sys.platform == 'darwin':
+            self.run_file_dialog()  # Tk only runs on the main thread on macOS
+        else:
+            # Keep the Kivy loop, and the progress of running transfers, moving while the dialog is up
+            threading.Thread(target=self.run_file_dialog, daemon=True).start()
+
+    def run_file_dialog(self):
+        file_paths = []
+        try:
+            root = tk.Tk()
+            try:
+                root.withdraw()
+                root.attributes('-topmost', True)  # The Kivy window no longer blocks, keep the dialog above it
+                file_paths = filedialog.askopenfilenames(parent=root, title="Select Files",
+                                                         filetypes=[("All files", "*.*")])
+                if not file_paths:
+                    folder_path = filedialog.askdirectory(parent=root, title="Select Folder")
+                    if folder_path:
+                        file_paths = [folder_path]
+            finally:
+                root.destroy()
+        except Exception as e:
+            print("File dialog error:", e)
+        Clock.schedule_once(lambda dt: self.on_file_dialog_closed(list(file_paths)))
+
+    def on_file_dialog_closed(self, file_paths):
+        self.picker_open = False
         if file_paths:
             self.handle_file_selection(file_paths)
 
     def handle_file_selection(self, file_paths):
         if not file_paths or not self.device_ip:
             return
-        for file_path in file_paths:
-            if os.path.isfile(file_path):
-                self.send_file(file_path)
-            elif os.path.isdir(file_path):
-                self.send_folder(file_path)
-
-    def send_file(self, file_path):
-        filename = os.path.basename(file_path)
-        self.show_sending_popup(filename)
-        FileTransferManager.send_file(
-            file_path,
-            self.device_ip,
-            progress_callback=self.update_sending_progress,
-            completion_callback=self.on_send_complete
-        )
-
-    def send_folder(self, folder_path):
-        folder_name = os.path.basename(folder_path)
-        zip_filename = f"{folder_name}.zip"
-        self.show_sending_popup(zip_filename)
-        
-        def create_and_send():
-            try:
-                temp_zip_path = FileTransferManager.create_zip_from_folder(folder_path)
-                FileTransferManager.send_file(
-                    temp_zip_path,
-                    self.device_ip,
-                    progress_callback=self.update_sending_progress,
-                    completion_callback=self.on_send_complete
-                )
-            except Exception as e:
-                Clock.schedule_once(lambda dt: self.on_send_complete(False, str(e)))
-                
-        threading.Thread(target=create_and_send, daemon=True).start()
+        transfer_queue = App.get_running_app().transfer_queue
+        targets = self.selected_targets()
+        swarm = self.ids.swarm_toggle.state == 'down'
+        sync = self.ids.sync_toggle.state == 'down'
+        file_paths = [path for path in dict.fromkeys(file_paths) if os.path.isfile(path) or os.path.isdir(path)]
+        if not file_paths:
+            return
+        if len(file_paths) > 1 and not (swarm or sync):
+            # One connection and one progress row for the whole selection
+            transfer_queue.submit(file_paths, targets)
+        else:
+            for file_path in file_paths:
+                transfer_queue.submit(file_path, targets, swarm=swarm, sync=sync)
+        self.show_queue_popup()
 
-    def show_sending_popup(self, filename):
-        if self.sending_popup:
-            self.sending_popup.dismiss()
-            
-        self.sending_popup = Popup(
-            content=SendingProgressPopup(),
+    def show_queue_popup(self):
+        if self.queue_popup:
+            return
+        self.queue_popup = Popup(
+            content=TransferQueuePopup(),
             title="",
-            size_hint=(0.85, None),
-            height=280,  # Increased height for graph
+            size_hint=(0.9, 0.7),
             auto_dismiss=False
         )
-        self.sending_popup.content.ids.file_name_label.text = filename
-        self.sending_popup.content.ids.status_label.text = f"Sending to {self.device_name}..."
-        self.sending_popup.content.ids.progress_bar.value = 0
-        self.sending_popup.content.ids.speed_label.text = "0 MB/s"
-        self.sending_popup.open()
-
-    def update_sending_progress(self, progress, speed, speed_value=0):
-        if self.sending_popup:
-            self.sending_popup.content.ids.progress_bar.value = progress
-            self.sending_popup.content.ids.speed_label.text = speed
-            # Update speed graph
-            if hasattr(self.sending_popup.content.ids, 'speed_graph'):
-                self.sending_popup.content.ids.speed_graph.add_speed_point(speed_value)
-
-    def on_send_complete(self, success, message):
-        if self.sending_popup:
-            self.sending_popup.dismiss()
-            self.sending_popup = None
-        if success:
-            print("File sent successfully!")
-        else:
-            print(f"Send failed: {message}")
+        self._job_rows = {}
+        for job in App.get_running_app().transfer_queue.jobs:
+            self.on_job_update(job)
+        self.queue_popup.open()
 
-class SendingProgressPopup(BoxLayout):
+    def on_job_update(self, job):
+        if not self.queue_popup:
+            return
+        content = self.queue_popup.content
+        row = self._job_rows.get(job.job_id)
+        if row is None:
+            row = TransferJobRow()
+            row.ids.file_name_label.text = job.name
+            content.ids.job_list.add_widget(row)
+            self._job_rows[job.job_id] = row
+        row.update(job)
+
+        transfer_queue = App.get_running_app().transfer_queue
+        running = [j for j in transfer_queue.jobs if j.state == 'running']
+        waiting = [j for j in transfer_queue.jobs if j.state in ('scanning', 'queued')]
+        content.ids.summary_label.text = f"{len(running)} sending, {len(waiting)} queued"
+        if job.state == 'running' and job.speed_value:
+            content.ids.speed_graph.add_speed_point(sum(j.speed_value for j in running))
+
+        if job.finished:
+            print(f"Sent {job.name}" if job.state == 'done' else f"Send failed: {job.message}")
+            if not transfer_queue.active:
+                self.queue_popup.dismiss()
+                self.queue_popup = None
+                transfer_queue.clear_finished()
+
+class TransferQueuePopup(BoxLayout):
     pass
 
+class TransferJobRow(BoxLayout):
+    STATE_TEXT = {
+        'scanning': "Preparing...",
+        'queued': "Queued",
+        'done': "Sent",
+    }
+
+    def update(self, job):
+        if job.state == 'running':
+            if len(job.targets) > 1:
+                status = f"Sending to {len(job.targets)} devices..."
+            else:
+                status = f"Sending to {job.targets[0][0]}... {job.speed_text}"
+        elif job.state == 'failed':
+            status = f"Failed: {job.message}"
+        elif job.state == 'queued' and job.summary:
+            status = f"Queued - {job.summary}"
+        else:
+            status = self.STATE_TEXT[job.state]
+        self.ids.status_label.text = status
+        self.ids.progress_bar.value = job.progress
+        if len(job.targets) > 1:
+            self.update_targets(job)
+
+    def update_targets(self, job):
+        target_rows = self.ids.target_rows
+        if not target_rows.children:
+            for name, ip in job.targets:
+                target_rows.add_widget(TargetProgressRow(device_name=name))
+        for row, (name, ip) in zip(reversed(target_rows.children), job.targets):
+            row.ids.status_label.text = job.target_status[ip]
+            row.ids.progress_bar.value = job.target_progress[ip]
+
+class TargetProgressRow(BoxLayout):
+    device_name = StringProperty()
+
 class ReceivingProgressPopup(BoxLayout):
     pass
 
+class SnippetPopup(BoxLayout):
+    text = StringProperty()
+    sender = StringProperty()
+    link = StringProperty()
+
+    def on_text(self, instance, text):
+        text = text.strip()
+        self.link = text if text.startswith(('http://', 'https://')) and not any(c.isspace() for c in text) else ''
+
+    def open_link(self):
+        webbrowser.open(self.link)
+
+    def copy(self):
+        Clipboard.copy(self.text)
+
+class SettingRow(BoxLayout):
+    """A labelled numeric setting bound to a key of the app config"""
+    title = StringProperty()
+    section = StringProperty()
+    key = StringProperty()
+
+    def on_kv_post(self, base_widget):
+        self.ids.value_input.text = App.get_running_app().config.get(self.section, self.key)
+
+    def commit(self, text):
+        App.get_running_app().update_setting(self.section, self.key, text or '0')
+        self.ids.value_input.text = App.get_running_app().config.get(self.section, self.key)
+
+class SettingSwitchRow(BoxLayout):
+    """A labelled on/off setting bound to a key of the app config"""
+    title = StringProperty()
+    section = StringProperty()
+    key = StringProperty()
+
+    def on_kv_post(self, base_widget):
+        self.ids.value_switch.active = App.get_running_app().config.getboolean(self.section, self.key)
+
+    def commit(self, active):
+        App.get_running_app().update_setting(self.section, self.key, '1' if active else '0')
+
+class LinkProfileRow(BoxLayout):
+    """One device's link history on the settings screen"""
+    device_name = StringProperty()
+    details = StringProperty()
+
+    @staticmethod
+    def describe(profile):
+        parts = []
+        throughput = profile.get('throughput', {})
+        if throughput:
+            transport, rate = max(throughput.items(), key=lambda item: item[1])
+            parts.append(f"{rate / 1048576:.1f} MB/s ({transport})")
+        if profile.get('rtt') is not None:
+            parts.append(f"RTT {profile['rtt'] * 1000:.1f} ms")
+        if profile.get('loss') is not None:
+            parts.append(f"{profile['loss'] * 100:.2f}% resent")
+        streams = LinkProfiles.best_streams(profile)
+        if streams:
+            parts.append("multipath" if streams > 1 else "single stream")
+        if profile.get('udp_failures', 0) >= LinkProfiles.UDP_FAILURE_LIMIT:
+            parts.append("UDP off")
+        parts.append(f"{profile.get('transfers', 0)} sends, {profile.get('failures', 0)} failed")
+        return ", ".join(parts)
+
+class SettingsScreen(Screen):
+    def on_pre_enter(self, *args):
+        fingerprint = SecureTransport.fingerprint
+        self.ids.tls_identity.details = (
+            ' '.join(fingerprint[i:i + 4] for i in range(0, 24, 4)) + " ..." if fingerprint
+            else "Unavailable: no certificate could be created")
+        self.refresh_links()
+
+    def refresh_links(self):
+        link_list = self.ids.link_list
+        link_list.clear_widgets()
+        profiles = sorted(LinkProfiles.all(), key=lambda profile: -profile.get('updated', 0))
+        for profile in profiles:
+            link_list.add_widget(LinkProfileRow(device_name=profile.get('name') or profile.get('address', ''),
+                                                details=LinkProfileRow.describe(profile)))
+        if not profiles:
+            link_list.add_widget(LinkProfileRow(device_name="No transfers yet",
+                                                details="Speeds and latency appear here after the first send"))
+
+    def forget_links(self):
+        LinkProfiles.clear()
+        self.refresh_links()
+
+    def forget_pins(self):
+        SecureTransport.forget_pins()
+
+    def on_back_button_touch(self, touch):
+        if self.ids.back_button.collide_point(*touch.pos):
+            self.manager.current = 'devices'
+            return True
+        return False
+
 class SplashScreen(Screen):
     pass
 
@@ -550,12 +5144,102 @@ class SnapSendApp(App):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self.receiving_popup = None
+        self.snippet_popup = None
+        self.transfer_queue = TransferQueue()
 
     def resource_path(self, relative_path):
         if hasattr(sys, '_MEIPASS'):
             return os.path.join(sys._MEIPASS, relative_path)
         return os.path.abspath(relative_path)
 
+    def get_application_config(self):
+        # Keep settings out of the (possibly temporary) bundle directory
+        return super().get_application_config(os.path.join(self.user_data_dir, '%(appname)s.ini'))
+
+    def build_config(self, config):
+        config.setdefaults('transfer', {
+            'global_limit_mbps': '0',
+            'peer_limit_mbps': '0',
+            'udp_mode': '0',
+            'udp_fec': '0',
+            'dedup': '1',
+            'sync_mirror_deletes': '0',
+            'sync_accept_deletes': '0',
+            'sync_checksum': '0',
+            'hash_cache_entries': '100000',
+            'multipath': '0',
+            'splice': '1',
+            'cache_friendly_mb': '1024',
+            'direct_io': '0',
+            'verify_chunks': '1',
+            'encrypt': '0',
+            'require_encryption': '0',
+        })
+        config.setdefaults('device', {
+            'id': '',
+        })
+        config.setdefaults('metrics', {
+            'enabled': '0',
+            'port': '32780',
+            'log_transfers': '0',
+            'profile': '0',
+            'profile_cprofile': '0',
+        })
+
+    def update_setting(self, section, key, value):
+        try:
+            number = max(0.0, float(value))
+        except ValueError:
+            return
+        value = str(int(number)) if number.is_integer() else str(number)
+        self.config.set(section, key, value)
+        self.config.write()
+        self.apply_settings()
+
+    def apply_settings(self):
+        if not self.config.get('device', 'id'):
+            # Lets peers recognise this device on every interface it announces
+            self.config.set('device', 'id', uuid.uuid4().hex[:16])
+            self.config.write()
+        PeerDirectory.device_id = self.config.get('device', 'id')
+        SecureTransport.configure(
+            os.path.join(self.user_data_dir, 'tls'),
+            self.config.getboolean('transfer', 'encrypt'),
+            self.config.getboolean('transfer', 'require_encryption')
+        )
+        LinkProfiles.configure(os.path.join(self.user_data_dir, 'links.json'))
+        FileTransferManager.limiter.configure(
+            self.config.getfloat('transfer', 'global_limit_mbps') * 1048576,
+            self.config.getfloat('transfer', 'peer_limit_mbps') * 1048576
+        )
+        FileTransferManager.use_udp = self.config.getboolean('transfer', 'udp_mode')
+        FileTransferManager.udp_fec = self.config.getboolean('transfer', 'udp_fec')
+        FileTransferManager.dedup = self.config.getboolean('transfer', 'dedup')
+        FileTransferManager.multipath = self.config.getboolean('transfer', 'multipath')
+        Splice.enabled = self.config.getboolean('transfer', 'splice')
+        PageCache.min_size = int(self.config.getfloat('transfer', 'cache_friendly_mb') * 1048576)
+        PageCache.direct_io = self.config.getboolean('transfer', 'direct_io')
+        FileTransferManager.verify_chunks = self.config.getboolean('transfer', 'verify_chunks')
+        FileTransferManager.sync_mirror_deletes = self.config.getboolean('transfer', 'sync_mirror_deletes')
+        FolderSync.accept_deletes = self.config.getboolean('transfer', 'sync_accept_deletes')
+        FileTransferManager.sync_checksum = self.config.getboolean('transfer', 'sync_checksum')
+        hash_cache_entries = int(self.config.getfloat('transfer', 'hash_cache_entries'))
+        ContentIndex.configure(
+            os.path.join(self.user_data_dir, 'hashes.sqlite3') if hash_cache_entries else None,
+            hash_cache_entries
+        )
+        Metrics.configure(
+            self.config.getboolean('metrics', 'enabled'),
+            int(self.config.getfloat('metrics', 'port')),
+            log_path=os.path.join(self.user_data_dir, 'transfers.jsonl')
+            if self.config.getboolean('metrics', 'log_transfers') else None
+        )
+        TransferProfile.configure(
+            self.config.getboolean('metrics', 'profile'),
+            self.config.getboolean('metrics', 'profile_cprofile'),
+            os.path.join(self.user_data_dir, 'profiles')
+        )
+
     def show_receiving_popup(self, filename, ip):
         if self.receiving_popup:
             self.receiving_popup.dismiss()
@@ -581,6 +5265,18 @@ class SnapSendApp(App):
             if hasattr(self.receiving_popup.content.ids, 'speed_graph'):
                 self.receiving_popup.content.ids.speed_graph.add_speed_point(speed_value)
 
+    def show_snippet(self, text, ip):
+        if self.snippet_popup:
+            self.snippet_popup.dismiss()
+        self.snippet_popup = Popup(
+            content=SnippetPopup(text=text, sender=PeerDirectory.name_for(ip) or ip),
+            title="",
+            size_hint=(0.85, None),
+            height=280
+        )
+        self.snippet_popup.bind(on_dismiss=lambda popup: setattr(self, 'snippet_popup', None))
+        self.snippet_popup.open()
+
     def close_receiving_popup(self, success, message):
         if self.receiving_popup:
             self.receiving_popup.dismiss()
@@ -590,11 +5286,14 @@ class SnapSendApp(App):
     def build(self):
         Window.size = (400, 700)
         self.icon = resource_path('logo.svg')
+        self.apply_settings()
         sm = ScreenManager()
         sm.add_widget(SplashScreen(name='splash'))
         sm.add_widget(DeviceDiscoveryScreen(screen_manager=sm, app=self, name='devices'))
         upload_screen = UploadScreen(name='upload')
         sm.add_widget(upload_screen)
+        self.transfer_queue.bind(upload_screen.on_job_update)
+        sm.add_widget(SettingsScreen(name='settings'))
         
         def on_drop_file(window, file_path, x, y):
             current_screen = sm.current_screen
@@ -605,5 +5304,8 @@ class SnapSendApp(App):
         Clock.schedule_once(lambda dt: setattr(sm, 'current', 'devices'), 3)
         return sm
 
+    def on_stop(self):
+        ContentIndex.close()
+
 if __name__ == '__main__':
     SnapSendApp().run()
\ No newline at end of file